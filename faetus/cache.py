@@ -0,0 +1,94 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+# Returned by MetadataCache.get() when nothing (or only an expired entry)
+# is cached. None cannot be used: it is cached to remember "does not exist".
+MISSING = object()
+
+
+class MetadataCache(object):
+    '''Time-limited LRU cache of S3 metadata lookups.
+
+ Entries are keyed by (bucket_name, key_name) tuples, key_name being None
+ for the bucket itself. The cached value is the boto Bucket/Key returned by
+ S3, or None for a negative entry (no such bucket/key), so that repeated
+ probes for missing paths do not go to S3 either.
+
+ (bucket_name, None, prefix) entries tell whether any key starts with
+ prefix, i.e. whether a virtual directory exists.
+
+ At most max_entries are kept, the least recently used being dropped
+ first. A ttl of 0 disables caching altogether.
+    '''
+
+    def __init__(self, ttl=30, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires < time.time():
+                return MISSING
+            # Re-insert to mark as most recently used.
+            self.entries[key] = entry
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def invalidate_key(self, bucket_name, key_name, sep='/'):
+        '''Forget a key, and whether the virtual directories it is in
+        exist (it may have been the first or the last key in them).'''
+        self.lock.acquire()
+        try:
+            self.entries.pop((bucket_name, key_name), None)
+            prefix = ''
+            for part in key_name.split(sep)[:-1]:
+                prefix += part + sep
+                self.entries.pop((bucket_name, None, prefix), None)
+        finally:
+            self.lock.release()
+
+    def invalidate_bucket(self, bucket_name):
+        '''Forget a bucket and every key cached for it.'''
+        self.lock.acquire()
+        try:
+            for key in [k for k in self.entries if k[0] == bucket_name]:
+                del self.entries[key]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
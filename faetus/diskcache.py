@@ -0,0 +1,184 @@
+import os
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+from pyftpdlib import ftpserver
+
+from faetus.utils import smart_str
+
+
+class DiskCache(object):
+    '''Bounded LRU cache of S3 objects on local disk.
+
+ Each entry is the content of a key at a given etag, in a file named after
+ the hash of (bucket, key, etag): a new version of a key is a different
+ entry, and the stale one ages out. At most max_size bytes are kept, the
+ least recently used entries being deleted first; objects larger than
+ max_object_size are not cached.
+
+ Entries are written by a CacheWriter while the object is being
+ downloaded, and only become visible once complete.
+    '''
+
+    def __init__(self, directory, max_size, max_object_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_object_size = max_object_size or max_size // 10
+        self.lock = threading.Lock()
+        # file name -> size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.load()
+
+    def load(self):
+        '''Pick up the entries of a previous run, oldest access first.'''
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                # Another worker's share, see part().
+                continue
+            if name.startswith('tmp'):
+                # Download interrupted by a crash or restart.
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            files.append((st.st_atime, name, st.st_size))
+        files.sort()
+        for atime, name, size in files:
+            self.entries[name] = size
+            self.size += size
+        self.evict()
+
+    def part(self, slot, parts):
+        '''Return the cache of worker process `slot` out of `parts`: its own
+        subdirectory, with its share of max_size. Processes do not share
+        their index of the entries.'''
+        return DiskCache(os.path.join(self.directory, 'worker-%d' % slot),
+                         self.max_size // parts, self.max_object_size)
+
+    def entry_name(self, bucket_name, key_name, etag):
+        return hashlib.sha1('\0'.join([smart_str(bucket_name), smart_str(key_name),
+                                       smart_str(etag)])).hexdigest()
+
+    def get(self, bucket_name, key_name, etag):
+        '''Return the path of the cached content, or None.'''
+        name = self.entry_name(bucket_name, key_name, etag)
+        self.lock.acquire()
+        try:
+            size = self.entries.pop(name, None)
+            if size is None:
+                return None
+            # Re-insert to mark as most recently used.
+            self.entries[name] = size
+        finally:
+            self.lock.release()
+        return os.path.join(self.directory, name)
+
+    def remove(self, bucket_name, key_name, etag):
+        self.lock.acquire()
+        try:
+            self.discard(self.entry_name(bucket_name, key_name, etag))
+        finally:
+            self.lock.release()
+
+    def writer(self, bucket_name, key_name, etag, size):
+        '''Return a CacheWriter for the content of this key, or None if it
+        is not to be cached.'''
+        if not etag or size > self.max_object_size:
+            return None
+        try:
+            return CacheWriter(self, self.entry_name(bucket_name, key_name, etag), size)
+        except EnvironmentError, e:
+            ftpserver.logerror("Could not create a cache entry in %s: %s" % (self.directory, e))
+            return None
+
+    def add(self, temp_path, name, size):
+        self.lock.acquire()
+        try:
+            self.discard(name)
+            os.rename(temp_path, os.path.join(self.directory, name))
+            self.entries[name] = size
+            self.size += size
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def discard(self, name):
+        '''Delete an entry. Call with the lock held.'''
+        size = self.entries.pop(name, None)
+        if size is None:
+            return
+        self.size -= size
+        try:
+            # Sessions still reading it keep their open file.
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def evict(self):
+        '''Delete the least recently used entries beyond max_size. Call with
+        the lock held.'''
+        while self.size > self.max_size and self.entries:
+            self.discard(next(iter(self.entries)))
+
+
+class CacheWriter(object):
+    '''Writes a DiskCache entry to a temporary file, added to the cache by
+ commit() if it received the whole object.
+    '''
+
+    def __init__(self, cache, name, size):
+        self.cache = cache
+        self.name = name
+        self.size = size
+        self.written = 0
+        self.lock = threading.Lock()
+        fd, self.temp_path = tempfile.mkstemp(prefix='tmp', dir=cache.directory)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.lock.acquire()
+        try:
+            # Ignored once discarded by an aborted transfer.
+            if self.file is not None:
+                self.file.write(data)
+                self.written += len(data)
+        finally:
+            self.lock.release()
+
+    def commit(self):
+        self.lock.acquire()
+        try:
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+            if self.written == self.size:
+                self.cache.add(self.temp_path, self.name, self.size)
+                return
+        finally:
+            self.lock.release()
+        self.remove()
+
+    def discard(self):
+        self.lock.acquire()
+        try:
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+        finally:
+            self.lock.release()
+        self.remove()
+
+    def remove(self):
+        try:
+            os.remove(self.temp_path)
+        except OSError, e:
+            ftpserver.logerror("Could not remove %s: %s" % (self.temp_path, e))
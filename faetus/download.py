@@ -0,0 +1,118 @@
+import threading
+import Queue
+
+from collections import deque
+
+from boto.exception import S3ResponseError
+from pyftpdlib import ftpserver
+
+
+class _Range(object):
+    '''Byte range [start, end) of a key, fetched by one GET.'''
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.data = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ParallelRangeReader(object):
+    '''Reads a S3 key from offset to the end with several ranged GETs in
+ flight at once, for a throughput a single GET stream does not reach.
+
+ Threads fetch the ranges of range_size bytes in order. At most
+ buffer_size bytes of ranges (at least one range) are requested ahead of
+ the one being read, the next ones only as read() consumes them, and
+ there are no more threads than that: `concurrency` at most. The GETs
+ are conditional on the key's etag, so that a key replaced during the
+ download fails it rather than mixing two versions.
+    '''
+
+    def __init__(self, bucket, name, etag, size, offset=0, concurrency=4,
+                 range_size=8 * 1024 * 1024, buffer_size=64 * 1024 * 1024):
+        self.bucket = bucket
+        self.name = name
+        self.etag = etag
+        self.size = size
+        self.range_size = range_size
+        self.next_offset = offset
+        self.max_ahead = max(1, buffer_size // range_size)
+        concurrency = min(concurrency, self.max_ahead)
+        # Ranges requested, in order, the first one being read next.
+        self.ranges = deque()
+        self.current = ''
+        self.position = 0
+        self.closed = False
+        self.jobs = Queue.Queue()
+        self.threads = []
+        for i in range(concurrency):
+            thread = threading.Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+        self.fill()
+
+    def fill(self):
+        while len(self.ranges) < self.max_ahead and self.next_offset < self.size:
+            end = min(self.next_offset + self.range_size, self.size)
+            byte_range = _Range(self.next_offset, end)
+            self.next_offset = end
+            self.ranges.append(byte_range)
+            self.jobs.put(byte_range)
+
+    def work(self):
+        while True:
+            byte_range = self.jobs.get()
+            if byte_range is None:
+                return
+            if not self.closed:
+                self.fetch(byte_range)
+            byte_range.done.set()
+
+    def fetch(self, byte_range):
+        headers = {'Range': 'bytes=%d-%d' % (byte_range.start, byte_range.end - 1)}
+        if self.etag:
+            headers['If-Match'] = self.etag
+        key = self.bucket.new_key(self.name)
+        try:
+            key.open_read(headers=headers)
+            data = key.read()
+            key.close()
+        except (S3ResponseError, EnvironmentError), e:
+            ftpserver.logerror("Could not get bytes %d-%d of %s: %s" \
+                               % (byte_range.start, byte_range.end - 1, self.name, e))
+            byte_range.error = e
+            return
+        if len(data) != byte_range.end - byte_range.start:
+            byte_range.error = IOError(5, 'Short read')
+            return
+        byte_range.data = data
+
+    def read(self, size=65536):
+        while self.position >= len(self.current):
+            if self.closed or not self.ranges:
+                return ''
+            byte_range = self.ranges[0]
+            byte_range.done.wait()
+            if byte_range.error is not None:
+                raise IOError(5, 'Input/output error')
+            self.ranges.popleft()
+            self.current = byte_range.data
+            self.position = 0
+            self.fill()
+        data = self.current[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        '''Stop the threads. The GETs in flight are left to finish.'''
+        if self.closed:
+            return
+        self.closed = True
+        self.ranges.clear()
+        self.current = ''
+        for thread in self.threads:
+            self.jobs.put(None)
+        self.threads = []
@@ -0,0 +1,305 @@
+import os
+import time
+import sqlite3
+import threading
+
+from pyftpdlib import ftpserver
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+from boto.s3.prefix import Prefix
+
+from faetus.utils import chunked
+
+
+def text(name):
+    '''Key names as SQLite stores them: unicode.'''
+    if isinstance(name, str):
+        return name.decode('utf-8')
+    return name
+
+
+def after_prefix(prefix):
+    '''The smallest name sorting after all those starting with prefix,
+    which ends with a separator: "a/b/" -> "a/b0".'''
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+class KeyIndex(object):
+    '''Local SQLite copy of the key list (name, size, date, ETag) of the
+ buckets, serving their listings and the stat() of their keys without
+ asking S3.
+
+ A bucket is only served from the index once it has been listed in full,
+ by a background thread, the first time it is used. That thread then
+ lists it again every refresh_interval seconds while it is in use, to
+ pick up the changes made outside of faetus; those made through faetus
+ (STOR, DELE, rename, RMD) are applied at once. A bucket which has not
+ been listed again for twice refresh_interval is left to S3 until it is.
+
+ Each change carries the time it was made and deleted keys are kept as
+ tombstones until the next listing, so that a listing started before a
+ change does not undo it.
+
+ The worker processes share the database file; each opens its own
+ connection and runs its own refresh thread. Before listing a bucket, a
+ thread claims it in the leases table, and the others leave it alone for
+ refresh_interval seconds: the bucket is listed by one worker at a time,
+ and by another one only if that one died or takes that long.
+    '''
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS keys (bucket TEXT, name TEXT, size INTEGER, '
+        'last_modified TEXT, etag TEXT, deleted INTEGER, updated REAL, '
+        'PRIMARY KEY (bucket, name))',
+        'CREATE TABLE IF NOT EXISTS buckets (bucket TEXT PRIMARY KEY, refreshed REAL)',
+        'CREATE TABLE IF NOT EXISTS leases (bucket TEXT PRIMARY KEY, tried REAL)',
+    ]
+
+    # Keys fetched from the database at once while listing.
+    page_size = 1000
+
+    def __init__(self, path, refresh_interval=300):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Condition()
+        self.db = None
+        self.pid = None
+        self.thread = None
+        # Buckets in use: name -> [Bucket, last used, last refresh attempt
+        # by this process].
+        self.buckets = {}
+
+    def connect(self):
+        '''The database connection of this process, opened on first use
+        (worker processes must not share the one of their parent). Call
+        with the lock held.'''
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # Readers do not wait for the other processes' writes.
+            self.db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                self.db.execute(statement)
+            self.db.commit()
+            self.pid = os.getpid()
+            self.thread = None
+            self.buckets = {}
+        return self.db
+
+    def query(self, sql, args=()):
+        self.lock.acquire()
+        try:
+            return self.connect().execute(sql, args).fetchall()
+        finally:
+            self.lock.release()
+
+    def update(self, sql, args=(), many=False):
+        self.lock.acquire()
+        try:
+            db = self.connect()
+            if many:
+                db.executemany(sql, args)
+            else:
+                db.execute(sql, args)
+            db.commit()
+        finally:
+            self.lock.release()
+
+    def refreshed(self, bucket_name):
+        rows = self.query('SELECT refreshed FROM buckets WHERE bucket = ?', (text(bucket_name),))
+        return rows and rows[0][0] or 0
+
+    def tried(self, bucket_name):
+        '''When a worker last listed the bucket, or started to.'''
+        rows = self.query('SELECT max(coalesce((SELECT refreshed FROM buckets WHERE bucket = ?), 0), '
+                          'coalesce((SELECT tried FROM leases WHERE bucket = ?), 0))',
+                          (text(bucket_name),) * 2)
+        return rows[0][0]
+
+    def claim(self, bucket_name, now):
+        '''Take the bucket for a listing started now, unless a worker has
+        listed it, or started to, in the last refresh_interval seconds.
+        Returns whether it is ours to list.'''
+        bucket_name = text(bucket_name)
+        since = now - self.refresh_interval
+        self.lock.acquire()
+        try:
+            db = self.connect()
+            # A single UPDATE: the check and the claim are one write, which
+            # the other processes wait for.
+            db.execute('INSERT OR IGNORE INTO leases VALUES (?, 0)', (bucket_name,))
+            claimed = db.execute('UPDATE leases SET tried = ? WHERE bucket = ? AND tried <= ? '
+                                 'AND coalesce((SELECT refreshed FROM buckets WHERE bucket = ?), 0) <= ?',
+                                 (now, bucket_name, since, bucket_name, since)).rowcount
+            db.commit()
+        finally:
+            self.lock.release()
+        return claimed == 1
+
+    def covers(self, bucket):
+        '''Whether bucket (a boto Bucket) can be served from the index.
+        Starts keeping it up to date if it is not.'''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.connect()
+            entry = self.buckets.get(text(bucket.name))
+            if entry is None:
+                self.buckets[text(bucket.name)] = [bucket, now, 0]
+                self.lock.notify_all()
+            else:
+                entry[1] = now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='KeyIndex')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        return now - self.refreshed(bucket.name) < 2 * self.refresh_interval
+
+    def list(self, bucket, prefix):
+        '''Yield the Keys and Prefixes (virtual directories) right under
+        prefix, in the order of an S3 listing with a "/" delimiter.'''
+        bucket_name, prefix = text(bucket.name), text(prefix)
+        start, after = prefix, '>='
+        while True:
+            rows = self.query('SELECT name, size, last_modified, etag FROM keys '
+                              'WHERE bucket = ? AND name %s ? AND deleted = 0 '
+                              'ORDER BY name LIMIT ?' % after,
+                              (bucket_name, start, self.page_size))
+            if not rows:
+                return
+            for name, size, last_modified, etag in rows:
+                if not name.startswith(prefix):
+                    return
+                rest = name[len(prefix):]
+                if '/' in rest:
+                    subdir = prefix + rest[:rest.index('/') + 1]
+                    yield Prefix(bucket, subdir)
+                    # Skip the rest of the subdirectory.
+                    start, after = after_prefix(subdir), '>='
+                    break
+                yield self.make_key(bucket, name, size, last_modified, etag)
+            else:
+                if len(rows) < self.page_size:
+                    return
+                start, after = name, '>'
+
+    def get(self, bucket, name):
+        '''Return the Key, or None if there is no such key.'''
+        rows = self.query('SELECT name, size, last_modified, etag FROM keys '
+                          'WHERE bucket = ? AND name = ? AND deleted = 0',
+                          (text(bucket.name), text(name)))
+        if not rows:
+            return None
+        return self.make_key(bucket, *rows[0])
+
+    def has_prefix(self, bucket, prefix):
+        '''Whether any key starts with prefix (which ends with a "/").'''
+        prefix = text(prefix)
+        return bool(self.query('SELECT 1 FROM keys WHERE bucket = ? AND name >= ? '
+                               'AND name < ? AND deleted = 0 LIMIT 1',
+                               (text(bucket.name), prefix, after_prefix(prefix))))
+
+    def make_key(self, bucket, name, size, last_modified, etag):
+        key = Key(bucket, name)
+        key.size = size
+        key.last_modified = last_modified
+        key.etag = etag
+        return key
+
+    def put(self, bucket_name, name, size, etag):
+        '''Record a key just written through faetus.'''
+        now = time.time()
+        self.update('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, 0, ?)',
+                    (text(bucket_name), text(name), size,
+                     time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(now)),
+                     etag and text(etag), now))
+
+    def remove(self, bucket_name, name):
+        '''Record a key just deleted through faetus.'''
+        self.update('INSERT OR REPLACE INTO keys VALUES (?, ?, 0, NULL, NULL, 1, ?)',
+                    (text(bucket_name), text(name), time.time()))
+
+    def remove_prefix(self, bucket_name, prefix):
+        '''Record the keys under prefix (which ends with a "/") just deleted.'''
+        prefix = text(prefix)
+        self.update('UPDATE keys SET deleted = 1, updated = ? '
+                    'WHERE bucket = ? AND name >= ? AND name < ?',
+                    (time.time(), text(bucket_name), prefix, after_prefix(prefix)))
+
+    def forget(self, bucket_name):
+        '''Drop a bucket just deleted.'''
+        bucket_name = text(bucket_name)
+        self.lock.acquire()
+        try:
+            db = self.connect()
+            db.execute('DELETE FROM keys WHERE bucket = ?', (bucket_name,))
+            db.execute('DELETE FROM buckets WHERE bucket = ?', (bucket_name,))
+            db.execute('DELETE FROM leases WHERE bucket = ?', (bucket_name,))
+            db.commit()
+            self.buckets.pop(bucket_name, None)
+        finally:
+            self.lock.release()
+
+    def refresh(self, bucket):
+        '''List bucket in full from S3 and bring its copy up to date. What
+        changed through faetus since the listing started is left alone.'''
+        started = time.time()
+        bucket_name = text(bucket.name)
+        for keys in chunked(bucket.list(), self.page_size):
+            rows = [(key.size, key.last_modified, key.etag, started,
+                     bucket_name, key.name, started) for key in keys]
+            # New keys, then the others unless changed meanwhile.
+            self.update('INSERT OR IGNORE INTO keys (bucket, name, deleted, updated) '
+                        'VALUES (?, ?, 1, 0)',
+                        [(bucket_name, key.name) for key in keys], many=True)
+            self.update('UPDATE keys SET size = ?, last_modified = ?, etag = ?, '
+                        'deleted = 0, updated = ? WHERE bucket = ? AND name = ? '
+                        'AND updated < ?', rows, many=True)
+        self.lock.acquire()
+        try:
+            db = self.connect()
+            # Gone from S3, and tombstones the listing has caught up with.
+            db.execute('DELETE FROM keys WHERE bucket = ? AND updated < ?',
+                       (bucket_name, started))
+            db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?)',
+                       (bucket_name, started))
+            db.commit()
+        finally:
+            self.lock.release()
+
+    def run(self):
+        '''Refresh the buckets in use, each every refresh_interval seconds.
+        Those not used since their last refresh are dropped; those another
+        worker is listing, or has just listed, are left to it.'''
+        while True:
+            self.lock.acquire()
+            try:
+                due = None
+                while due is None:
+                    now = time.time()
+                    delay = self.refresh_interval
+                    for name, entry in self.buckets.items():
+                        bucket, used, tried = entry
+                        last = max(tried, self.tried(name))
+                        wait = last + self.refresh_interval - now
+                        if wait > 0:
+                            delay = min(delay, wait)
+                        elif used < last:
+                            del self.buckets[name]
+                        elif self.claim(name, now):
+                            due = entry
+                            break
+                    if due is None:
+                        self.lock.wait(delay)
+                due[2] = now
+            finally:
+                self.lock.release()
+            try:
+                self.refresh(due[0])
+            except S3ResponseError, e:
+                if e.status == 404:
+                    self.forget(due[0].name)
+                ftpserver.logerror("Could not index bucket %s: %s" % (due[0].name, e))
+            except Exception, e:
+                ftpserver.logerror("Could not index bucket %s: %s" % (due[0].name, e))
@@ -0,0 +1,71 @@
+import time
+
+from boto.s3.bucket import Bucket
+from boto.s3.prefix import Prefix
+
+from faetus.utils import s3_timestamp
+
+
+# Month numbers of ISO 8601 dates -> month names of LIST lines.
+MONTHS = dict(('%02d' % (i + 1), name) for i, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+
+def list_date(last_modified):
+    '''"Oct 12 17:50" for an S3 last_modified value, cut out of the ISO 8601
+    dates of the listings (2009-10-12T17:50:30.000Z) rather than parsed.'''
+    month = last_modified and last_modified[4:5] == '-' and MONTHS.get(last_modified[5:7])
+    if month:
+        # boto gives unicode: the lines must stay str.
+        return '%s %s %s' % (month, str(last_modified[8:10]), str(last_modified[11:16]))
+    # RFC 1123, from a HEAD.
+    return time.strftime("%b %d %H:%M", time.gmtime(s3_timestamp(last_modified)))
+
+
+def modify_fact(last_modified):
+    '''"20091012175030", the UTC MLSx modify fact of an S3 last_modified
+    value, cut out of ISO 8601 dates as list_date() does. None if there
+    is no date.'''
+    if last_modified and last_modified[4:5] == '-' and len(last_modified) >= 19:
+        return str(last_modified[0:4] + last_modified[5:7] + last_modified[8:10] +
+                   last_modified[11:13] + last_modified[14:16] + last_modified[17:19])
+    mtime = s3_timestamp(last_modified)
+    return mtime and time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime)) or None
+
+
+class ListFormatter(object):
+    '''Formats (name, item) pairs, as FaetusFS.get_dir_entries() gives them,
+ into the lines of a LIST reply ("ls -l" style), batch_size lines to each
+ string yielded: what the data channel sends at once.
+
+ The parts of the lines which do not depend on the entry are made once,
+ and the dates are cut out of S3's ISO 8601 ones (see list_date()).
+    '''
+
+    batch_size = 100
+
+    def __init__(self, username):
+        self.file_prefix = '-rw------   1 %s   group  ' % username
+        self.dir_key_prefix = 'drw------   1 %s   group  ' % username
+        # Buckets and virtual directories have no size nor date of their own.
+        self.dir_prefix = 'drwx------   1 %s   group  %8s Jan 01 00:00 ' % (username, 0)
+
+    def line(self, name, item):
+        if isinstance(item, (Bucket, Prefix)):
+            return '%s%s\r\n' % (self.dir_prefix, name)
+        if item.name[-1:] == '/':
+            prefix = self.dir_key_prefix
+        else:
+            prefix = self.file_prefix
+        return '%s%8s %s %s\r\n' % (prefix, item.size, list_date(item.last_modified), name)
+
+    def format(self, entries):
+        batch = []
+        line = self.line
+        for name, item in entries:
+            batch.append(line(name, item))
+            if len(batch) >= self.batch_size:
+                yield ''.join(batch)
+                batch = []
+        if batch:
+            yield ''.join(batch)
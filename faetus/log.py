@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+import collections
+
+from pyftpdlib import ftpserver
+
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+LOG_FORMAT = '%(asctime)-15s - %(levelname)s - %(message)s'
+
+
+class QueuedLogHandler(logging.Handler):
+    '''Queues the log records for a thread which formats them and writes
+ them to stream, every interval seconds, so that the event loop and the
+ worker threads never wait for the log file or the terminal. Queueing a
+ record is a deque append: no lock is taken and no thread woken.
+
+ The functions made by logger() (those pyftpdlib logs with) queue their
+ messages as they are, and the thread writes them in LOG_FORMAT without
+ making a LogRecord, the date and time being formatted once a second.
+
+ At most max_queued records wait to be written; beyond that they are
+ dropped, and how many is logged with the next ones written.
+
+ Each process starts its own thread on its first record: the workers
+ forked by PreforkServer do not inherit it.
+    '''
+
+    def __init__(self, stream, interval=0.1, max_queued=100000):
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.interval = interval
+        self.max_queued = max_queued
+        self.records = collections.deque()
+        self.dropped = 0
+        self.pid = None
+        self.starting = threading.Lock()
+        self.writing = threading.Lock()
+        # Date and time of line(), for the second they were made for.
+        self.second = None
+        self.asctime = None
+
+    def start(self):
+        self.starting.acquire()
+        try:
+            if self.pid != os.getpid():
+                # Left by the parent process: its own thread writes them.
+                self.records.clear()
+                self.dropped = 0
+                thread = threading.Thread(target=self.run, name='QueuedLogHandler')
+                thread.setDaemon(True)
+                thread.start()
+                self.pid = os.getpid()
+        finally:
+            self.starting.release()
+
+    def handle(self, record):
+        # Without the handler lock: emit() does not need it.
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def queue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        if len(self.records) < self.max_queued:
+            self.records.append(record)
+        else:
+            self.dropped += 1
+
+    def emit(self, record):
+        # The arguments and the traceback may change or go away before the
+        # thread gets to them.
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = (self.formatter or logging._defaultFormatter) \
+                .formatException(record.exc_info)
+            record.exc_info = None
+        self.queue(record)
+
+    def logger(self, level):
+        '''A function logging its message at level, if the root logger is
+        enabled for it, straight to this handler.'''
+        def log(msg):
+            if logging.root.isEnabledFor(level):
+                self.queue((time.time(), level, msg))
+        return log
+
+    def line(self, created, level, msg):
+        '''LOG_FORMAT line of a message queued by a logger() function.'''
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')
+        second = int(created)
+        if second != self.second:
+            self.second = second
+            self.asctime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))
+        return '%s,%03d - %s - %s\n' % (self.asctime, (created - second) * 1000,
+                                        logging.getLevelName(level), msg)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def write(self):
+        '''Write the queued records.'''
+        self.writing.acquire()
+        try:
+            records = self.records
+            lines = []
+            while records:
+                record = records.popleft()
+                if isinstance(record, tuple):
+                    lines.append(self.line(*record))
+                    continue
+                try:
+                    lines.append(self.format(record) + '\n')
+                except Exception:
+                    self.handleError(record)
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self.line(time.time(), logging.WARNING,
+                                       '%d log records dropped: the log could not keep up'
+                                       % dropped))
+            if not lines:
+                return
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except Exception:
+                # As logging.Handler.handleError() does, without a record.
+                if logging.raiseExceptions:
+                    try:
+                        traceback.print_exc()
+                    except IOError:
+                        pass
+        finally:
+            self.writing.release()
+
+    def flush(self):
+        if self.pid == os.getpid():
+            self.write()
+
+    def close(self):
+        self.flush()
+        if self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
+        logging.Handler.close(self)
+
+
+class SampledLog(object):
+    '''Debug lines logged for every path or file handled: one in `every`
+ of them is logged, none when the DEBUG level is off.
+
+ Called with a format and its arguments (parse_fspath(), FaetusFD(),
+ username transforms), the line is only formatted when it is logged. As
+ a logging filter, on the "boto" logger, it samples the "path=" and
+ "auth_path=" lines of each S3 request.
+
+ The count is shared by the threads without a lock: sampling may be off
+ by a few lines.
+    '''
+
+    def __init__(self, every=1):
+        self.every = every
+        self.count = 0
+
+    def sampled(self):
+        self.count += 1
+        if self.count >= self.every:
+            self.count = 0
+            return True
+        return False
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.sampled()
+
+    def __call__(self, msg, *args):
+        if logging.root.isEnabledFor(logging.DEBUG) and self.sampled():
+            if args:
+                msg = msg % args
+            ftpserver.logline(msg)
+
+
+debug_log = SampledLog()
+
+
+def setup(log_file=None, level='debug', queued=False, sample=1):
+    '''Send the pyftpdlib and faetus logs to log_file (stderr if None),
+    through a QueuedLogHandler if queued, and log one in `sample` of the
+    debug_log lines.'''
+    root = logging.getLogger()
+    ftpserver.log = root.info
+    ftpserver.logline = root.debug
+    ftpserver.logerror = root.error
+    debug_log.every = sample
+    if sample > 1:
+        # Counting apart from debug_log: the two kinds of lines alternate.
+        logging.getLogger('boto').addFilter(SampledLog(sample))
+    # Nothing of the log format needs the caller's file and line, which
+    # every record would otherwise look up in the stack, nor the thread
+    # and process.
+    logging._srcfile = None
+    logging.logThreads = 0
+    logging.logProcesses = 0
+
+    if queued:
+        if log_file:
+            stream = open(log_file, 'a')
+        else:
+            stream = sys.stderr
+        handler = QueuedLogHandler(stream)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(handler)
+        root.setLevel(LEVELS[level])
+        ftpserver.log = handler.logger(logging.INFO)
+        ftpserver.logline = handler.logger(logging.DEBUG)
+        ftpserver.logerror = handler.logger(logging.ERROR)
+    else:
+        logging.basicConfig(filename=log_file,
+                            format=LOG_FORMAT,
+                            level=LEVELS[level])
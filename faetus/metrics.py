@@ -0,0 +1,248 @@
+import time
+import threading
+import functools
+import BaseHTTPServer
+
+from pyftpdlib import ftpserver
+
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    '''Cumulative histogram of observed values, as Prometheus has them.'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    '''Counters of the server activity: FTP command latencies, S3 requests
+ and their latencies by operation, bytes transferred over the data
+ channels and active sessions. Shared by all the sessions (and threads)
+ of a process.
+
+ render() gives them in the Prometheus text format, served over HTTP by
+ serve(); summary() gives the lines SITE STATS replies with.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.sessions = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # command -> Histogram
+        self.commands = {}
+        # operation -> Histogram
+        self.s3_requests = {}
+        self.fs_operations = {}
+        # operation -> count of the requests S3 answered with an error
+        self.s3_errors = {}
+        # Write-behind uploads waiting to be sent to S3 (faetus.writebehind).
+        self.pending_uploads = 0
+        self.pending_upload_bytes = 0
+
+    def reset(self):
+        '''Start from zero (e.g. in a freshly forked process).'''
+        self.__init__()
+
+    def _observe(self, histograms, name, seconds):
+        self.lock.acquire()
+        try:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram()
+            histogram.observe(seconds)
+        finally:
+            self.lock.release()
+
+    def command(self, cmd, seconds):
+        self._observe(self.commands, cmd, seconds)
+
+    def fs_operation(self, name, seconds):
+        self._observe(self.fs_operations, name, seconds)
+
+    def s3_request(self, operation, seconds, status):
+        self._observe(self.s3_requests, operation, seconds)
+        # No status: the request failed without a response.
+        if status is None or status >= 400:
+            self.lock.acquire()
+            try:
+                self.s3_errors[operation] = self.s3_errors.get(operation, 0) + 1
+            finally:
+                self.lock.release()
+
+    def transfer(self, received, sent):
+        self.lock.acquire()
+        try:
+            self.bytes_received += received
+            self.bytes_sent += sent
+        finally:
+            self.lock.release()
+
+    def session_opened(self):
+        self.lock.acquire()
+        self.sessions += 1
+        self.lock.release()
+
+    def session_closed(self):
+        self.lock.acquire()
+        self.sessions -= 1
+        self.lock.release()
+
+    def upload_queue(self, depth, size):
+        self.lock.acquire()
+        self.pending_uploads = depth
+        self.pending_upload_bytes = size
+        self.lock.release()
+
+    def timed(self, name):
+        '''Decorator recording the duration of each call as the FaetusFS/
+        FaetusFD operation `name`, whether it succeeds or not.'''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.fs_operation(name, time.time() - start)
+            return wrapper
+        return decorator
+
+    def render(self):
+        '''All the metrics, in the Prometheus text exposition format.'''
+        self.lock.acquire()
+        try:
+            lines = [
+                '# HELP faetus_sessions Active FTP sessions.',
+                '# TYPE faetus_sessions gauge',
+                'faetus_sessions %d' % self.sessions,
+                '# HELP faetus_data_bytes_total Bytes transferred over the data channels.',
+                '# TYPE faetus_data_bytes_total counter',
+                'faetus_data_bytes_total{direction="in"} %d' % self.bytes_received,
+                'faetus_data_bytes_total{direction="out"} %d' % self.bytes_sent,
+                '# HELP faetus_pending_uploads Write-behind uploads not sent to S3 yet.',
+                '# TYPE faetus_pending_uploads gauge',
+                'faetus_pending_uploads %d' % self.pending_uploads,
+                '# HELP faetus_pending_upload_bytes Bytes of the write-behind uploads not sent to S3 yet.',
+                '# TYPE faetus_pending_upload_bytes gauge',
+                'faetus_pending_upload_bytes %d' % self.pending_upload_bytes,
+            ]
+            lines.extend(self.render_histograms('faetus_command_seconds',
+                'Time from an FTP command to its reply.', 'command', self.commands))
+            lines.extend(self.render_histograms('faetus_s3_request_seconds',
+                'Time from a S3 request to its response headers.', 'operation',
+                self.s3_requests))
+            lines.extend(self.render_histograms('faetus_fs_operation_seconds',
+                'Duration of the filesystem operations.', 'operation',
+                self.fs_operations))
+            lines.append('# HELP faetus_s3_errors_total S3 requests answered with an error.')
+            lines.append('# TYPE faetus_s3_errors_total counter')
+            for operation, count in sorted(self.s3_errors.items()):
+                lines.append('faetus_s3_errors_total{operation="%s"} %d' % (operation, count))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines) + '\n'
+
+    def render_histograms(self, metric, help, label, histograms):
+        lines = ['# HELP %s %s' % (metric, help), '# TYPE %s histogram' % metric]
+        for name, histogram in sorted(histograms.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label, name, bound, count))
+            lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (metric, label, name, histogram.count))
+            lines.append('%s_sum{%s="%s"} %f' % (metric, label, name, histogram.sum))
+            lines.append('%s_count{%s="%s"} %d' % (metric, label, name, histogram.count))
+        return lines
+
+    def summary(self):
+        '''Human readable lines for SITE STATS.'''
+        def averages(histograms, errors={}):
+            return ['  %s: %d, %.3fs avg%s' % (name, h.count, h.sum / h.count,
+                                               errors.get(name) and
+                                               ', %d errors' % errors[name] or '')
+                    for name, h in sorted(histograms.items())]
+
+        self.lock.acquire()
+        try:
+            lines = ['Uptime: %ds' % (time.time() - self.started),
+                     'Sessions: %d' % self.sessions,
+                     'Data bytes: %d in, %d out' % (self.bytes_received, self.bytes_sent),
+                     'Pending uploads: %d (%d bytes)' % (self.pending_uploads,
+                                                         self.pending_upload_bytes),
+                     'FTP commands:']
+            lines.extend(averages(self.commands))
+            lines.append('S3 requests:')
+            lines.extend(averages(self.s3_requests, self.s3_errors))
+        finally:
+            self.lock.release()
+        return lines
+
+    def serve(self, address, port):
+        '''Serve render() over HTTP, from a thread.'''
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        ftpserver.log("Serving metrics on http://%s:%d/" % (address, port))
+        return server
+
+
+def s3_operation(method, bucket, key, headers, query_args):
+    '''Name of the S3 API operation a boto request is for.'''
+    query_args = query_args or ''
+    headers = headers or {}
+    if not bucket:
+        return 'ListBuckets'
+    if not key:
+        if method == 'POST' and 'delete' in query_args:
+            return 'DeleteObjects'
+        if method == 'GET' and 'uploads' in query_args:
+            return 'ListMultipartUploads'
+        return {'GET': 'ListObjects', 'PUT': 'CreateBucket', 'HEAD': 'HeadBucket',
+                'DELETE': 'DeleteBucket'}.get(method, method + 'Bucket')
+    if method == 'PUT':
+        copy = 'x-amz-copy-source' in headers
+        if 'partNumber' in query_args:
+            return copy and 'UploadPartCopy' or 'UploadPart'
+        return copy and 'CopyObject' or 'PutObject'
+    if method == 'POST':
+        if 'uploads' in query_args:
+            return 'CreateMultipartUpload'
+        return 'CompleteMultipartUpload'
+    if method == 'DELETE' and 'uploadId' in query_args:
+        return 'AbortMultipartUpload'
+    if method == 'GET' and 'uploadId' in query_args:
+        return 'ListParts'
+    return {'GET': 'GetObject', 'HEAD': 'HeadObject',
+            'DELETE': 'DeleteObject'}.get(method, method + 'Object')
+
+
+metrics = Metrics()
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import errno
+import signal
+import logging
+import traceback
+
+from pyftpdlib import ftpserver
+
+from faetus.server import connections, FaetusFD
+from faetus.workers import WorkerPool
+from faetus.metrics import metrics
+
+
+def split_ports(ports, parts):
+    '''Split a list of passive ports into `parts` contiguous slices of
+    (almost) the same size.'''
+    size, extra = divmod(len(ports), parts)
+    slices = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (i < extra and 1 or 0)
+        slices.append(ports[start:end])
+        start = end
+    return slices
+
+
+class PreforkServer(object):
+    '''Runs an ftpserver.FTPServer in several forked worker processes, all
+ accepting connections on its listening socket, so that the sessions are
+ spread over as many cores.
+
+ Each worker starts without any S3 connection (they are not shared across
+ processes), creates its own worker thread pool if `threads` is set, and
+ gets its own slice of the handler's passive_ports so that two workers
+ never pick the same one, and its own share of the disk cache. With a
+ metrics_port, worker `slot` serves its metrics on metrics_port + slot.
+ Workers that die are restarted; SIGTERM or SIGINT stops them all.
+    '''
+
+    # Seconds to wait before restarting a worker which died right after
+    # being started, so that a broken setup does not fork in a tight loop.
+    restart_delay = 1
+
+    def __init__(self, server, workers, threads=0, metrics_port=0):
+        self.server = server
+        self.handler = server.handler
+        self.workers = workers
+        self.threads = threads
+        self.metrics_port = metrics_port
+        self.passive_ports = None
+        if self.handler.passive_ports:
+            self.passive_ports = split_ports(list(self.handler.passive_ports), workers)
+        # pid -> (slot, start time)
+        self.children = {}
+        self.running = False
+
+    def serve_forever(self, **kwargs):
+        '''Start the workers, then restart them as they die until stopped.
+        Keyword arguments are passed to FTPServer.serve_forever() in the workers.'''
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        ftpserver.log("Serving FTP on %s:%s with %d worker processes" \
+                      % (self.server.socket.getsockname()[:2] + (self.workers,)))
+        for slot in range(self.workers):
+            self.spawn(slot, kwargs)
+
+        while self.running:
+            try:
+                pid, status = os.wait()
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno == errno.ECHILD:
+                    break
+                raise
+            if pid not in self.children:
+                continue
+            slot, started = self.children.pop(pid)
+            if not self.running:
+                break
+            ftpserver.logerror("Worker %d (pid %d) exited with status %d; restarting it." \
+                               % (slot, pid, status))
+            if time.time() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+            self.spawn(slot, kwargs)
+        self.stop()
+
+    def handle_signal(self, signum, frame):
+        self.running = False
+
+    def spawn(self, slot, kwargs):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot, time.time())
+            return pid
+        status = 0
+        try:
+            try:
+                self.run_worker(slot, kwargs)
+            except:
+                ftpserver.logerror(traceback.format_exc())
+                status = 1
+        finally:
+            # Write what a QueuedLogHandler still holds.
+            logging.shutdown()
+            os._exit(status)
+
+    def run_worker(self, slot, kwargs):
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # FTPServer.serve_forever() closes all the sessions on SystemExit.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        # Nothing opened by the parent (or a previous worker) is reused.
+        connections.clear()
+        if self.passive_ports:
+            self.handler.passive_ports = self.passive_ports[slot]
+        if FaetusFD.disk_cache is not None:
+            FaetusFD.disk_cache = FaetusFD.disk_cache.part(slot, self.workers)
+        if FaetusFD.upload_queue is not None:
+            FaetusFD.upload_queue = FaetusFD.upload_queue.part(slot, self.workers)
+        if self.threads:
+            self.handler.worker_pool = WorkerPool(self.threads)
+        metrics.reset()
+        if self.metrics_port:
+            metrics.serve(self.server.socket.getsockname()[0], self.metrics_port + slot)
+        self.server.serve_forever(**kwargs)
+
+    def stop(self):
+        '''Stop the workers and wait for them.'''
+        self.running = False
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                break
+            self.children.pop(pid, None)
+        self.children.clear()
+        self.server.close()
+        ftpserver.log("Shutting down FTP server.")
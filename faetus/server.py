@@ -1,16 +1,30 @@
 import os
-import datetime
+import hashlib
 import ftplib
+import itertools
 import time
 import mimetypes
-import tempfile
+import socket
+import threading
+from cStringIO import StringIO
 
 from pyftpdlib import ftpserver
 from boto.s3.connection import S3Connection
-from boto.exception import S3ResponseError, S3CreateError
+from boto.exception import S3ResponseError, S3CreateError, S3DataError
 from boto.s3.key import Key
 from boto.s3.bucket import Bucket
 from boto.s3.bucketlistresultset import BucketListResultSet
+from boto.s3.prefix import Prefix
+
+from faetus.cache import MetadataCache, MISSING
+from faetus.workers import PrefetchProducer, parallel_map, loop_waker
+from faetus.download import ParallelRangeReader
+from faetus.upload import ParallelPartUploader
+from faetus.spool import MemoryBudget, SpooledUpload
+from faetus.listing import ListFormatter, modify_fact
+from faetus.utils import s3_timestamp, chunked
+from faetus.metrics import metrics, s3_operation
+from faetus.log import debug_log
 
 # The path separator used for "virtual directories" in  the cloud system. ("/" for S3)
 # This is used for two purposes:
@@ -36,28 +50,720 @@ def asciify(string):
     except:
         return string
             
+class FaetusDTPHandler(ftpserver.DTPHandler):
+    '''Data channel which tells the FaetusFD when an upload was cut short
+ (ABOR, timeout, reset or broken data connection), so that a half-sent
+ multipart upload gets cancelled instead of completed.
+
+ When the command channel has a worker pool, the FaetusFD calls that go to
+ S3 are made in the pool: the writes of an upload (one at a time, the
+ socket not being read meanwhile) and the final upload on EOF, which the
+ 226 reply then waits for. Downloads are sent from a PrefetchProducer,
+ the channel only asking for data once the next chunk has arrived.
+
+ With or without a pool, the socket of an upload is not read while the
+ parts being uploaded in parallel fill their buffer (FaetusFD.ready()),
+ rather than the write blocking the loop until one is done.
+
+ With a Scheduler on the command channel, the socket is only read from or
+ written to while the bandwidth limits of the account allow it.
+    '''
+
+    def __init__(self, sock_obj, cmd_channel):
+        self._throttle = cmd_channel.fs.throttle
+        self._aborted = False
+        self._writing = False
+        self._committing = False
+        self._abort_pending = False
+        super(FaetusDTPHandler, self).__init__(sock_obj, cmd_channel)
+
+    def readable(self):
+        if self._writing or self._committing:
+            return False
+        if self.receive and not self.file_obj.ready():
+            # The parts being uploaded fill the memory budget.
+            return False
+        if self.receive and self._throttle is not None and \
+           not self._throttle.may_transfer():
+            return False
+        return super(FaetusDTPHandler, self).readable()
+
+    def enable_receiving(self, type, cmd):
+        super(FaetusDTPHandler, self).enable_receiving(type, cmd)
+        # Re-check readable() as soon as an upload has room again.
+        if self.cmd_channel.worker_pool is not None:
+            self.file_obj.on_ready = self.cmd_channel.worker_pool.wake
+        else:
+            self.file_obj.on_ready = loop_waker().wake
+
+    def writable(self):
+        if self.producer_fifo:
+            producer = self.producer_fifo[0]
+            if hasattr(producer, 'ready') and not producer.ready():
+                return False
+        if not self.receive and self._throttle is not None and \
+           not self._throttle.may_transfer():
+            return False
+        return super(FaetusDTPHandler, self).writable()
+
+    def recv(self, buffer_size):
+        chunk = super(FaetusDTPHandler, self).recv(buffer_size)
+        if self._throttle is not None:
+            self._throttle.transferred(len(chunk))
+        return chunk
+
+    def send(self, data):
+        sent = super(FaetusDTPHandler, self).send(data)
+        if self._throttle is not None:
+            self._throttle.transferred(sent)
+        return sent
+
+    def handle_read(self):
+        pool = self.cmd_channel.worker_pool
+        if pool is None:
+            return super(FaetusDTPHandler, self).handle_read()
+        try:
+            chunk = self.recv(self.ac_in_buffer_size)
+        except socket.error:
+            self.handle_error()
+            return
+        self.tot_bytes_received += len(chunk)
+        if chunk:
+            self._writing = True
+            pool.submit(self.file_obj.write, (self._data_wrapper(chunk),),
+                        self._written, self._write_failed)
+        # else recv() has called handle_close() already
+
+    def _written(self, result):
+        self._writing = False
+        if self._abort_pending:
+            self._abort_pending = False
+            self.cmd_channel.worker_pool.submit(self.file_obj.abort)
+        elif self._committing:
+            self._commit()
+
+    def _write_failed(self, err):
+        self._writing = False
+        self._abort_pending = False
+        self.file_obj.closed = True
+        self.cmd_channel.worker_pool.submit(self.file_obj.abort)
+        if not self._closed:
+            self.cmd_channel.respond("426 %s; transfer aborted." % ftpserver._strerror(err))
+            self.close()
+
+    def _commit(self):
+        fd = self.file_obj
+        fd.closed = True
+        self.cmd_channel.worker_pool.submit(fd.commit, (), self._committed,
+                                            self._commit_failed)
+
+    def _committed(self, result):
+        # Unless ABOR or QUIT closed the channel while we were uploading.
+        if not self._closed:
+            self.cmd_channel.respond("226 Transfer complete.")
+            self.close()
+
+    def _commit_failed(self, err):
+        if not self._closed:
+            self.transfer_finished = False
+            self.cmd_channel.respond("426 %s; transfer aborted." % ftpserver._strerror(err))
+            self.close()
+
+    def handle_error(self):
+        # Whatever went wrong (socket error, S3 error while writing),
+        # the data received so far is not a complete file.
+        if self.receive:
+            self._aborted = True
+        super(FaetusDTPHandler, self).handle_error()
+
+    def handle_close(self):
+        if self.receive and self._aborted:
+            self.cmd_channel.respond("426 Transfer aborted; %d bytes transmitted." \
+                                     % self.get_transmitted_bytes())
+            self.close()
+        elif self.receive and self.cmd_channel.worker_pool is not None:
+            # End of the upload: only reply once the data is on S3.
+            self.transfer_finished = True
+            if not self._committing:
+                self._committing = True
+                if self._idler is not None and not self._idler.cancelled:
+                    self._idler.cancel()
+                if not self._writing:
+                    self._commit()
+        else:
+            super(FaetusDTPHandler, self).handle_close()
+
+    def close(self):
+        if not self._closed:
+            metrics.transfer(self.tot_bytes_received, self.tot_bytes_sent)
+        if self.receive and not self.transfer_finished:
+            fd = self.file_obj
+            if fd is not None and not fd.closed:
+                if self.cmd_channel.worker_pool is None:
+                    fd.abort()
+                else:
+                    fd.closed = True
+                    if self._writing:
+                        # Not while the pool is still writing to it.
+                        self._abort_pending = True
+                    else:
+                        self.cmd_channel.worker_pool.submit(fd.abort)
+        super(FaetusDTPHandler, self).close()
+
+
 class FaetusFTPHandler(ftpserver.FTPHandler):
+    '''FTP command channel. Without a worker_pool, S3 is called right from the
+ asyncore loop, every session waiting while a request is under way.
+
+ With a worker_pool (faetus.workers.WorkerPool), the commands going to S3
+ make their calls in the pool and reply once the result is back in the
+ loop. The session does not process further commands meanwhile: those
+ pipelined by the client are queued and run in order afterwards.
+    '''
+
+    dtp_handler = FaetusDTPHandler
+    worker_pool = None
+    # faetus.throttle.Scheduler enforcing bandwidth and S3 request limits.
+    scheduler = None
+
+    proto_cmds = ftpserver.proto_cmds.copy()
+    proto_cmds['SITE RMTREE'] = dict(perm='d', auth=True, arg=True,
+        help='Syntax: SITE <SP> RMTREE <SP> path (remove directory and all its content).')
+    proto_cmds['SITE STATS'] = dict(perm=None, auth=True, arg=False,
+        help='Syntax: SITE <SP> STATS (show server statistics).')
+    proto_cmds['SITE MD5'] = dict(perm='r', auth=True, arg=True,
+        help='Syntax: SITE <SP> MD5 <SP> file-name (show the MD5 of a file).')
+    proto_cmds['SITE SHA256'] = dict(perm='r', auth=True, arg=True,
+        help='Syntax: SITE <SP> SHA256 <SP> file-name (show the SHA-256 of a file).')
         
     def __init__(self, conn, server):
+      self._deferred = False
+      self._pipelined = []
+      self._cmd_started = None
       super(FaetusFTPHandler, self).__init__(conn, server)
-     
+      # The MLSD/MLST facts S3 lists (no unix.* nor create).
+      self._available_facts = ['type', 'perm', 'size', 'modify', 'unique']
+      self._current_facts = self._available_facts[:]
+      metrics.session_opened()
+
+    def flush_account(self):
+        # REIN or a second USER: the next login gets a fresh FaetusFS.
+        if self.fs is not None:
+            self.fs.close()
+        super(FaetusFTPHandler, self).flush_account()
+
+    def close(self):
+        if not self._closed:
+            metrics.session_closed()
+        if self.fs is not None:
+            self.fs.close()
+        super(FaetusFTPHandler, self).close()
+
+    def readable(self):
+        return not self._deferred and super(FaetusFTPHandler, self).readable()
+
+    def found_terminator(self):
+        if self._deferred:
+            # Pipelined after a command still waiting for S3: run it later.
+            self._pipelined.append(''.join(self._in_buffer))
+            self._in_buffer = []
+            self._in_buffer_len = 0
+            return
+        super(FaetusFTPHandler, self).found_terminator()
+
+    def process_command(self, cmd, *args, **kwargs):
+        self._current_cmd = (cmd, args and args[0])
+        self._cmd_started = time.time()
+        super(FaetusFTPHandler, self).process_command(cmd, *args, **kwargs)
+
+    def log_cmd(self, cmd, arg, respcode, respstr):
+        # Called once per command, on its (first) reply, deferred or not.
+        if self._cmd_started is not None:
+            metrics.command(cmd, time.time() - self._cmd_started)
+            self._cmd_started = None
+        super(FaetusFTPHandler, self).log_cmd(cmd, arg, respcode, respstr)
+
+    def defer(self, function, args, callback, errback=None, cleanup=None):
+        """Call function(*args) in the worker pool, then callback(result)
+        back in the loop. An EnvironmentError is passed to errback, or
+        replied as a 550 by default. If the session was closed meanwhile,
+        cleanup(result) is called instead of callback.
+        """
+        cmd, arg = self._current_cmd
+
+        def finish(handler, value):
+            self._deferred = False
+            if self._closed:
+                if cleanup is not None and handler is callback:
+                    cleanup(value)
+                return
+            self._last_response = ""
+            handler(value)
+            # As process_command() does for the commands replying at once.
+            if self._last_response:
+                code = int(self._last_response[:3])
+                self.log_cmd(cmd, arg, code, self._last_response[4:])
+            while self._pipelined and not self._deferred and not self._closed:
+                self._in_buffer = [self._pipelined.pop(0)]
+                self._in_buffer_len = len(self._in_buffer[0])
+                super(FaetusFTPHandler, self).found_terminator()
+
+        def failed(err):
+            if not isinstance(err, EnvironmentError):
+                self.respond('451 Requested action aborted: local error in processing.')
+            elif errback is not None:
+                errback(err)
+            else:
+                self.respond('550 %s.' % ftpserver._strerror(err))
+
+        self._deferred = True
+        self.worker_pool.submit(function, args,
+                                lambda result: finish(callback, result),
+                                lambda err: finish(failed, err))
+
+    def open_listing(self, function, path):
+        """Run in the pool: start a LIST/NLST listing, fetching its first
+        lines so that errors are raised here."""
+        producer = ftpserver.BufferedIteratorProducer(function(path))
+        return PrefetchProducer(producer, self.worker_pool, producer.more())
+
+    def ftp_MLSD(self, path):
+        """Stream the listing as LIST does, with the facts S3 lists
+        rather than a stat() of each entry."""
+        perms = self.authorizer.get_perms(self.username)
+        function = lambda path: self.fs.get_mlsd_dir(path, perms, self._current_facts)
+        if self.worker_pool is not None:
+            self.defer(self.open_listing, (function, path), lambda producer:
+                self.push_dtp_data(producer, isproducer=True, cmd="MLSD"))
+            return
+        try:
+            iterator = self.run_as_current_user(function, path)
+        except OSError, err:
+            self.respond('550 %s.' % ftpserver._strerror(err))
+        else:
+            producer = ftpserver.BufferedIteratorProducer(iterator)
+            self.push_dtp_data(producer, isproducer=True, cmd="MLSD")
+
+    def get_mlst_data(self, path):
+        basedir, basename = os.path.split(path)
+        perms = self.authorizer.get_perms(self.username)
+        return ''.join(self.fs.format_mlsx(basedir, [basename], perms,
+                                           self._current_facts, ignore_err=False))
+
+    def ftp_MLST(self, path):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_MLST(path)
+        line = self.fs.fs2ftp(path)
+
+        def reply(data):
+            # As pyftpdlib replies, with the full path.
+            self.push('250-Listing "%s":\r\n' % line)
+            self.push(' ' + data.split(' ')[0] + ' %s\r\n' % line)
+            self.respond('250 End MLST.')
+
+        self.defer(self.get_mlst_data, (path,), reply)
+
+    def ftp_CWD(self, path):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_CWD(path)
+        self.defer(self.fs.chdir, (path,), lambda result:
+            self.respond('250 "%s" is the current directory.' % self.fs.cwd))
+
+    def ftp_LIST(self, path):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_LIST(path)
+        self.defer(self.open_listing, (self.fs.get_list_dir, path), lambda producer:
+            self.push_dtp_data(producer, isproducer=True, cmd="LIST"))
+
+    def ftp_NLST(self, path):
+        """Return a list of files in the specified directory in a
+        compact form to the client, streamed as S3 lists it (the same
+        way as LIST) rather than collected and sorted first.
+        """
+        if self.worker_pool is not None:
+            self.defer(self.open_listing, (self.fs.get_nlst_dir, path), lambda producer:
+                self.push_dtp_data(producer, isproducer=True, cmd="NLST"))
+            return
+        try:
+            iterator = self.run_as_current_user(self.fs.get_nlst_dir, path)
+        except OSError, err:
+            self.respond('550 %s.' % ftpserver._strerror(err))
+        else:
+            producer = ftpserver.BufferedIteratorProducer(iterator)
+            self.push_dtp_data(producer, isproducer=True, cmd="NLST")
+
+    def seek_restart(self, fd, file, rest_pos):
+        """Run in the pool: position fd for REST as pyftpdlib does, returning
+        the 554 reply if that is not possible (None if it went fine)."""
+        try:
+            if rest_pos > self.fs.getsize(file):
+                raise ValueError
+            fd.seek(rest_pos)
+        except ValueError:
+            return '554 Invalid REST parameter'
+        except IOError, err:
+            return '554 %s' % ftpserver._strerror(err)
+
+    def open_retr(self, file, rest_pos, type):
+        fd = self.fs.open(file, 'rb')
+        if rest_pos:
+            error = self.seek_restart(fd, file, rest_pos)
+            if error:
+                fd.close()
+                return fd, error
+        producer = ftpserver.FileProducer(fd, type)
+        return fd, PrefetchProducer(producer, self.worker_pool, producer.more())
+
+    def ftp_RETR(self, file):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_RETR(file)
+        rest_pos = self._restart_position
+        self._restart_position = 0
+
+        def start((fd, producer)):
+            if isinstance(producer, str):
+                self.respond(producer)
+            else:
+                self.push_dtp_data(producer, isproducer=True, file=fd, cmd="RETR")
+
+        self.defer(self.open_retr, (file, rest_pos, self._current_type), start,
+                   cleanup=lambda (fd, producer): fd.close())
+
+    def open_stor(self, file, mode, rest_pos):
+        fd = self.fs.open(file, mode)
+        if rest_pos:
+            return fd, self.seek_restart(fd, file, rest_pos)
+        return fd, None
+
+    def ftp_STOR(self, file, mode='w'):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_STOR(file, mode)
+        if 'a' in mode:
+            cmd = 'APPE'
+        else:
+            cmd = 'STOR'
+        rest_pos = self._restart_position
+        self._restart_position = 0
+        if rest_pos:
+            mode = 'r+'
+
+        def start((fd, error)):
+            if error:
+                self.respond(error)
+            elif self.data_channel is not None:
+                self.respond("125 Data connection already open. Transfer starting.")
+                self.data_channel.file_obj = fd
+                self.data_channel.enable_receiving(self._current_type, cmd)
+            else:
+                self.respond("150 File status okay. About to open data connection.")
+                self._in_dtp_queue = (fd, cmd)
+
+        def cleanup((fd, error)):
+            fd.closed = True
+            self.worker_pool.submit(fd.abort)
+
+        self.defer(self.open_stor, (file, mode + 'b', rest_pos), start,
+                   cleanup=cleanup)
+
+    def get_size(self, path):
+        if not self.fs.isfile(self.fs.realpath(path)):
+            return None
+        return self.fs.getsize(path)
+
+    def ftp_SIZE(self, path):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_SIZE(path)
+        line = self.fs.fs2ftp(path)
+        if self._current_type == 'a':
+            self.respond("550 SIZE not allowed in ASCII mode.")
+            return
+
+        def reply(size):
+            if size is None:
+                self.respond("550 %s is not retrievable." % line)
+            else:
+                self.respond("213 %s" % size)
+
+        self.defer(self.get_size, (path,), reply)
+
+    def get_mtime(self, path):
+        if not self.fs.isfile(self.fs.realpath(path)):
+            return None
+        return self.fs.getmtime(path)
+
+    def ftp_MDTM(self, path):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_MDTM(path)
+        line = self.fs.fs2ftp(path)
+        if self.use_gmt_times:
+            timefunc = time.gmtime
+        else:
+            timefunc = time.localtime
+
+        def reply(secs):
+            if secs is None:
+                self.respond("550 %s is not retrievable" % line)
+                return
+            try:
+                lmt = time.strftime("%Y%m%d%H%M%S", timefunc(secs))
+            except ValueError:
+                self.respond("550 Can't determine file's last modification time.")
+            else:
+                self.respond("213 %s" % lmt)
+
+        self.defer(self.get_mtime, (path,), reply)
+
+    def get_status_listing(self, path):
+        # The whole listing: the command channel has no producer waiting
+        # for the pool.
+        return ''.join(self.fs.get_list_dir(path))
+
+    def ftp_STAT(self, path):
+        if self.worker_pool is None or not path:
+            return super(FaetusFTPHandler, self).ftp_STAT(path)
+        line = self.fs.fs2ftp(path)
+
+        def reply(listing):
+            self.push('213-Status of "%s":\r\n' % line)
+            self.push(listing)
+            self.respond('213 End of status.')
+
+        self.defer(self.get_status_listing, (path,), reply)
+
+    def ftp_MKD(self, path):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_MKD(path)
+        line = self.fs.fs2ftp(path)
+        self.defer(self.fs.mkdir, (path,), lambda result:
+            self.respond('257 "%s" directory created.' % line.replace('"', '""')))
+
+    def ftp_RMD(self, path):
+        if self.worker_pool is None or \
+           self.fs.realpath(path) == self.fs.realpath(self.fs.root):
+            return super(FaetusFTPHandler, self).ftp_RMD(path)
+        self.defer(self.fs.rmdir, (path,), lambda result:
+            self.respond("250 Directory removed."))
+
+    def ftp_SITE_RMTREE(self, path):
+        """Delete a bucket or virtual directory with all its content."""
+        if self.fs.realpath(path) == self.fs.realpath(self.fs.root):
+            self.respond("550 Can't remove root directory.")
+            return
+        reply = lambda deleted: self.respond("250 Directory removed (%d files)." % deleted)
+        if self.worker_pool is not None:
+            self.defer(self.fs.delete_tree, (path,), reply)
+            return
+        try:
+            deleted = self.run_as_current_user(self.fs.delete_tree, path)
+        except OSError, err:
+            self.respond('550 %s.' % ftpserver._strerror(err))
+        else:
+            reply(deleted)
+
+    def ftp_SITE_STATS(self, line):
+        """Show the request counts and latencies of this server process."""
+        self.push("211-Faetus statistics:\r\n")
+        self.push("".join([" %s\r\n" % x for x in metrics.summary()]))
+        self.respond("211 End STATS.")
+
+    def site_checksum(self, path, algorithm):
+        reply = lambda digest: self.respond("213 %s" % digest)
+        if self.worker_pool is not None:
+            self.defer(self.fs.checksum, (path, algorithm), reply)
+            return
+        try:
+            digest = self.run_as_current_user(self.fs.checksum, path, algorithm)
+        except OSError, err:
+            self.respond('550 %s.' % ftpserver._strerror(err))
+        else:
+            reply(digest)
+
+    def ftp_SITE_MD5(self, path):
+        """Reply with the MD5 of a file, as recorded on S3: no download."""
+        self.site_checksum(path, 'md5')
+
+    def ftp_SITE_SHA256(self, path):
+        """Reply with the SHA-256 of a file uploaded with upload_sha256 set."""
+        self.site_checksum(path, 'sha256')
+
+    def ftp_DELE(self, path):
+        if self.worker_pool is None:
+            return super(FaetusFTPHandler, self).ftp_DELE(path)
+        self.defer(self.fs.remove, (path,), lambda result:
+            self.respond("250 File removed."))
+
+    def ftp_RNFR(self, path):
+        if self.worker_pool is None or \
+           self.fs.realpath(path) == self.fs.realpath(self.fs.root):
+            return super(FaetusFTPHandler, self).ftp_RNFR(path)
+
+        def reply(exists):
+            if not exists:
+                self.respond("550 No such file or directory.")
+            else:
+                self._rnfr = path
+                self.respond("350 Ready for destination name.")
+
+        self.defer(self.fs.lexists, (path,), reply)
+
+    def ftp_RNTO(self, path):
+        if self.worker_pool is None or not self._rnfr:
+            return super(FaetusFTPHandler, self).ftp_RNTO(path)
+        src = self._rnfr
+        self._rnfr = None
+        self.defer(self.fs.rename, (src, path), lambda result:
+            self.respond("250 Renaming ok."))
+
+
+class FaetusS3Connection(S3Connection):
+    '''S3Connection which keeps at most max_pooled_sockets idle keep-alive
+ HTTP connections in its pool, and really closes them on close().
+
+ Only the idle sockets are capped, as a request gives its socket back to
+ the pool: those in use (each streaming RETR holds one) are not counted,
+ and an account serving many sessions at once may have more open.
+    '''
+    max_pooled_sockets = 8
+    # faetus.throttle.Throttle of the FTP user, if its requests are limited.
+    throttle = None
+
+    def make_request(self, method, bucket='', key='', headers=None, data='',
+                     query_args=None, sender=None, override_num_retries=None,
+                     retry_handler=None):
+        # Every S3 call boto makes goes through here.
+        if self.throttle is not None:
+            self.throttle.request()
+        operation = s3_operation(method, bucket, key, headers, query_args)
+        start = time.time()
+        status = None
+        try:
+            response = super(FaetusS3Connection, self).make_request(
+                method, bucket, key, headers, data, query_args, sender,
+                override_num_retries=override_num_retries, retry_handler=retry_handler)
+            status = response.status
+            return response
+        finally:
+            metrics.s3_request(operation, time.time() - start, status)
+
+    def _is_idle(self, http_connection):
+        # Same check boto's pool does: a response still attached to the
+        # connection is being streamed (e.g. a RETR) and must not be cut.
+        response = getattr(http_connection, '_HTTPConnection__response', None)
+        return response is None or response.isclosed()
+
+    def put_http_connection(self, host, port, is_secure, connection):
+        if self._pool.size() >= self.max_pooled_sockets and self._is_idle(connection):
+            connection.close()
+            return
+        super(FaetusS3Connection, self).put_http_connection(host, port, is_secure, connection)
+
+    def close(self):
+        pool = self._pool
+        pool.mutex.acquire()
+        try:
+            for host_pool in pool.host_to_pool.values():
+                for http_connection, _ in host_pool.queue:
+                    if self._is_idle(http_connection):
+                        http_connection.close()
+            pool.host_to_pool.clear()
+        finally:
+            pool.mutex.release()
+        super(FaetusS3Connection, self).close()
+
+
+class FaetusS3Account(object):
+    '''What the sessions logged in with the same S3 credentials share: the
+ S3 connection and the cache of bucket/key metadata.
+    '''
+
+    def __init__(self, connection, cache):
+        self.connection = connection
+        self.cache = cache
+        self.sessions = 0
+        self.last_used = 0
+
+    def close(self):
+        self.connection.close()
+        self.cache.clear()
+
+
+class FaetusConnectionRegistry(object):
+    '''Shares one S3 connection (and so its pool of warm HTTP keep-alive
+ connections) and one metadata cache between all the sessions logged in
+ with the same S3 credentials. Accounts no session has used for
+ idle_timeout seconds are closed, and at most max_connections unused ones
+ are kept around.
+
+ When limits are enforced, the S3 requests of a connection count against
+ the Throttle of one FTP user: FTP users sharing S3 credentials then get
+ an account each.
+    '''
+    connection_class = FaetusS3Connection
+    idle_timeout = 300
+    max_connections = 64
+    # Metadata cache settings, see faetus.cache.MetadataCache.
+    cache_ttl = 30
+    cache_size = 10000
 
-class FaetusOperations(object):
-    """Storing connection object."""
     def __init__(self):
-        self.connection = None
-        self.username = None
-        
-    def authenticate(self, username, password):
-        ''       
-        self.username = username
-        self.connection = S3Connection(username, password)
+        self.lock = threading.Lock()
+        # (aws_access_key_id, aws_secret_access_key, throttle) -> FaetusS3Account
+        self.entries = {}
+
+    def acquire(self, username, password, throttle=None):
+        '''Return the account for these credentials (and Throttle), creating
+        it if needed. Every acquire() must be paired with a release().'''
+        key = (username, password, throttle)
+        self.lock.acquire()
+        try:
+            account = self.entries.get(key)
+            if account is None:
+                account = FaetusS3Account(self.connection_class(username, password),
+                                          MetadataCache(self.cache_ttl, self.cache_size))
+                account.connection.throttle = throttle
+                self.entries[key] = account
+            account.sessions += 1
+            account.last_used = time.time()
+            self.evict()
+            return account
+        finally:
+            self.lock.release()
+
+    def release(self, username, password, throttle=None):
+        self.lock.acquire()
+        try:
+            account = self.entries.get((username, password, throttle))
+            if account is not None:
+                account.sessions -= 1
+                account.last_used = time.time()
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        '''Close unused accounts: idle ones, then the least recently used
+        ones beyond max_connections. Call with the lock held.'''
+        now = time.time()
+        unused = [(account.last_used, key) for key, account in self.entries.items()
+                  if account.sessions <= 0]
+        unused.sort()
+        excess = len(self.entries) - self.max_connections
+        for last_used, key in unused:
+            if last_used + self.idle_timeout < now or excess > 0:
+                self.entries.pop(key).close()
+                excess -= 1
+
+    def clear(self):
+        '''Forget all accounts (e.g. in a freshly forked process).'''
+        self.lock.acquire()
+        try:
+            for account in self.entries.values():
+                account.close()
+            self.entries.clear()
+        finally:
+            self.lock.release()
 
-    
-    def __repr__(self):
-        return self.connection
-    
-operations = FaetusOperations()
+connections = FaetusConnectionRegistry()
 
 
 class FaetusAuthorizer(ftpserver.DummyAuthorizer):
@@ -70,41 +776,48 @@ class FaetusAuthorizer(ftpserver.DummyAuthorizer):
  Note that due to the nature of S3, AWS_ACCESS_KEY_ID *cannot* be kept secret,
  even if a username_transform_map is defined. A user who knows an FTP user name
  and password can easily recover the AWS_ACCESS_KEY_ID (but not the AWS_SECRET_ACCESS_KEY)
+ user_limits is of the form {username : (bytes_per_second, s3_requests_per_second)},
+ either being None for the server's default user limit, 0 for no limit.
     '''
     users = {}
     
-    def __init__(self, allowed_users=None, username_transform_map=None,  password_transform_map=None):
+    def __init__(self, allowed_users=None, username_transform_map=None,  password_transform_map=None,
+                 user_limits=None):
         super(FaetusAuthorizer, self).__init__()
         self.username_transform_map = username_transform_map or {}
         self.password_transform_map = password_transform_map or {}
+        self.user_limits = user_limits or {}
         self.allowed_users = allowed_users
         if self.allowed_users == []:
           ftpserver.logwarn("Warning: allowed_users is empty. No users can log in!")
 
     def transform_username(self, username):
-        ftpserver.log("transforming username %s" % (username))
+        debug_log("transforming username %s", username)
         if (self.username_transform_map.has_key(username)):
             username = self.username_transform_map[username]
-        ftpserver.log("transformed username to %s" % (username))
+        debug_log("transformed username to %s", username)
         return username
             
     def transform_password(self, password):
         if (self.password_transform_map.has_key(password)):
             password = self.password_transform_map[password]
         return password
+
+    def get_limits(self, username):
+        '''(bytes_per_second, s3_requests_per_second) of the user.'''
+        return self.user_limits.get(username, (None, None))
     
     def validate_authentication(self, username, password):
         '''username: your amazon AWS_ACCESS_KEY_ID or a mapped username
         password: your amazon AWS_SECRET_ACCESS_KEY or a mapped password
         '''
+        # The S3 connection itself is taken from the registry by the
+        # FaetusFS created for the session.
         try:
             # Check for None, not false here. If the server
             # really wants to allow an empty list of allowed users, 
             # then allow no users.
             if (self.allowed_users is None) or (username in self.allowed_users):
-              s3_username = self.transform_username(username)
-              s3_password = self.transform_password(password)
-              operations.authenticate(s3_username, s3_password)
               return True
             else:
               return False
@@ -122,7 +835,7 @@ class FaetusAuthorizer(ftpserver.DummyAuthorizer):
         return 'lrdw'
 
     def get_home_dir(self, username):
-        ftpserver.log("get_home_dir(%s(" % (username))
+        debug_log("get_home_dir(%s)", username)
         return ftp_sep + self.transform_username(username)
 
     def get_msg_login(self, username):
@@ -133,100 +846,590 @@ class FaetusAuthorizer(ftpserver.DummyAuthorizer):
 
 
 class FaetusFD(object):
+    '''File-like object reading an S3 key for RETR, or writing one for STOR,
+ through the connection of the FaetusFS (session) that opened it.
+    '''
 
-    def __init__(self, username, bucket, obj, mode):
+    # Size of the parts sent to S3 while a STOR is still being received.
+    # 0 disables multipart uploads: the data is spooled and sent with a
+    # single PUT on close().
+    # S3 refuses parts smaller than 5 MB (except for the last one).
+    multipart_chunk_size = 0
+
+    # Number of parts of a multipart upload sent at once, at most
+    # upload_buffer_size bytes of parts waiting to be sent (see
+    # faetus.upload.ParallelPartUploader). 0 or 1: one part after the other.
+    upload_concurrency = 0
+    upload_buffer_size = 64 * 1024 * 1024
+
+    # Without multipart uploads: uploads of up to spool_memory_size bytes
+    # are spooled in memory, as long as all of them together fit in
+    # spool_budget (faetus.spool.MemoryBudget); the others go to a
+    # temporary file.
+    spool_memory_size = 1024 * 1024
+    spool_budget = MemoryBudget(64 * 1024 * 1024)
+
+    # faetus.diskcache.DiskCache keeping local copies of the keys downloaded,
+    # served again (after checking with S3 they did not change) instead of
+    # being downloaded again. None: no cache.
+    disk_cache = None
+
+    # RETR of keys larger than download_range_size: number of ranges of that
+    # size downloaded at once, at most download_buffer_size bytes being
+    # buffered ahead (see faetus.download.ParallelRangeReader).
+    # 0 or 1 disables parallel downloads: the key is read from a single GET.
+    download_concurrency = 0
+    download_range_size = 8 * 1024 * 1024
+    download_buffer_size = 64 * 1024 * 1024
+
+    # Whether uploads also get their SHA-256 computed, and recorded on S3
+    # as the sha256 metadata for SITE SHA256 (single PUTs only: the metadata
+    # of a multipart upload is sent before its data).
+    upload_sha256 = False
+
+    # faetus.writebehind.UploadQueue: a STOR completes once its data is on
+    # the local disk, and is sent to S3 in the background (in parts of the
+    # queue's part_size, not multipart_chunk_size). None: once S3 has it.
+    upload_queue = None
+
+    def __init__(self, fs, username, bucket, obj, mode):
+        self.fs = fs
+        self.connection = fs.connection
         self.username = username
         self.bucket = bucket
         self.name = obj
         self.mode = mode
         self.closed = False
         self.total_size = 0
-        self.temp_file_path = None
-        self.temp_file = None
-        ftpserver.log("Creating FaetusFD(%s,%s,%s,%s)" %(username, bucket, obj, mode))
+        self.spool = None
+        self.pending = None
+        self.multipart = None
+        self.part_buffer = None
+        self.part_num = 0
+        self.uploader = None
+        # Called (from any thread) when ready() may have become true.
+        self.on_ready = None
+        self.size = 0
+        self.etag = None
+        self.eof = False
+        self.offset = 0
+        self.reader = None
+        self.started = False
+        self.cache_file = None
+        self.cache_writer = None
+        # Uploads: hashed as they are written, so that boto does not read
+        # the data again to compute the Content-MD5 of the PUT or parts.
+        self.md5 = None
+        self.part_md5 = None
+        self.part_md5s = []
+        self.sha256 = None
+        debug_log("Creating FaetusFD(%s,%s,%s,%s)", username, bucket, obj, mode)
         
         if not all([username, bucket, obj]):
             self.closed = True
             raise IOError(1, 'Operation not permitted')
 
         try:
-            self.bucket = operations.connection.get_bucket(self.bucket)
-        except:
+            self.bucket = fs.get_bucket(self.bucket)
+            exists = self.bucket is not None
+            if exists and 'r' in self.mode and self.upload_queue is not None:
+                # A key still being uploaded is read from its local copy.
+                pending = self.upload_queue.open(fs.username, self.bucket.name, self.name)
+                if pending is not None:
+                    self.cache_file, self.size, self.etag = pending
+                    self.started = True
+            if exists and 'r' in self.mode and self.cache_file is None:
+                key = fs.get_key(self.bucket.name, self.name)
+                exists = key is not None
+                if exists:
+                    self.size = key.size
+                    self.etag = key.etag
+        except S3ResponseError:
+            exists = False
+        if not exists:
+            self.closed = True
             raise IOError(2, 'No such file or directory')
 
-        if 'r' in self.mode:
-            try:
-                self.obj = self.bucket.get_key(self.name)
-            except:
-                raise IOError(2, 'No such file or directory')
-        else: #write
-            self.obj = self.bucket.get_key(self.name)
-            if not self.obj:
-                # key does not exist, create it
-                self.obj = self.bucket.new_key(self.name)
-            # create a temporary file
-            self.temp_file_path = tempfile.mkstemp()[1]
-            self.temp_file = open(self.temp_file_path, 'w')
+        # Always a fresh Key: the cached ones are shared with other
+        # sessions, and reading one keeps the HTTP response in it.
+        # For writing, it does not matter whether the key already exists.
+        self.obj = self.bucket.new_key(self.name)
+        if 'r' not in self.mode:
+            self.md5 = hashlib.md5()
+            self.part_md5 = hashlib.md5()
+            if self.upload_sha256:
+                self.sha256 = hashlib.sha256()
+            if self.upload_queue is not None:
+                self.pending = self.upload_queue.new()
+            elif self.multipart_chunk_size:
+                self.part_buffer = StringIO()
+            else:
+                self.spool = SpooledUpload(self.spool_budget, self.spool_memory_size)
 
     def write(self, data):
         if 'r' in self.mode:
             raise OSError(1, 'Operation not permitted')
-        self.temp_file.write(data)
-        
+        self.total_size += len(data)
+        self.md5.update(data)
+        if self.sha256 is not None:
+            self.sha256.update(data)
+        if self.pending is not None:
+            self.pending.write(data)
+        elif self.part_buffer is not None:
+            self.part_md5.update(data)
+            self.part_buffer.write(data)
+            if self.part_buffer.tell() >= self.multipart_chunk_size:
+                self.upload_part()
+        else:
+            self.spool.write(data)
+
+    def upload_part(self):
+        '''Send the buffered data to S3 as the next part of a multipart upload,
+        starting the upload on the first part.'''
+        if self.multipart is None:
+            self.multipart = self.bucket.initiate_multipart_upload(self.name)
+            if self.upload_concurrency > 1:
+                self.uploader = ParallelPartUploader(self.multipart,
+                                                     self.multipart_chunk_size,
+                                                     self.upload_concurrency,
+                                                     self.upload_buffer_size)
+                self.uploader.on_ready = self.on_ready
+        self.part_num += 1
+        digest = self.part_md5.digest()
+        self.part_md5s.append(digest)
+        md5 = self.obj.get_md5_from_hexdigest(digest.encode('hex'))
+        if self.uploader is not None:
+            self.uploader.submit(self.part_num, self.part_buffer.getvalue(), md5)
+        else:
+            self.part_buffer.seek(0)
+            self.multipart.upload_part_from_file(self.part_buffer, self.part_num, md5=md5)
+        self.part_buffer = StringIO()
+        self.part_md5 = hashlib.md5()
+
+    def ready(self):
+        '''Whether write() can take another part without waiting for the
+        parts being uploaded.'''
+        return self.uploader is None or self.uploader.ready()
+
+    def abort(self):
+        '''Called by the data channel when the transfer did not complete.'''
+        self.closed = True
+        if self.part_buffer is None:
+            # Spooled mode: keep uploading what we got, as before.
+            try:
+                self.commit()
+            except IOError:
+                pass
+            return
+        self.part_buffer = None
+        if self.uploader is not None:
+            self.uploader.close()
+            self.uploader = None
+        if self.multipart is not None:
+            ftpserver.log("Cancelling multipart upload of %s after %d parts" \
+                          % (self.name, self.part_num))
+            try:
+                self.multipart.cancel_upload()
+            except S3ResponseError, e:
+                ftpserver.logerror("Could not cancel multipart upload of %s: %s" \
+                                   % (self.name, e))
+            self.multipart = None
+
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.commit()
+        except IOError:
+            # Already logged. The client got its 226 before we got here.
+            pass
+
+    @metrics.timed('commit')
+    def commit(self):
+        '''Finish the transfer: drop the GET (RETR), or send the data to S3
+        (STOR), raising IOError if that fails. Called by close(), or directly
+        by the data channel once it has set closed.'''
         if 'r' in self.mode:
+            # Drop the GET without draining whatever the client did not
+            # fetch (e.g. ABOR); a fully read key has already been closed.
+            if self.reader is not None:
+                self.reader.close()
+            if self.cache_file is not None:
+                self.cache_file.close()
+            writer, self.cache_writer = self.cache_writer, None
+            if writer is not None:
+                # Not read to the end.
+                writer.discard()
+            self.obj.close(fast=True)
+            return
+        if self.part_buffer is not None:
+            self.close_multipart()
+            return
+        if self.pending is not None:
+            self.queue_upload()
+            return
+        if self.spool is None:
+            # Already committed (abort() after close()).
             return
-        self.temp_file.close()
         try: 
-            self.obj.set_contents_from_filename(self.temp_file_path)
+            self.set_checksum_metadata()
+            # boto checks the ETag S3 returns against the MD5.
+            self.obj.set_contents_from_file(self.spool.open(), md5=self.get_md5())
+        except S3DataError, e:
+            ftpserver.logerror("Could not upload %s: %s" % (self.name, e))
+            raise IOError(5, 'S3 upload failed')
         except S3ResponseError, e:
             # Avoid crashing when the "directory" vanished while we were processing it.
             # This is actually due to a server error. It seems to happen after
             # a "rm file" command incorrectly deletes an entire directory. (!!!)
-            ftpserver.logerror("Directory vanished! could not set contents from file %s " % (self.temp_file_path))
-            return
+            ftpserver.logerror("Directory vanished! could not upload %s: %s" % (self.name, e))
+            raise IOError(5, 'S3 upload failed')
+        finally:
+            self.spool.close()
+            self.spool = None
 
         self.obj.close()
-        
-        # clean up the temporary file
-        os.remove(self.temp_file_path)
-        self.temp_file_path = None
-        self.temp_file = None
+        self.fs.key_written(self.bucket.name, self.name, self.total_size, self.obj.etag)
        
+    def queue_upload(self):
+        pending, self.pending = self.pending, None
+        md5 = self.md5.hexdigest()
+        try:
+            self.upload_queue.submit(pending, self.fs.username, self.bucket.name, self.name,
+                                     md5, self.sha256 and self.sha256.hexdigest())
+        except EnvironmentError, e:
+            ftpserver.logerror("Could not queue the upload of %s: %s" % (self.name, e))
+            self.upload_queue.discard(pending)
+            raise IOError(5, 'Could not queue the upload')
+        self.fs.key_written(self.bucket.name, self.name, self.total_size, '"%s"' % md5)
+
+    def close_multipart(self):
+        try:
+            if self.multipart is None:
+                # Everything fitted in a single part: plain PUT.
+                self.part_buffer.seek(0)
+                self.set_checksum_metadata()
+                self.obj.set_contents_from_file(self.part_buffer, md5=self.get_md5())
+                etag = self.obj.etag
+            else:
+                if self.part_buffer.tell():
+                    self.upload_part()
+                if self.uploader is not None:
+                    etag = self.complete_parts(self.uploader.finish())
+                else:
+                    etag = self.multipart.complete_upload().etag
+                self.check_multipart_etag(etag)
+            self.fs.key_written(self.bucket.name, self.name, self.total_size, etag)
+        except (S3ResponseError, S3DataError, IOError), e:
+            ftpserver.logerror("Could not upload %s: %s" % (self.name, e))
+            if self.uploader is not None:
+                self.uploader.close()
+            if self.multipart is not None:
+                try:
+                    self.multipart.cancel_upload()
+                except S3ResponseError:
+                    pass
+            raise IOError(5, 'S3 upload failed')
+        finally:
+            self.part_buffer = None
+            self.multipart = None
+            self.uploader = None
+
+    def complete_parts(self, parts):
+        '''Complete the multipart upload from the [(part number, etag)] we
+        kept, rather than listing the parts back from S3.'''
+        xml = ['<CompleteMultipartUpload>']
+        for part_num, etag in parts:
+            xml.append('<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' \
+                       % (part_num, etag))
+        xml.append('</CompleteMultipartUpload>')
+        return self.bucket.complete_multipart_upload(self.name, self.multipart.id,
+                                                     ''.join(xml)).etag
+
+    def get_md5(self):
+        '''The MD5 of what was written, as boto takes it.'''
+        return self.obj.get_md5_from_hexdigest(self.md5.hexdigest())
+
+    def set_checksum_metadata(self):
+        if self.sha256 is not None:
+            self.obj.set_metadata('sha256', self.sha256.hexdigest())
+
+    def check_multipart_etag(self, etag):
+        '''S3 gives a multipart upload the MD5 of the MD5s of its parts, with
+        their count: check it is that of the parts we sent.'''
+        expected = '"%s-%d"' % (hashlib.md5(''.join(self.part_md5s)).hexdigest(),
+                                len(self.part_md5s))
+        if etag is not None and etag != expected:
+            raise S3DataError('ETag %s of the completed upload is not %s' % (etag, expected))
+        ftpserver.log("Uploaded %s, MD5 %s" % (self.name, self.md5.hexdigest()))
+
     def read(self, size=65536):
-        return self.obj.read()
+        # Stream the object straight off the S3 response, never more than
+        # `size` bytes at a time, so memory per transfer stays constant.
+        # Key.read(0) would slurp the whole object: guard against it.
+        if not size or size < 0:
+            size = 65536
+        if self.closed or self.eof:
+            # A read-ahead finishing after ABOR must not start a new GET.
+            return ''
+        if not self.started:
+            self.start_read()
+            if self.eof:
+                # The key shrank below offset since it was cached.
+                return ''
+        if self.cache_file is not None:
+            return self.cache_file.read(size)
+        if self.reader is not None:
+            data = self.reader.read(size)
+        else:
+            data = self.obj.read(size)
+        if self.cache_writer is not None:
+            self.fill_cache(data)
+        return data
+
+    def start_read(self):
+        '''First read(): serve the key from the disk cache if S3 confirms it
+        did not change, else start downloading it from offset, filling the
+        disk cache on the way when downloading it all.'''
+        self.started = True
+        if self.disk_cache is not None and self.obj.resp is None:
+            path = self.disk_cache.get(self.bucket.name, self.name, self.etag)
+            if path is not None and self.revalidate():
+                try:
+                    self.cache_file = open(path, 'rb')
+                    self.cache_file.seek(self.offset)
+                    return
+                except IOError:
+                    # Evicted in the meantime.
+                    self.cache_file = None
+            if not self.offset:
+                self.cache_writer = self.disk_cache.writer(self.bucket.name, self.name,
+                                                           self.etag, self.size)
+        if self.parallel_download():
+            self.reader = ParallelRangeReader(self.bucket, self.name, self.etag,
+                                              self.size, self.offset,
+                                              self.download_concurrency,
+                                              self.download_range_size,
+                                              self.download_buffer_size)
+        elif self.offset and self.obj.resp is None:
+            self.open_range()
+
+    def revalidate(self):
+        '''Whether the key is still at the etag we have a cached copy of,
+        with a conditional GET: S3 answers 304 Not Modified without a body
+        if so, else sends the new content.'''
+        key = self.bucket.new_key(self.name)
+        try:
+            key.open_read(headers={'If-None-Match': self.etag})
+        except S3ResponseError, e:
+            if e.status != 304:
+                ftpserver.logerror("Could not revalidate %s: %s" % (self.name, e))
+            return e.status == 304
+        ftpserver.log("%s changed since it was cached" % self.name)
+        self.disk_cache.remove(self.bucket.name, self.name, self.etag)
+        self.fs.cache.invalidate((self.bucket.name, self.name))
+        self.etag = key.etag
+        self.size = key.size
+        self.eof = self.offset >= self.size
+        if self.offset or self.parallel_download():
+            key.close(fast=True)
+        else:
+            # The response is the whole new content: download from it.
+            self.obj = key
+        return False
 
-    def seek(self, *kargs, **kwargs):
-        raise IOError(1, 'Operation not permitted')
+    def fill_cache(self, data):
+        # commit() may drop the writer meanwhile, from another thread.
+        writer = self.cache_writer
+        if writer is None:
+            return
+        try:
+            if data:
+                writer.write(data)
+            else:
+                self.cache_writer = None
+                writer.commit()
+        except EnvironmentError, e:
+            # A full disk must not fail the download.
+            ftpserver.logerror("Could not cache %s: %s" % (self.name, e))
+            self.cache_writer = None
+            writer.discard()
+
+    def parallel_download(self):
+        return 'r' in self.mode and self.download_concurrency > 1 and \
+            self.size > self.download_range_size
+
+    def seek(self, offset, whence=0):
+        '''REST for RETR: restart the GET at offset, with a Range request, so
+        that only the rest of the key is downloaded. Uploads cannot be
+        resumed: S3 keys cannot be written in place.'''
+        if 'r' not in self.mode or '+' in self.mode or whence != 0:
+            raise IOError(1, 'Operation not permitted')
+        if offset < 0:
+            raise IOError(22, 'Invalid argument')
+        self.obj.close(fast=True)
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        # S3 answers 416 to a Range starting at the end of the key.
+        self.eof = offset >= self.size
+        self.offset = offset
+        if self.cache_file is not None:
+            # The local copy of a write-behind upload.
+            self.cache_file.seek(offset)
+            return
+        if self.parallel_download() or (self.disk_cache is not None and \
+           self.disk_cache.get(self.bucket.name, self.name, self.etag) is not None):
+            # The ranges are requested (or the cached copy read) from
+            # offset on the first read().
+            return
+        if offset and not self.eof:
+            self.open_range()
+
+    def open_range(self):
+        try:
+            self.obj.open_read(headers={'Range': 'bytes=%d-' % self.offset})
+        except S3ResponseError, e:
+            ftpserver.logerror("Could not resume %s at %d: %s" % (self.name, self.offset, e))
+            raise IOError(5, 'Input/output error')
 
 
 class FaetusFS(ftpserver.AbstractedFS):
     '''Amazon S3 File system emulation for FTP server.
     '''
 
-    # MAX  #objects to display in a bucket, to avoid getting swamped
-    # FIXME: implement "virtual directory" support, for keys with '/' in name.
-    MAX_OBJECTS = 1000
-                
-    def __init__(self, root, cmd_channel): super(FaetusFS, self).__init__(root, cmd_channel)
+    # Keys are renamed by copying them within S3, in parts of copy_part_size
+    # bytes for those larger than the copy_size_limit of a single copy.
+    # The keys of a virtual directory are copied by rename_concurrency threads.
+    copy_size_limit = 5 * 1024 * 1024 * 1024
+    copy_part_size = 512 * 1024 * 1024
+    rename_concurrency = 8
+
+    # Whether RMD deletes non-empty buckets and virtual directories (as
+    # SITE RMTREE always does), with delete_concurrency requests at once.
+    recursive_rmdir = False
+    delete_concurrency = 4
+
+    # faetus.index.KeyIndex serving the listings and the stat() of the keys
+    # from a local copy of the key list of the buckets. None: from S3.
+    key_index = None
+
+    def __init__(self, root, cmd_channel):
+        super(FaetusFS, self).__init__(root, cmd_channel)
+        authorizer = cmd_channel.authorizer
+        self.username = authorizer.transform_username(cmd_channel.username)
+        self.credentials = (self.username,
+                            authorizer.transform_password(cmd_channel.password))
+        self.throttle = None
+        scheduler = getattr(cmd_channel, 'scheduler', None)
+        if scheduler is not None:
+            self.throttle = scheduler.throttle(cmd_channel.username,
+                                               *authorizer.get_limits(cmd_channel.username))
+        account = connections.acquire(self.username, self.credentials[1], self.throttle)
+        self.connection = account.connection
+        self.cache = account.cache
+        if FaetusFD.upload_queue is not None:
+            FaetusFD.upload_queue.login(self.credentials)
+
+    def close(self):
+        '''Give the session's S3 account back to the registry.'''
+        if self.connection is not None:
+            self.connection = None
+            connections.release(self.username, self.credentials[1], self.throttle)
+
+    def get_bucket(self, bucket_name):
+        '''Return the Bucket, or None if there is no such bucket.
+        Served from the metadata cache when possible.'''
+        bucket = self.cache.get((bucket_name, None))
+        if bucket is MISSING:
+            try:
+                bucket = self.connection.get_bucket(bucket_name)
+            except S3ResponseError, e:
+                if e.status != 404:
+                    raise
+                bucket = None
+            self.cache.set((bucket_name, None), bucket)
+        return bucket
+
+    def get_key(self, bucket_name, key_name):
+        '''Return the Key (as returned by a HEAD request), or None if there
+        is no such key or bucket. Served from the metadata cache when possible.
+        A key still being uploaded (write-behind) is as it will be.'''
+        key = self.pending_key(bucket_name, key_name)
+        if key is not None:
+            return key
+        key = self.cache.get((bucket_name, key_name))
+        if key is MISSING:
+            bucket = self.get_bucket(bucket_name)
+            if bucket is None:
+                return None
+            key = bucket.get_key(key_name)
+            self.cache.set((bucket_name, key_name), key)
+        return key
+
+    def find_key(self, bucket_name, key_name):
+        """get_key(), from the key index when it covers the bucket: for
+        stat() and the like, not to open the key."""
+        if self.key_index is not None:
+            bucket = self.get_bucket(bucket_name)
+            if bucket is None:
+                return None
+            if self.key_index.covers(bucket):
+                return self.pending_key(bucket_name, key_name) or \
+                    self.key_index.get(bucket, key_name)
+        return self.get_key(bucket_name, key_name)
+
+    def pending_key(self, bucket_name, key_name):
+        """The Key a write-behind upload of key_name will give, if any."""
+        if FaetusFD.upload_queue is None:
+            return None
+        bucket = self.get_bucket(bucket_name)
+        if bucket is None:
+            return None
+        return FaetusFD.upload_queue.pending(self.username, bucket, key_name)
+
+    def settle(self, bucket_name, key_name=None, prefix=None, cancel=False):
+        """Wait until S3 has the keys of the write-behind uploads of key_name
+        (or of the keys under prefix), or drop them if cancel."""
+        if FaetusFD.upload_queue is None:
+            return
+        try:
+            FaetusFD.upload_queue.flush(self.username, bucket_name, key_name, prefix, cancel)
+        except IOError, e:
+            raise OSError(e.errno, e.strerror)
+
+    def key_written(self, bucket_name, key_name, size, etag):
+        """Record a key just written, of size bytes."""
+        self.cache.invalidate_key(bucket_name, key_name)
+        if self.key_index is not None:
+            self.key_index.put(bucket_name, key_name, size, etag)
+
+    def key_deleted(self, bucket_name, key_name):
+        """Record a key just deleted."""
+        self.cache.invalidate_key(bucket_name, key_name)
+        if self.key_index is not None:
+            self.key_index.remove(bucket_name, key_name)
 
     def get_all_buckets(self):
       try: 
-        return list(operations.connection.get_all_buckets())
+        return list(self.connection.get_all_buckets())
       except S3ResponseError, e:
         raise OSError(1, "S3 error (probably bad credentials)" + str(e))
 
     def create_bucket(self, bucket):
       try: 
-        return operations.connection.create_bucket(bucket)
+        created = self.connection.create_bucket(bucket)
       except (S3CreateError, S3ResponseError), e:
         raise OSError(1, "S3 error (probably bucket name conflict)" + str(e))
+      self.cache.set((bucket, None), created)
+      return created
 
     def parse_fspath(self, path):
         '''Returns a (username, site, filename) tuple. For shorter paths
         replaces not-provided values with empty strings.
         '''
-        ftpserver.log("parse_fspath(%s)" % (path))
+        debug_log("parse_fspath(%s)", path)
         if not path.startswith(ftp_sep):
             raise ValueError('parse_fspath: You have to provide a full path, not %s'  % path)
         parts = path.split(ftp_sep)[1:]
@@ -239,10 +1442,12 @@ class FaetusFS(ftpserver.AbstractedFS):
             parts.append('')
         return tuple(parts)
 
+    @metrics.timed('open')
     def open(self, filename, mode):
         username, bucket, obj = self.parse_fspath(filename)
-        return FaetusFD(username, bucket, obj, mode)
+        return FaetusFD(self, username, bucket, obj, mode)
 
+    @metrics.timed('chdir')
     def chdir(self, path):
         if path.startswith(self.root):
             _, bucket, obj = self.parse_fspath(path)
@@ -254,14 +1459,16 @@ class FaetusFS(ftpserver.AbstractedFS):
                     raise OSError(550, 'Failed to change directory: Path is not a dir: ' + path)
                 return
 
-            if not obj:
-                try:
-                    operations.connection.get_bucket(bucket)
+            try:
+                if (not obj and self.get_bucket(bucket) is not None) or \
+                   (obj and self.is_virtual_dir(bucket, obj)):
                     self._cwd = self.fs2ftp(path)
                     return
-                except S3ResponseError:
-                    raise OSError(550, 'Failed to change directory.')
-                    
+            except S3ResponseError:
+                raise OSError(550, 'Failed to change directory.')
+
+            if not obj:
+                raise OSError(550, 'Failed to change directory.')
             raise OSError(550, 'Path is not a dir: ' + obj)
 
         ftpserver.logerror('Cannot chdir outside of root (%s) to %s' % (self.root, path));
@@ -269,6 +1476,7 @@ class FaetusFS(ftpserver.AbstractedFS):
                       
 
 
+    @metrics.timed('mkdir')
     def mkdir(self, path):
         try:
             _, bucket, obj = self.parse_fspath(path)
@@ -279,72 +1487,119 @@ class FaetusFS(ftpserver.AbstractedFS):
 
         self.create_bucket(bucket)
                 
+    @metrics.timed('listdir')
     def listdir(self, path):
         """List the content of a directory, as a list of strings."""            
-
+        return [name for name, item in self.get_dir_entries(path)]
+
+    @metrics.timed('get_dir_entries')
+    def get_dir_entries(self, path, files=True):
+        """Return an iterator of (name, item) pairs for the content of the
+        directory at path, item being the boto Bucket, Key or Prefix
+        (virtual directory). If path is a key, it is the only entry, or
+        ENOTDIR is raised if files is false.
+
+        Since S3 does not have native directories, a bucket or virtual
+        directory can have arbitrarily many elements: list pages are only
+        fetched from S3 as the iterator is consumed. The first one is
+        fetched right away, though, so that errors are raised here.
+        """
         try:
             _, bucket_name, key_name = self.parse_fspath(path)
         except(ValueError):
             raise OSError(2, 'No such file or directory')
-        
-        if not bucket_name and not key_name:
-            buckets = self.get_all_buckets()
-            return map( (lambda bucket: asciify(bucket.name)), buckets)
 
-        if bucket_name and not key_name:
-            try:
-                bucket = operations.connection.get_bucket(bucket_name)
-                # BEWARE! Since S3 does not have native directories
-                # this bucket can have arbitrarily many elements.
-                # Do NOT convert it to a list!
-                # FIXME: implement conventional "virtual directory" support.
-                # List only the set of unique prefixes ("virtual directories")
-                # http://boto.s3.amazonaws.com/ref/s3.html
-                count = 0
-                objects_limited = []
-                for object in bucket.list(delimiter=cloud_sep):
-                    count = count + 1
-                    if count > self.MAX_OBJECTS:
-                        ftpserver.logerror("Too many items to list! Stopping at #%d" % MAX_OBJECTS)
-                        break
-                    objects_limited.append(object)
-                
-                return map( (lambda object: asciify(object.name)), objects_limited)
-            except:
-                raise OSError(2, 'No such file or directory')
+        if not bucket_name:
+            return iter([(asciify(bucket.name), bucket) for bucket in self.get_all_buckets()])
 
+        try:
+            bucket = self.get_bucket(bucket_name)
+            if bucket is None:
+                raise OSError(2, 'No such file or directory')
+            prefix = key_name and key_name.rstrip(cloud_sep) + cloud_sep
+            entries = self.iter_prefix(bucket, prefix)
+            try:
+                return itertools.chain([entries.next()], entries)
+            except StopIteration:
+                pass
+            if not key_name:
+                return iter([])
+            # Not a virtual directory: maybe a plain key.
+            key = self.find_key(bucket_name, key_name)
+            if key is not None and not files:
+                raise OSError(20, 'Not a directory')
+        except S3ResponseError, e:
+            ftpserver.logerror("Failed listing %s: %s" % (path, e))
+            raise OSError(2, 'No such file or directory')
+        if key is None:
+            raise OSError(2, 'No such file or directory')
+        return iter([(asciify(key_name.split(cloud_sep)[-1]), key)])
+
+    def iter_prefix(self, bucket, prefix):
+        """Yield (name, item) pairs for the keys and common prefixes (virtual
+        directories) right under prefix, names being relative to prefix.
+        Keys still being uploaded (write-behind) are as they will be."""
+        pending = {}
+        if FaetusFD.upload_queue is not None:
+            pending = FaetusFD.upload_queue.listing(self.username, bucket, prefix)
+        if self.key_index is not None and self.key_index.covers(bucket):
+            items = self.key_index.list(bucket, prefix)
+        else:
+            items = bucket.list(prefix=prefix, delimiter=cloud_sep)
+        # Key names come as unicode, prefix as UTF-8 bytes: sliced as bytes.
+        skip = len(asciify(prefix))
+        for item in items:
+            name = asciify(item.name)[skip:].rstrip(cloud_sep)
+            if not name: # Skip the "directory" placeholder key itself.
+                continue
+            other = pending.get(name)
+            if other is not None and isinstance(other, Prefix) == isinstance(item, Prefix):
+                if not isinstance(item, Prefix):
+                    # Listed with the pending uploads, below.
+                    continue
+                del pending[name]
+            yield name, item
+        for name, item in sorted(pending.items()):
+            yield name, item
+
+    def has_prefix(self, bucket, prefix):
+        """Whether any key starts with prefix, with a single one-key list."""
+        if self.key_index is not None and self.key_index.covers(bucket):
+            return self.key_index.has_prefix(bucket, prefix)
+        return len(bucket.get_all_keys(prefix=prefix, max_keys=1)) > 0
+
+    def is_virtual_dir(self, bucket_name, key_name):
+        """Whether keys are named after key_name (a virtual directory).
+        Served from the metadata cache when possible."""
+        prefix = key_name.rstrip(cloud_sep) + cloud_sep
+        if FaetusFD.upload_queue is not None and \
+           FaetusFD.upload_queue.has_prefix(self.username, bucket_name, prefix):
+            return True
+        exists = self.cache.get((bucket_name, None, prefix))
+        if exists is MISSING:
+            bucket = self.get_bucket(bucket_name)
+            exists = bucket is not None and self.has_prefix(bucket, prefix)
+            self.cache.set((bucket_name, None, prefix), exists)
+        return exists
     
     def get_list_dir(self, path):
         """"Return an iterator object that yields a directory listing
         in a form suitable for LIST command.
         """
-        try:
-            _, bucket, obj = self.parse_fspath(path)
-        except(ValueError):
-            raise OSError(2, 'No such file or directory')
-        
-        if not bucket and not obj:
-            buckets = self.get_all_buckets()
-            return self.format_list_buckets(buckets)
-
-        if bucket and not obj:
-            try:
-                objects = operations.connection.get_bucket().list(delimiter=cloud_sep)
-            except:
-                raise OSError(2, 'No such file or directory')
-            return self.format_list_objects(objects)
-
-        if bucket and obj:
-          # This is a key, which is not supported literally as a directory.
-          # Try interpreting as a hierarchical key:
-            try:
-                objects = operations.connection.get_bucket().list(prefix=obj, delimiter=cloud_sep)
-            except:
-                raise OSError(2, 'No such file or directory')
-            return self.format_list_objects(objects)
+        return self.format_list_objects(self.get_dir_entries(path))
 
+    def get_nlst_dir(self, path):
+        """Return an iterator object that yields a directory listing
+        in a form suitable for NLST command.
+        """
+        return ('%s\r\n' % name for name, item in self.get_dir_entries(path))
 
+    @metrics.timed('rmdir')
     def rmdir(self, path):
+        if self.recursive_rmdir:
+            self.delete_tree(path)
+            return
+
         _, bucket, name = self.parse_fspath(path)
 
         # If the user requests 'rmdir' of a file, refuse that.
@@ -354,41 +1609,246 @@ class FaetusFS(ftpserver.AbstractedFS):
             raise OSError(13, 'Operation not permitted')
 
         else:
+            bucket_name = bucket
             try:
-                bucket = operations.connection.get_bucket(bucket)
+                bucket = self.get_bucket(bucket_name)
             except:
+                bucket = None
+            if bucket is None:
                 raise OSError(2, 'No such file or directory')
+            # Not empty as long as uploads to it are pending.
+            self.settle(bucket_name, prefix='')
     
             try:
-                operations.connection.delete_bucket(bucket)
+                self.connection.delete_bucket(bucket)
             except:
                 raise OSError(39, "Directory not empty: '%s'" % bucket)
+            finally:
+                self.cache.invalidate_bucket(bucket_name)
+            if self.key_index is not None:
+                self.key_index.forget(bucket_name)
+
+    @metrics.timed('delete_tree')
+    def delete_tree(self, path):
+        """Delete a bucket or a virtual directory with every key under it.
+
+        The keys are listed page by page and deleted by multi-object delete
+        requests of up to 1000 keys, delete_concurrency of them at once.
+        Returns the number of keys deleted."""
+        _, bucket_name, key_name = self.parse_fspath(path)
+        if not bucket_name:
+            raise OSError(1, 'Operation not permitted')
+        prefix = key_name and key_name.rstrip(cloud_sep) + cloud_sep
+        deleted = []
+        self.settle(bucket_name, prefix=prefix, cancel=True)
 
+        def names(bucket):
+            for key in bucket.list(prefix=prefix):
+                deleted.append(None)
+                yield key.name
+
+        try:
+            bucket = self.get_bucket(bucket_name)
+            if bucket is None:
+                raise OSError(2, 'No such file or directory')
+            errors = parallel_map(lambda batch: self.delete_keys(bucket, batch),
+                                  chunked(names(bucket), 1000),
+                                  self.delete_concurrency)
+            if [error for error in errors if error is not None]:
+                raise OSError(5, 'Input/output error')
+            if not key_name:
+                self.connection.delete_bucket(bucket_name)
+            elif not deleted and self.find_key(bucket_name, key_name.rstrip(cloud_sep)):
+                raise OSError(20, 'Not a directory')
+            elif not deleted:
+                raise OSError(2, 'No such file or directory')
+        except S3ResponseError, e:
+            ftpserver.logerror("Failed deleting %s: %s" % (path, e))
+            raise OSError(5, 'Input/output error')
+        finally:
+            self.cache.invalidate_bucket(bucket_name)
+            if self.key_index is not None and not key_name:
+                self.key_index.forget(bucket_name)
+            elif self.key_index is not None and deleted:
+                # Maybe not all of them, if it failed: the next refresh
+                # finds those left.
+                self.key_index.remove_prefix(bucket_name, prefix)
+        return len(deleted)
+
+    @metrics.timed('remove')
     def remove(self, path):
         _, bucket, name = self.parse_fspath(path)
 
         if not name:
             raise OSError(13, 'Operation not permitted')
 
+        self.settle(bucket, name, cancel=True)
         try:
-            bucket = operations.connection.get_bucket(bucket)
-            bucket.delete_key(name)
+            self.get_bucket(bucket).delete_key(name)
         except:
+            self.cache.invalidate_key(bucket, name)
             raise OSError(2, 'No such file or directory')
+        self.key_deleted(bucket, name)
         return not name
 
+    @metrics.timed('checksum')
+    def checksum(self, path, algorithm):
+        """Return the hex digest of a key, 'md5' or 'sha256', from what S3
+        has recorded about it (a HEAD), without reading its content."""
+        _, bucket_name, key_name = self.parse_fspath(path)
+        if not key_name:
+            raise OSError(21, 'Is a directory')
+        try:
+            key = self.get_key(bucket_name, key_name)
+        except S3ResponseError:
+            raise OSError(2, 'No such file or directory')
+        if key is None:
+            raise OSError(2, 'No such file or directory')
+        digest = key.get_metadata(algorithm)
+        if digest is None and algorithm == 'md5':
+            # The ETag of a single PUT is the MD5 of the content, not that
+            # of a multipart upload ("<md5 of the parts' md5s>-<parts>").
+            etag = (key.etag or '').strip('"')
+            if etag and '-' not in etag:
+                digest = etag
+        if digest is None:
+            raise OSError(61, 'No %s recorded for this file' % algorithm.upper())
+        # boto gives the headers as unicode.
+        return str(digest)
+
+    @metrics.timed('rename')
     def rename(self, src, dst):
-        raise OSError(1, 'Operation not permitted')
+        """Rename a key, or a virtual directory with all the keys under it,
+        by copying within S3 then deleting the source: no data goes through
+        the FTP server. Buckets cannot be renamed."""
+        _, src_bucket, src_name = self.parse_fspath(src)
+        _, dst_bucket, dst_name = self.parse_fspath(dst)
+        if not (src_name and dst_name):
+            raise OSError(1, 'Operation not permitted')
+        src_name = src_name.rstrip(cloud_sep)
+        dst_name = dst_name.rstrip(cloud_sep)
+        if (src_bucket, src_name) == (dst_bucket, dst_name):
+            return
+
+        try:
+            if self.get_bucket(src_bucket) is None or self.get_bucket(dst_bucket) is None:
+                raise OSError(2, 'No such file or directory')
+            self.settle(src_bucket, src_name, src_name + cloud_sep)
+            self.settle(dst_bucket, dst_name, dst_name + cloud_sep, cancel=True)
+            key = self.get_key(src_bucket, src_name)
+            if key is not None:
+                etag = self.copy_key(key, dst_bucket, dst_name)
+                self.key_written(dst_bucket, dst_name, key.size, etag)
+                self.get_bucket(src_bucket).delete_key(src_name)
+                self.key_deleted(src_bucket, src_name)
+            else:
+                self.rename_prefix(src_bucket, src_name + cloud_sep,
+                                   dst_bucket, dst_name + cloud_sep)
+        except S3ResponseError, e:
+            ftpserver.logerror("Failed renaming %s to %s: %s" % (src, dst, e))
+            raise OSError(5, 'Input/output error')
+        finally:
+            self.cache.invalidate_key(src_bucket, src_name)
+            self.cache.invalidate_key(dst_bucket, dst_name)
+
+    def rename_prefix(self, src_bucket_name, src_prefix, dst_bucket_name, dst_prefix):
+        """Move every key under src_prefix to dst_prefix, copying them with
+        rename_concurrency threads. The keys are only deleted once they have
+        all been copied: if a copy fails, the copies are deleted instead."""
+        if src_bucket_name == dst_bucket_name and dst_prefix.startswith(src_prefix):
+            raise OSError(22, 'Invalid argument')
+        src_bucket = self.get_bucket(src_bucket_name)
+        keys = list(src_bucket.list(prefix=src_prefix))
+        if not keys:
+            raise OSError(2, 'No such file or directory')
+        # Key names come as unicode, the prefixes as UTF-8 bytes.
+        src_prefix, dst_prefix = asciify(src_prefix), asciify(dst_prefix)
+        new_names = [dst_prefix + asciify(key.name)[len(src_prefix):] for key in keys]
+        etags = {}
+
+        def copy((key, new_name)):
+            etags[new_name] = self.copy_key(key, dst_bucket_name, new_name)
+
+        errors = parallel_map(copy, zip(keys, new_names), self.rename_concurrency)
+        try:
+            failed = [error for error in errors if error is not None]
+            if failed:
+                self.delete_keys(self.get_bucket(dst_bucket_name),
+                                 [new_name for new_name, error in zip(new_names, errors)
+                                  if error is None])
+                raise failed[0]
+            self.delete_keys(src_bucket, [key.name for key in keys])
+            if self.key_index is not None:
+                for key, new_name in zip(keys, new_names):
+                    self.key_index.put(dst_bucket_name, new_name, key.size, etags[new_name])
+                self.key_index.remove_prefix(src_bucket_name, src_prefix)
+        finally:
+            self.cache.invalidate_bucket(src_bucket_name)
+            self.cache.invalidate_bucket(dst_bucket_name)
+
+    def copy_key(self, key, dst_bucket_name, dst_name):
+        """Copy key within S3, in parts if it is too large for a single copy.
+        Returns the ETag of the copy."""
+        dst_bucket = self.get_bucket(dst_bucket_name)
+        if key.size <= self.copy_size_limit:
+            return dst_bucket.copy_key(dst_name, key.bucket.name, key.name).etag
+        # Unlike a copy, a multipart upload does not take the metadata over.
+        key = key.bucket.get_key(key.name)
+        headers = {}
+        if key.content_type:
+            headers['Content-Type'] = key.content_type
+        multipart = dst_bucket.initiate_multipart_upload(dst_name, headers=headers,
+                                                         metadata=key.metadata)
+        # S3 allows up to 10000 parts.
+        part_size = max(self.copy_part_size, -(-key.size // 10000))
+        completed = False
+        try:
+            for part_num, start in enumerate(xrange(0, key.size, part_size)):
+                multipart.copy_part_from_key(key.bucket.name, key.name, part_num + 1,
+                                             start, min(start + part_size, key.size) - 1)
+            etag = multipart.complete_upload().etag
+            completed = True
+        finally:
+            if not completed:
+                try:
+                    multipart.cancel_upload()
+                except S3ResponseError:
+                    pass
+        return etag
+
+    def delete_keys(self, bucket, names):
+        """Delete keys with multi-object delete requests (1000 keys each),
+        raising OSError if any of them could not be deleted."""
+        if not names:
+            return
+        result = bucket.delete_keys(names, quiet=True)
+        if result.errors:
+            for error in result.errors[:10]:
+                ftpserver.logerror("Could not delete %s: %s" % (error.key, error.message))
+            raise OSError(5, 'Input/output error')
 
     def isfile(self, path):
-        return not self.isdir(path)
+        try:
+            _, bucket_name, key_name = self.parse_fspath(path)
+            return bool(key_name) and self.find_key(bucket_name, key_name) is not None
+        except (ValueError, S3ResponseError):
+            return False
 
     def islink(self, path):
         return False
 
     def isdir(self, path):
-        _, _, name = self.parse_fspath(path)
-        return not name
+        """The root, an existing bucket, or a virtual directory; a HEAD or a
+        one-key list at most."""
+        try:
+            _, bucket_name, key_name = self.parse_fspath(path)
+            if not bucket_name:
+                return True
+            if not key_name:
+                return self.get_bucket(bucket_name) is not None
+            return self.is_virtual_dir(bucket_name, key_name)
+        except (ValueError, S3ResponseError):
+            return False
 
     def getsize(self, path):
         return self.stat(path).st_size
@@ -399,6 +1859,7 @@ class FaetusFS(ftpserver.AbstractedFS):
     def realpath(self, path):
         return path
 
+    @metrics.timed('lexists')
     def lexists(self, path):
         try:
             _, bucket_name, key_name = self.parse_fspath(path)
@@ -408,19 +1869,20 @@ class FaetusFS(ftpserver.AbstractedFS):
         if not bucket_name and not key_name:
             return True # root
             
-        if bucket_name and not key_name:
-            try:
-                bucket = operations.connection.get_bucket(bucket_name)
-                objects = bucket.list()
-            except:
-                raise OSError(2, 'No such file or directory')
-            return obj in objects
-
-        if bucket_name and key_name:
-            bucket = operations.connection.get_bucket(bucket_name)
-            return not (not bucket.get_key(key_name))
+        try:
+            if bucket_name and not key_name:
+                return self.get_bucket(bucket_name) is not None
+
+            if bucket_name and key_name:
+                if self.find_key(bucket_name, key_name) is not None:
+                    return True
+                # Maybe a virtual directory.
+                return self.is_virtual_dir(bucket_name, key_name)
+        except S3ResponseError:
+            raise OSError(2, 'No such file or directory')
 
 
+    @metrics.timed('stat')
     def stat(self, path):
 
         st_mode = FULL_CONTROL_MODE_FLAG
@@ -429,7 +1891,7 @@ class FaetusFS(ftpserver.AbstractedFS):
         #Hack together a stat result
         
         st_size = 0
-        st_mtime = datetime.datetime(  *time.strptime("1970-01-01",  "%Y-%m-%d")[0:6])
+        st_mtime = 0
 
         try:
             if not key_name: # Bucket
@@ -437,20 +1899,20 @@ class FaetusFS(ftpserver.AbstractedFS):
                 st_mode = st_mode | DIR_MODE_FLAG
     
             else: # Key
-                bucket = operations.connection.get_bucket(bucket_name)
                 if (key_name[-1] == cloud_sep): # Virtual directory for hierarchical key.
                     st_mode = st_mode | DIR_MODE_FLAG
                 else:
-                    obj = bucket.get_key(key_name)
+                    obj = self.find_key(bucket_name, key_name)
                     # Workaround os.sep crap.
-                    if obj is None:
-                        obj = bucket.get_key(key_name.replace(cloud_sep, os.sep))
+                    if obj is None and os.sep != cloud_sep:
+                        obj = self.find_key(bucket_name, key_name.replace(cloud_sep, os.sep))
                     if obj is None:
                          ftpserver.logerror("Cannot find object for path %s , key %s in bucket %s " % (path, key_name, bucket_name))
                          raise OSError(2, 'No such file or directory')
                     st_size = obj.size
+                    st_mtime = s3_timestamp(obj.last_modified)
                    
-            return os.stat_result([st_mode, 0, 0, 0, 0, 0, st_size, 0, 0, 0])  #FIXME more stats (mtime)
+            return os.stat_result([st_mode, 0, 0, 0, 0, 0, st_size, 0, st_mtime, 0])
 
         
         except Exception,  e:
@@ -463,26 +1925,91 @@ class FaetusFS(ftpserver.AbstractedFS):
     def validpath(self, path):
         return True
 
-    def format_list_objects(self, items):
-        for item in items:
-            if item.name[-1] == cloud_sep:
-                dir_flag = 'd'
-            else:
-                dir_flag = '-'
-            ts = datetime.datetime(
-                *time.strptime(
-                    item.last_modified[:item.last_modified.find('.')],
-                    "%Y-%m-%dT%H:%M:%S")[0:6]).strftime("%b %d %H:%M")
-
-            yield '%srw------   1 %s   group  %8s %s %s\r\n' % \
-                (dir_flag, operations.username, item.size, ts, item.name)
-
-    def format_list_buckets(self, buckets):
-        for bucket in buckets:
-            name = asciify(bucket.name)
-            yield ('drwx------   1 %s   group  %8s Jan 01 00:00 %s\r\n' % \
-                   (operations.username, 0, name))
-            
+    def format_list_objects(self, entries):
+        """LIST lines of (name, item) pairs, several lines to each string
+        (see faetus.listing.ListFormatter)."""
+        return ListFormatter(self.username).format(entries)
 
     def get_stat_dir(self, *kargs, **kwargs):
         raise OSError(40, 'unsupported')
+
+    def get_mlsd_dir(self, path, perms, facts):
+        """Return an iterator object that yields a directory listing in a
+        form suitable for the MLSD command, from what S3 lists (no request
+        per entry), page by page as LIST does."""
+        return self.format_mlsx_entries(self.get_dir_entries(path, files=False), perms, facts)
+
+    def get_entry(self, path):
+        """Return (name, item) for a single path, as get_dir_entries()
+        gives them: item is a Bucket, Key or Prefix (the root, or a
+        virtual directory)."""
+        try:
+            _, bucket_name, key_name = self.parse_fspath(path)
+        except(ValueError):
+            raise OSError(2, 'No such file or directory')
+        name = asciify(path.rstrip(ftp_sep).split(ftp_sep)[-1])
+        try:
+            if not bucket_name:
+                return name, Prefix(name=cloud_sep)
+            if not key_name:
+                item = self.get_bucket(bucket_name)
+            else:
+                item = self.find_key(bucket_name, key_name)
+                if item is None and self.is_virtual_dir(bucket_name, key_name):
+                    item = Prefix(name=key_name.rstrip(cloud_sep) + cloud_sep)
+        except S3ResponseError:
+            raise OSError(2, 'No such file or directory')
+        if item is None:
+            raise OSError(2, 'No such file or directory')
+        return name, item
+
+    def format_mlsx(self, basedir, listing, perms, facts, ignore_err=True):
+        """MLST (and MLSD, for pyftpdlib's own ftp_MLSD) from one HEAD
+        per entry rather than a stat() of each."""
+        entries = []
+        for basename in listing:
+            try:
+                entries.append(self.get_entry(os.path.join(basedir, basename)))
+            except OSError:
+                if not ignore_err:
+                    raise
+        return self.format_mlsx_entries(entries, perms, facts)
+
+    def format_mlsx_entries(self, entries, perms, facts):
+        """Yield the MLSD/MLST lines of (name, item) pairs, with the facts
+        of RFC 3659 S3 has: the size and date of the keys, their ETag as
+        unique id."""
+        if self.cmd_channel.use_gmt_times:
+            timefunc = time.gmtime
+        else:
+            timefunc = time.localtime
+        # As pyftpdlib's AbstractedFS.format_mlsx() does.
+        permdir = ''.join([x for x in perms if x not in 'arw'])
+        permfile = ''.join([x for x in perms if x not in 'celmp'])
+        if ('w' in perms) or ('a' in perms) or ('f' in perms):
+            permdir += 'c'
+        if 'd' in perms:
+            permdir += 'p'
+        for name, item in entries:
+            is_dir = isinstance(item, (Bucket, Prefix)) or item.name.endswith(cloud_sep)
+            line = []
+            if 'type' in facts:
+                line.append(is_dir and 'type=dir;' or 'type=file;')
+            if 'size' in facts:
+                line.append('size=%s;' % (not is_dir and item.size or 0))
+            if 'perm' in facts:
+                line.append('perm=%s;' % (is_dir and permdir or permfile))
+            if 'modify' in facts:
+                last_modified = getattr(item, 'last_modified', None) or \
+                    getattr(item, 'creation_date', None)
+                if timefunc is time.gmtime:
+                    modify = modify_fact(last_modified)
+                else:
+                    mtime = s3_timestamp(last_modified)
+                    modify = mtime and time.strftime("%Y%m%d%H%M%S", timefunc(mtime))
+                if modify:
+                    line.append('modify=%s;' % modify)
+            if 'unique' in facts and not is_dir and item.etag:
+                # boto gives the listed values as unicode.
+                line.append('unique=%s;' % str(item.etag).strip('"'))
+            yield '%s %s\r\n' % (''.join(line), name)
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import threading
+from cStringIO import StringIO
+
+from pyftpdlib import ftpserver
+
+
+class MemoryBudget(object):
+    '''Bytes of upload data all the sessions of a process may keep in
+ memory at once. Shared by the SpooledUploads.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        '''Take amount bytes from the budget, if there is that much left.'''
+        self.lock.acquire()
+        try:
+            if self.used + amount > self.size:
+                return False
+            self.used += amount
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self, amount):
+        self.lock.acquire()
+        self.used -= amount
+        self.lock.release()
+
+
+class SpooledUpload(object):
+    '''The data of an upload, kept in memory while it is no larger than
+ max_memory bytes and the budget has room for it, else written to a
+ temporary file (all of it, from then on).
+    '''
+
+    def __init__(self, budget, max_memory):
+        self.budget = budget
+        self.max_memory = max_memory
+        self.buffer = StringIO()
+        # Bytes of the buffer taken from the budget.
+        self.reserved = 0
+        self.file = None
+        self.path = None
+        self.size = 0
+
+    def write(self, data):
+        if self.file is None:
+            if self.size + len(data) <= self.max_memory and \
+               self.budget is not None and self.budget.reserve(len(data)):
+                self.reserved += len(data)
+                self.buffer.write(data)
+                self.size += len(data)
+                return
+            self.spill()
+        self.file.write(data)
+        self.size += len(data)
+
+    def spill(self):
+        fd, self.path = tempfile.mkstemp()
+        self.file = os.fdopen(fd, 'w+b')
+        self.file.write(self.buffer.getvalue())
+        self.buffer = None
+        self.release()
+
+    def release(self):
+        if self.reserved:
+            self.budget.release(self.reserved)
+            self.reserved = 0
+
+    def open(self):
+        '''Return a file-like object with all the data, at its start.'''
+        if self.file is None:
+            self.buffer.seek(0)
+            return self.buffer
+        self.file.flush()
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        '''Free the memory, or delete the temporary file.'''
+        self.release()
+        self.buffer = None
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.path)
+            except OSError, e:
+                ftpserver.logerror("Could not remove %s: %s" % (self.path, e))
+            self.file = None
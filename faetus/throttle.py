@@ -0,0 +1,165 @@
+import time
+import threading
+
+
+class TokenBucket(object):
+    '''rate tokens a second, of which up to burst seconds' worth are saved
+ up while unused (and available at once). Taking more than there is puts
+ the bucket in debt: nothing else gets through until it is paid back.
+ Not thread-safe; the Scheduler serializes its use.
+    '''
+
+    def __init__(self, rate, burst=1.0):
+        self.rate = float(rate)
+        # At least a whole token: below 1 request a second, a short burst
+        # would never let one through.
+        self.capacity = max(1.0, self.rate * burst)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        '''Seconds until a token is available, 0 if one is now.'''
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.refill()
+        self.tokens -= amount
+
+
+class Throttle(object):
+    '''The limits of one FTP user, on top of the Scheduler's global ones.
+ Shared by all the sessions of the user.
+    '''
+
+    def __init__(self, scheduler, bandwidth, request_rate):
+        self.scheduler = scheduler
+        self.bandwidth = bandwidth and TokenBucket(bandwidth, scheduler.burst)
+        self.requests = request_rate and TokenBucket(request_rate, scheduler.burst)
+        # Tickets of the threads waiting to make an S3 request, in order.
+        self.waiting = []
+
+    def may_transfer(self):
+        return self.scheduler.may_transfer(self)
+
+    def transferred(self, amount):
+        self.scheduler.transferred(self, amount)
+
+    def request(self):
+        self.scheduler.request(self)
+
+
+class Scheduler(object):
+    '''Enforces limits on the bytes a second going through the data channels
+ and on the S3 requests a second, for all the sessions (bandwidth,
+ request_rate) and for each FTP user (user_bandwidth, user_request_rate,
+ or those given to throttle()). 0 means no limit. Up to burst seconds'
+ worth of unused allowance can be spent at once. With several worker
+ processes, each enforces `share` (1/workers) of every limit.
+
+ Data channels check may_transfer() before each read from or write to
+ their socket, and report what they moved with transferred(): once
+ in debt, no channel moves data until the debt is paid back, then each
+ ready channel moves one buffer per pass of the loop, sharing the
+ bandwidth evenly between sessions.
+
+ request() blocks the calling thread until an S3 request may be made.
+ Users waiting for the global allowance take turns, one request each,
+ and within a user requests go in order.
+    '''
+
+    def __init__(self, bandwidth=0, request_rate=0, user_bandwidth=0,
+                 user_request_rate=0, burst=1.0, share=1.0):
+        self.burst = burst
+        self.share = share
+        self.bandwidth = bandwidth and TokenBucket(bandwidth * share, burst)
+        self.requests = request_rate and TokenBucket(request_rate * share, burst)
+        self.user_bandwidth = user_bandwidth
+        self.user_request_rate = user_request_rate
+        self.lock = threading.Condition()
+        # Throttles with threads waiting in request(), in turn order.
+        self.turns = []
+        # FTP username -> Throttle
+        self.throttles = {}
+
+    def throttle(self, username, bandwidth=None, request_rate=None):
+        '''Return the Throttle of an FTP user, made on its first session
+        with the default user limits where none is given.'''
+        self.lock.acquire()
+        try:
+            throttle = self.throttles.get(username)
+            if throttle is None:
+                if bandwidth is None:
+                    bandwidth = self.user_bandwidth
+                if request_rate is None:
+                    request_rate = self.user_request_rate
+                throttle = self.throttles[username] = Throttle(
+                    self, bandwidth * self.share, request_rate * self.share)
+            return throttle
+        finally:
+            self.lock.release()
+
+    def may_transfer(self, throttle):
+        for bucket in (self.bandwidth, throttle.bandwidth):
+            if bucket and bucket.delay():
+                return False
+        return True
+
+    def transferred(self, throttle, amount):
+        for bucket in (self.bandwidth, throttle.bandwidth):
+            if bucket:
+                bucket.take(amount)
+
+    def request(self, throttle):
+        if not self.requests and not throttle.requests:
+            return
+        ticket = object()
+        self.lock.acquire()
+        try:
+            throttle.waiting.append(ticket)
+            if len(throttle.waiting) == 1:
+                self.turns.append(throttle)
+            while True:
+                delay = self.request_delay(throttle, ticket)
+                if not delay:
+                    break
+                self.lock.wait(delay)
+            for bucket in (self.requests, throttle.requests):
+                if bucket:
+                    bucket.take(1)
+            throttle.waiting.pop(0)
+            # To the back of the line if it has more requests waiting.
+            self.turns.remove(throttle)
+            if throttle.waiting:
+                self.turns.append(throttle)
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def request_delay(self, throttle, ticket):
+        '''Seconds to wait before checking again whether the request
+        `ticket` of throttle may go, 0 if it may now. Call with the lock
+        held.'''
+        if throttle.waiting[0] is not ticket:
+            # Woken up when the one before it goes.
+            return 1.0
+        delay = throttle.requests and throttle.requests.delay()
+        if delay:
+            return delay
+        if not self.requests:
+            return 0
+        # The first account in line which its own limit lets through gets
+        # the next global token.
+        for first in self.turns:
+            if not first.requests or not first.requests.delay():
+                break
+        if first is not throttle:
+            return 1.0
+        return self.requests.delay()
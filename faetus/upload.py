@@ -0,0 +1,113 @@
+import threading
+import Queue
+from cStringIO import StringIO
+
+from boto.exception import S3ResponseError, S3DataError
+from pyftpdlib import ftpserver
+
+
+class ParallelPartUploader(object):
+    '''Uploads the parts of a S3 multipart upload with several threads at
+ once, for a throughput a single PUT stream does not reach.
+
+ At most buffer_size bytes of parts are waiting or being uploaded: beyond
+ that, submit() blocks until a part is done, which stops the data channel
+ from reading more. ready() tells whether a part of part_size bytes can be
+ submitted without blocking, and on_ready (if set) is called, from an
+ upload thread, every time a part is done.
+
+ S3 orders the parts by number, whatever the order they are uploaded in:
+ finish() returns the etags needed to complete the upload, in order.
+
+ Parts are submitted with their MD5 (as given by Key.get_md5_from_hexdigest),
+ which S3 checks the data against.
+    '''
+
+    def __init__(self, multipart, part_size, concurrency=4,
+                 buffer_size=64 * 1024 * 1024):
+        self.multipart = multipart
+        self.part_size = part_size
+        self.buffer_size = buffer_size
+        self.on_ready = None
+        # Bytes submitted and not uploaded yet.
+        self.pending = 0
+        # part number -> etag
+        self.etags = {}
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.jobs = Queue.Queue()
+        self.threads = []
+        for i in range(concurrency):
+            thread = threading.Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def ready(self):
+        return self.error is not None or self.pending == 0 or \
+            self.pending + self.part_size <= self.buffer_size
+
+    def submit(self, part_num, data, md5=None):
+        self.condition.acquire()
+        try:
+            while self.error is None and self.pending and \
+                  self.pending + len(data) > self.buffer_size:
+                self.condition.wait()
+            if self.error is not None:
+                raise IOError(5, 'S3 upload failed')
+            self.pending += len(data)
+        finally:
+            self.condition.release()
+        self.jobs.put((part_num, data, md5))
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            part_num, data, md5 = job
+            etag = error = None
+            if self.error is None and not self.closed:
+                try:
+                    etag = self.multipart.upload_part_from_file(StringIO(data), part_num,
+                                                                md5=md5).etag
+                except (S3ResponseError, S3DataError, EnvironmentError), e:
+                    ftpserver.logerror("Could not upload part %d of %s: %s" \
+                                       % (part_num, self.multipart.key_name, e))
+                    error = e
+            self.condition.acquire()
+            try:
+                self.pending -= len(data)
+                if etag is not None:
+                    self.etags[part_num] = etag
+                elif self.error is None:
+                    self.error = error or IOError(5, 'S3 upload cancelled')
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+            if self.on_ready is not None:
+                self.on_ready()
+
+    def finish(self):
+        '''Wait for all the parts, and return their [(part number, etag)],
+        in order. Raises IOError if any of them failed.'''
+        self.condition.acquire()
+        try:
+            while self.pending:
+                self.condition.wait()
+        finally:
+            self.condition.release()
+        self.close()
+        if self.error is not None:
+            raise IOError(5, 'S3 upload failed')
+        return sorted(self.etags.items())
+
+    def close(self):
+        '''Stop the threads. The parts being uploaded are left to finish.'''
+        if self.closed:
+            return
+        self.closed = True
+        for thread in self.threads:
+            self.jobs.put(None)
+        self.threads = []
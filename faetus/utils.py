@@ -1,4 +1,7 @@
+import calendar
+import time
 import types
+from email.utils import parsedate_tz, mktime_tz
 
 #from django.utils
 def smart_str(s, encoding='utf-8', strings_only=False, errors='strict'):
@@ -18,3 +21,30 @@ def smart_str(s, encoding='utf-8', strings_only=False, errors='strict'):
         return s.decode('utf-8', errors).encode(encoding, errors)
     else:
         return s
+
+
+def s3_timestamp(last_modified):
+    """Seconds since the epoch for an S3 last_modified value: ISO 8601
+    (2009-10-12T17:50:30.000Z) in listings, RFC 1123
+    (Mon, 12 Oct 2009 17:50:30 GMT) in HEAD and GET responses.
+    Returns 0 when there is nothing to parse."""
+    if not last_modified:
+        return 0
+    if last_modified[4:5] == '-':
+        return calendar.timegm(time.strptime(last_modified[:19], "%Y-%m-%dT%H:%M:%S"))
+    parsed = parsedate_tz(last_modified)
+    if parsed is None:
+        return 0
+    return mktime_tz(parsed)
+
+
+def chunked(iterable, size):
+    """Yield lists of up to size consecutive items of iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
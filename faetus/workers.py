@@ -0,0 +1,225 @@
+import os
+import sys
+import fcntl
+import functools
+import asyncore
+import threading
+import traceback
+import Queue
+
+from collections import deque
+
+from pyftpdlib import ftpserver
+
+
+class _Waker(asyncore.file_dispatcher):
+    '''Pipe registered in the asyncore map. Worker threads write a byte to it
+ to wake the loop up (select() returns), which then runs the callbacks they
+ queued, in the loop thread.
+    '''
+
+    def __init__(self):
+        read_fd, self.write_fd = os.pipe()
+        # file_dispatcher works on its own dup() of the descriptor.
+        asyncore.file_dispatcher.__init__(self, read_fd)
+        os.close(read_fd)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL,
+                    fcntl.fcntl(self.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.callbacks = deque()
+        self.lock = threading.Lock()
+        self.woken = False
+
+    def writable(self):
+        return False
+
+    def wake(self, callback=None):
+        '''Called from any thread: run callback (if any) in the loop thread.'''
+        self.lock.acquire()
+        try:
+            if callback is not None:
+                self.callbacks.append(callback)
+            if self.woken:
+                return
+            self.woken = True
+        finally:
+            self.lock.release()
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError:
+            pass
+
+    def handle_read(self):
+        self.lock.acquire()
+        try:
+            self.woken = False
+            try:
+                self.recv(4096)
+            except (OSError, IOError):
+                pass
+            callbacks, self.callbacks = self.callbacks, deque()
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            try:
+                callback()
+            except (KeyboardInterrupt, SystemExit, asyncore.ExitNow):
+                raise
+            except:
+                ftpserver.logerror(traceback.format_exc())
+
+    def handle_close(self):
+        pass
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+_loop_waker = None
+
+
+def loop_waker():
+    '''The _Waker of this process' loop, for the code running without a
+    WorkerPool. Made on first use, which must be in the loop thread, and
+    made again once closed (FTPServer.close_all() closes it with the
+    sessions).'''
+    global _loop_waker
+    if _loop_waker is None or _loop_waker._fileno is None:
+        _loop_waker = _Waker()
+    return _loop_waker
+
+
+class WorkerPool(object):
+    '''Bounded pool of threads running blocking calls (S3 requests) off the
+ asyncore loop, so that a slow S3 request only holds its own session up.
+
+ submit() queues a call; its result (or the exception it raised) is handed
+ to callback (or errback) back in the loop thread. The pool must be
+ created in the process, and with the asyncore map, that runs the loop.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.jobs = Queue.Queue()
+        self.waker = _Waker()
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.work, name="faetus-worker-%d" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, args=(), callback=None, errback=None):
+        self.jobs.put((function, args, callback, errback))
+
+    def wake(self):
+        '''Make the loop re-check which channels are readable/writable.'''
+        self.waker.wake()
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            function, args, callback, errback = job
+            try:
+                result = function(*args)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                error = sys.exc_info()[1]
+                if errback is None or not isinstance(error, EnvironmentError):
+                    # Unexpected: log the traceback, which errback won't see.
+                    ftpserver.logerror(traceback.format_exc())
+                if errback is None:
+                    self.waker.wake()
+                else:
+                    # Bound now: this thread may run the next job before
+                    # the loop runs the callback.
+                    self.waker.wake(functools.partial(errback, error))
+            else:
+                if callback is None:
+                    self.waker.wake()
+                else:
+                    self.waker.wake(functools.partial(callback, result))
+
+    def close(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+        self.threads = []
+        self.waker.close()
+
+
+class PrefetchProducer(object):
+    '''Producer wrapping another one whose more() blocks on S3 (a
+ FileProducer over a FaetusFD, or a listing): while the data channel sends
+ one chunk, the next one is fetched in the worker pool.
+
+ The first chunk is fetched by whoever creates the producer (typically in
+ the pool, along with opening the file) so that the producer is ready when
+ pushed. ready() tells the data channel whether more() can be called
+ without blocking.
+    '''
+
+    def __init__(self, producer, pool, first_chunk):
+        self.producer = producer
+        self.pool = pool
+        self.chunk = first_chunk
+        self.error = None
+        self.fetched = threading.Event()
+        self.fetched.set()
+
+    def ready(self):
+        return self.fetched.isSet()
+
+    def fetch(self):
+        try:
+            self.chunk = self.producer.more()
+        except:
+            self.error = sys.exc_info()[1]
+        self.fetched.set()
+
+    def more(self):
+        # Normally only called once ready(); wait otherwise.
+        self.fetched.wait()
+        if self.error is not None:
+            raise self.error
+        data, self.chunk = self.chunk, ''
+        if data:
+            self.fetched.clear()
+            self.pool.submit(self.fetch)
+        return data
+
+
+def parallel_map(function, items, threads):
+    '''Call function(item) for each of items, with up to `threads` threads
+    at once. items may be a lazy iterator: it is only consumed as threads
+    become free. Return the exception each call raised (None if it
+    succeeded), in the order of items.'''
+    errors = []
+    jobs = Queue.Queue(threads)
+
+    def work():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            index, item = job
+            try:
+                function(item)
+            except Exception:
+                errors[index] = sys.exc_info()[1]
+
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    try:
+        for index, item in enumerate(items):
+            errors.append(None)
+            jobs.put((index, item))
+    finally:
+        for thread in workers:
+            jobs.put(None)
+        for thread in workers:
+            thread.join()
+    return errors
@@ -0,0 +1,510 @@
+import os
+import time
+import json
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+from pyftpdlib import ftpserver
+from boto.exception import S3ResponseError, S3DataError
+from boto.s3.key import Key
+from boto.s3.prefix import Prefix
+
+from faetus.metrics import metrics
+
+
+class PendingUpload(object):
+    '''An upload waiting in the UploadQueue: its data in <id>.data, and
+ once complete, its journal entry in <id>.json.
+
+ The data is hashed as it is written in parts of part_size bytes, whose
+ MD5s are journaled with it: the multipart upload sends each part with its
+ digest, so that data which changed on the disk meanwhile is refused.
+    '''
+
+    fields = ('username', 'bucket', 'name', 'size', 'md5', 'sha256', 'created')
+    # Not in the journals of older versions.
+    optional_fields = ('part_size', 'part_md5s')
+
+    def __init__(self, directory, id, part_size=None):
+        self.directory = directory
+        self.id = id
+        self.username = self.bucket = self.name = None
+        self.size = 0
+        self.md5 = self.sha256 = None
+        self.created = 0
+        self.part_size = part_size
+        # Hex MD5s of the parts written so far, the last one being hashed
+        # in part_md5 until it is full.
+        self.part_md5s = []
+        self.part_md5 = None
+        self.part_left = 0
+        self.file = None
+        self.attempts = 0
+        self.next_try = 0
+        self.failed = False
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.id + '.data')
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.directory, self.id + '.json')
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        while data and self.part_size:
+            if self.part_md5 is None:
+                self.part_md5 = hashlib.md5()
+                self.part_left = self.part_size
+            chunk, data = data[:self.part_left], data[self.part_left:]
+            self.part_md5.update(chunk)
+            self.part_left -= len(chunk)
+            if not self.part_left:
+                self.part_md5s.append(self.part_md5.hexdigest())
+                self.part_md5 = None
+
+    def key(self, bucket):
+        '''The Key it will be, as a HEAD would give it.'''
+        key = Key(bucket, self.name)
+        key.size = self.size
+        key.last_modified = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(self.created))
+        key.etag = '"%s"' % self.md5
+        if self.sha256:
+            key.metadata['sha256'] = self.sha256
+        return key
+
+    def save(self):
+        '''Make the data durable, then record it in the journal.'''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        if self.part_md5 is not None:
+            self.part_md5s.append(self.part_md5.hexdigest())
+            self.part_md5 = None
+        data = json.dumps(dict((field, getattr(self, field))
+                               for field in self.fields + self.optional_fields))
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='tmp')
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(path, self.journal_path)
+        fsync_directory(self.directory)
+
+    def load(self):
+        entry = json.load(open(self.journal_path))
+        for field in self.fields:
+            value = entry[field]
+            # json gives unicode; the paths of the FTP server are UTF-8.
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            setattr(self, field, value)
+        self.part_size = entry.get('part_size')
+        self.part_md5s = [str(md5) for md5 in entry.get('part_md5s') or []]
+
+    def remove(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for path in (self.journal_path, self.path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class UploadQueue(object):
+    '''Write-behind uploads: a STOR completes once its data is on the local
+ disk (fsynced, with its entry in the journal), and `threads` threads send
+ the queued files to S3. A failed upload is retried after retry_delay
+ seconds, twice as long after each failure (up to max_retry_delay), and
+ given up on after max_attempts: its files are then renamed to
+ <id>.failed.data and <id>.failed.json.
+
+ The uploads still in the journal after a restart are resumed, once their
+ user logs in again: the S3 credentials are only kept in memory. With
+ several worker processes, each has its own directory (see part()), and
+ worker 0 also resumes those of the workers a previous run had and this one
+ has not.
+
+ Until it is uploaded, the new content of a key is what the sessions of
+ its user see: pending() and listing() give it to the FaetusFS, and open()
+ its data to a RETR. Only the
+ latest upload of a key is kept, and uploads of the same key are sent one
+ at a time, in order.
+    '''
+
+    def __init__(self, directory, connections, threads=4, part_size=64 * 1024 * 1024,
+                 max_attempts=10, retry_delay=1.0, max_retry_delay=300):
+        self.directory = directory
+        self.connections = connections
+        self.thread_count = threads
+        self.part_size = part_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lock = threading.Condition()
+        # id -> PendingUpload, oldest first.
+        self.entries = OrderedDict()
+        # (username, bucket, name) -> ids of its uploads, in order (an
+        # upload being sent, then the one replacing it).
+        self.keys = {}
+        self.in_flight = set()
+        # Bytes of the entries.
+        self.size = 0
+        # username -> (username, password)
+        self.credentials = {}
+        self.threads = None
+        # Directories of other queues whose journal this one resumes; None
+        # for those of all the worker processes.
+        self.adopted = None
+
+    def part(self, slot, parts):
+        '''Return the queue of worker process `slot` out of `parts`: its own
+        subdirectory, and journal.'''
+        queue = UploadQueue(os.path.join(self.directory, 'worker-%d' % slot), self.connections,
+                            self.thread_count, self.part_size, self.max_attempts,
+                            self.retry_delay, self.max_retry_delay)
+        queue.adopted = []
+        if slot == 0:
+            # Left by a run with more worker processes: nobody else would.
+            queue.adopted = self.slot_directories(parts)
+        return queue
+
+    def slot_directories(self, first):
+        '''The directories of the worker processes from slot `first` on.'''
+        directories = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                prefix, _, slot = name.partition('worker-')
+                if not prefix and slot.isdigit() and int(slot) >= first:
+                    directories.append(os.path.join(self.directory, name))
+        return sorted(directories)
+
+    def start(self):
+        '''Resume the uploads of the journal, and start the threads (in the
+        process serving the sessions). Call with the lock held.'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        adopted = self.adopted
+        if adopted is None:
+            adopted = self.slot_directories(0)
+        loaded = []
+        for directory in [self.directory] + adopted:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.startswith('tmp'):
+                    # Journal entry interrupted by a crash.
+                    os.remove(path)
+                    continue
+                if not name.endswith('.data') or name.endswith('.failed.data'):
+                    continue
+                entry = PendingUpload(directory, name[:-len('.data')])
+                if not os.path.exists(entry.journal_path):
+                    # A STOR which never completed.
+                    entry.remove()
+                    continue
+                try:
+                    entry.load()
+                except (ValueError, KeyError, EnvironmentError), e:
+                    ftpserver.logerror("Dropping the upload journaled in %s: %s" \
+                                       % (entry.journal_path, e))
+                    entry.remove()
+                    continue
+                loaded.append((entry.created, entry.id, entry))
+        loaded.sort()
+        for created, id, entry in loaded:
+            self.add(entry)
+        if loaded:
+            ftpserver.log("Resuming %d uploads" % len(loaded))
+        self.threads = [threading.Thread(target=self.run, name='UploadQueue-%d' % i)
+                        for i in range(self.thread_count)]
+        for thread in self.threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def login(self, credentials):
+        '''Let the uploads of this (username, password) go.'''
+        self.lock.acquire()
+        try:
+            if self.threads is None:
+                self.start()
+            if self.credentials.get(credentials[0]) != credentials:
+                self.credentials[credentials[0]] = credentials
+                self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def new(self):
+        '''Return a PendingUpload to write the data of a STOR to.'''
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='upload-', suffix='.data')
+        entry = PendingUpload(self.directory, os.path.basename(path)[:-len('.data')],
+                              self.part_size)
+        entry.file = os.fdopen(fd, 'wb')
+        return entry
+
+    def submit(self, entry, username, bucket_name, key_name, md5, sha256=None):
+        '''Journal the upload written to entry, and queue it, replacing any
+        other upload of the key not sent yet.'''
+        entry.username, entry.bucket, entry.name = username, bucket_name, key_name
+        entry.md5, entry.sha256 = md5, sha256
+        entry.created = time.time()
+        entry.save()
+        self.lock.acquire()
+        try:
+            key = (username, bucket_name, key_name)
+            for id in self.keys.get(key, [])[:]:
+                if (key, id) not in self.in_flight:
+                    self.drop(self.entries[id])
+            self.add(entry)
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def add(self, entry):
+        '''Call with the lock held.'''
+        self.entries[entry.id] = entry
+        self.keys.setdefault((entry.username, entry.bucket, entry.name), []).append(entry.id)
+        self.size += entry.size
+        metrics.upload_queue(len(self.entries), self.size)
+
+    def drop(self, entry, failed=False):
+        '''Forget entry, deleting its files (or keeping them aside if it
+        failed). Call with the lock held.'''
+        del self.entries[entry.id]
+        key = (entry.username, entry.bucket, entry.name)
+        self.keys[key].remove(entry.id)
+        if not self.keys[key]:
+            del self.keys[key]
+        if failed:
+            for path in (entry.path, entry.journal_path):
+                os.rename(path, path[:-5] + '.failed' + path[-5:])
+        else:
+            entry.remove()
+        self.size -= entry.size
+        metrics.upload_queue(len(self.entries), self.size)
+        self.lock.notify_all()
+
+    def discard(self, entry):
+        '''Drop the data of a STOR never submitted.'''
+        entry.remove()
+
+    def pending(self, username, bucket, key_name):
+        '''The Key (for bucket, a boto Bucket) the latest upload of key_name
+        will give, or None if it has none pending.'''
+        self.lock.acquire()
+        try:
+            ids = self.keys.get((username, bucket.name, key_name))
+            return ids and self.entries[ids[-1]].key(bucket) or None
+        finally:
+            self.lock.release()
+
+    def open(self, username, bucket_name, key_name):
+        '''(file, size, etag) of the data of the latest upload of key_name,
+        or None if it has none pending. The file stays readable once the
+        upload is done and its data deleted.'''
+        self.lock.acquire()
+        try:
+            ids = self.keys.get((username, bucket_name, key_name))
+            if not ids:
+                return None
+            entry = self.entries[ids[-1]]
+            # Under the lock: drop() deletes the file once uploaded.
+            return open(entry.path, 'rb'), entry.size, '"%s"' % entry.md5
+        finally:
+            self.lock.release()
+
+    def listing(self, username, bucket, prefix):
+        '''{name: item} of what the pending uploads add right under prefix,
+        names being relative to it, items Keys and Prefixes.'''
+        items = {}
+        self.lock.acquire()
+        try:
+            for (user, bucket_name, key_name), ids in self.keys.iteritems():
+                if user != username or bucket_name != bucket.name or \
+                   not key_name.startswith(prefix):
+                    continue
+                name, sep, rest = key_name[len(prefix):].partition('/')
+                if sep:
+                    items[name] = Prefix(bucket, prefix + name + sep)
+                elif name not in items:
+                    items[name] = self.entries[ids[-1]].key(bucket)
+        finally:
+            self.lock.release()
+        return items
+
+    def has_prefix(self, username, bucket_name, prefix):
+        '''Whether the pending uploads add keys under prefix.'''
+        self.lock.acquire()
+        try:
+            for user, bucket, key_name in self.keys:
+                if (user, bucket) == (username, bucket_name) and key_name.startswith(prefix):
+                    return True
+            return False
+        finally:
+            self.lock.release()
+
+    def flush(self, username, bucket_name, key_name=None, prefix=None, cancel=False):
+        '''Wait until the uploads of key_name (or of the keys under prefix)
+        are done, sending them right away, or dropping those not being
+        sent if cancel. Raises IOError if one fails meanwhile.'''
+        def matches(key):
+            return key[:2] == (username, bucket_name) and \
+                (key[2] == key_name or (prefix is not None and key[2].startswith(prefix)))
+
+        self.lock.acquire()
+        try:
+            waiting = []
+            for key, ids in self.keys.items():
+                if not matches(key):
+                    continue
+                for id in ids[:]:
+                    entry = self.entries[id]
+                    if cancel and (key, id) not in self.in_flight:
+                        self.drop(entry)
+                        continue
+                    entry.next_try = 0
+                    entry.failed = False
+                    waiting.append(entry)
+            self.lock.notify_all()
+            while waiting:
+                entry = waiting[0]
+                if entry.id not in self.entries:
+                    waiting.pop(0)
+                elif entry.failed:
+                    raise IOError(5, 'Upload of %s failed' % entry.name)
+                else:
+                    self.lock.wait(1.0)
+        finally:
+            self.lock.release()
+
+    def next_upload(self):
+        '''Wait for an upload which may be sent now, and mark it in flight.'''
+        self.lock.acquire()
+        try:
+            while True:
+                now = time.time()
+                delay = None
+                for ids in self.keys.itervalues():
+                    entry = self.entries[ids[0]]
+                    key = (entry.username, entry.bucket, entry.name)
+                    if (key, entry.id) in self.in_flight or \
+                       entry.username not in self.credentials:
+                        continue
+                    if entry.next_try <= now:
+                        self.in_flight.add((key, entry.id))
+                        return entry
+                    delay = min(delay or entry.next_try - now, entry.next_try - now)
+                self.lock.wait(delay)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            entry = self.next_upload()
+            error = None
+            try:
+                self.upload(entry)
+            except Exception, e:
+                error = e
+            self.lock.acquire()
+            try:
+                self.in_flight.discard(((entry.username, entry.bucket, entry.name), entry.id))
+                if error is None:
+                    self.drop(entry)
+                    continue
+                entry.attempts += 1
+                entry.failed = True
+                if entry.attempts >= self.max_attempts:
+                    ftpserver.logerror("Giving up uploading %s/%s after %d attempts: %s" \
+                                       % (entry.bucket, entry.name, entry.attempts, error))
+                    self.drop(entry, failed=True)
+                    continue
+                delay = min(self.retry_delay * 2 ** (entry.attempts - 1), self.max_retry_delay)
+                ftpserver.logerror("Could not upload %s/%s, retrying in %.1fs: %s" \
+                                   % (entry.bucket, entry.name, delay, error))
+                entry.next_try = time.time() + delay
+                self.lock.notify_all()
+            finally:
+                self.lock.release()
+
+    def upload(self, entry):
+        '''Send entry to S3, with a multipart upload if it is larger than
+        part_size.'''
+        credentials = self.credentials[entry.username]
+        account = self.connections.acquire(*credentials)
+        try:
+            bucket = account.connection.get_bucket(entry.bucket, validate=False)
+            key = bucket.new_key(entry.name)
+            metadata = entry.sha256 and {'sha256': entry.sha256} or {}
+            data = open(entry.path, 'rb')
+            try:
+                if entry.size <= (entry.part_size or self.part_size):
+                    key.update_metadata(metadata)
+                    # boto checks the ETag S3 returns against the MD5.
+                    key.set_contents_from_file(data, md5=key.get_md5_from_hexdigest(entry.md5))
+                else:
+                    self.upload_parts(key, entry, data, metadata)
+            finally:
+                data.close()
+        finally:
+            account.cache.invalidate_key(entry.bucket, entry.name)
+            self.connections.release(*credentials)
+
+    def upload_parts(self, key, entry, data, metadata):
+        '''Send entry as a multipart upload, in the parts it was hashed in
+        (those of the queue's part_size if its journal has no digests), and
+        complete it once S3 has them all with the expected ETags.'''
+        part_size = entry.part_size or self.part_size
+        multipart = key.bucket.initiate_multipart_upload(entry.name, metadata=metadata)
+        try:
+            # part number -> ETag
+            etags = {}
+            for part_num, start in enumerate(xrange(0, entry.size, part_size)):
+                md5 = None
+                if part_num < len(entry.part_md5s):
+                    md5 = key.get_md5_from_hexdigest(entry.part_md5s[part_num])
+                data.seek(start)
+                etag = multipart.upload_part_from_file(data, part_num + 1, md5=md5,
+                                                       size=min(part_size, entry.size - start)).etag
+                if md5 is not None and etag.strip('"') != md5[0]:
+                    raise S3DataError('ETag of part %d of %s does not match its MD5' \
+                                      % (part_num + 1, entry.name))
+                etags[part_num + 1] = etag
+            missing = etags.copy()
+            for part in multipart:
+                if missing.pop(part.part_number, None) != part.etag:
+                    raise S3DataError('Part %d of %s is not the one uploaded' \
+                                      % (part.part_number, entry.name))
+            if missing:
+                raise S3DataError('S3 is missing parts %s of %s' \
+                                  % (sorted(missing), entry.name))
+            # From the ETags checked, rather than from another listing as
+            # MultiPartUpload.complete_upload() would.
+            xml = ['<CompleteMultipartUpload>']
+            for part_num, etag in sorted(etags.items()):
+                xml.append('<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' \
+                           % (part_num, etag))
+            xml.append('</CompleteMultipartUpload>')
+            key.bucket.complete_multipart_upload(entry.name, multipart.id, ''.join(xml))
+        except:
+            try:
+                multipart.cancel_upload()
+            except S3ResponseError:
+                pass
+            raise
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+'''Benchmarks faetus against the in-process S3 stand-in of fakes3.py: no
+AWS account or network needed. A faetus FTPServer is started in a thread
+and driven with ftplib clients (or its FaetusFS directly, for "fs"):
+
+ list        LIST, NLST and MLSD of a directory of --keys keys
+ fs          the same listing through FaetusFS, time in S3 against client
+             side (boto's XML parsing, caches, formatting)
+ format      LIST lines of --keys keys, without S3: faetus.listing against
+             the strptime based formatting it replaced
+ small       STOR then RETR of --files files of --file-size bytes
+ large       STOR then RETR of one file of --large-size MB
+ concurrent  --clients clients doing STOR/RETR/LIST at the same time
+
+Every scenario reports its duration, throughput and S3 requests per
+command. Run them all, or those named on the command line:
+
+ python tests/benchmark.py --latency 20 --bandwidth 50 list large
+
+--log-file measures the cost of logging, with or without --async-log.
+'''
+import time
+import ftplib
+import threading
+from optparse import OptionParser
+from cStringIO import StringIO
+
+from pyftpdlib import ftpserver
+from boto.s3.key import Key
+
+from fakes3 import FakeS3
+from faetus.server import FaetusFTPHandler, FaetusAuthorizer, FaetusFS, FaetusFD
+from faetus.server import connections
+from faetus.workers import WorkerPool
+from faetus.metrics import metrics
+from faetus import log
+from faetus.listing import ListFormatter
+from faetus.utils import s3_timestamp
+
+
+SCENARIOS = ['list', 'fs', 'format', 'small', 'large', 'concurrent']
+BUCKET = 'bench'
+USERNAME = 'benchmark'
+PASSWORD = 'secret'
+
+
+class ZeroFile(object):
+    '''File of `size` zero bytes, for uploads larger than the memory.'''
+
+    def __init__(self, size):
+        self.size = size
+
+    def read(self, amt=8192):
+        amt = min(amt, self.size)
+        self.size -= amt
+        return '\0' * amt
+
+
+def strptime_list_lines(username, entries):
+    '''LIST lines of keys as FaetusFS formatted them before
+    faetus.listing: a strptime() and a strftime() per key.'''
+    for name, item in entries:
+        if item.name[-1] == '/':
+            dir_flag = 'd'
+        else:
+            dir_flag = '-'
+        ts = time.strftime("%b %d %H:%M", time.gmtime(s3_timestamp(item.last_modified)))
+        yield '%srw------   1 %s   group  %8s %s %s\r\n' % \
+            (dir_flag, username, item.size, ts, name)
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.fake = FakeS3(options.latency / 1000.0, options.bandwidth * 1024 * 1024)
+        connections.connection_class = self.fake.connection
+        self.fake.request('PUT', '/' + BUCKET, {}, '')
+
+        handler = FaetusFTPHandler
+        handler.authorizer = FaetusAuthorizer()
+        handler.abstracted_fs = FaetusFS
+        if options.threads:
+            handler.worker_pool = WorkerPool(options.threads)
+        FaetusFD.multipart_chunk_size = options.multipart_chunk_size * 1024 * 1024
+        FaetusFD.upload_concurrency = options.upload_concurrency
+        FaetusFD.download_concurrency = options.download_concurrency
+        if options.log_file:
+            log.setup(options.log_file, 'debug', options.async_log, options.log_sample)
+        else:
+            ftpserver.log = ftpserver.logline = lambda msg: None
+        self.server = ftpserver.FTPServer(('127.0.0.1', 0), handler)
+        self.server.max_cons = 0
+        # pyftpdlib listens with a backlog of 5: the clients of the
+        # concurrent scenario all connect at once.
+        self.server.listen(max(5, options.clients))
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'timeout': 0.01})
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def close(self):
+        self.server.close_all()
+        self.thread.join()
+
+    def client(self):
+        client = ftplib.FTP()
+        client.connect('127.0.0.1', self.server.socket.getsockname()[1])
+        client.login(USERNAME, PASSWORD)
+        client.voidcmd('TYPE I')
+        return client
+
+    def run(self, name, commands, transferred, function, *args):
+        '''Run function(*args), which issues `commands` FTP commands
+        transferring `transferred` bytes, and report it.'''
+        requests = len(self.fake.requests)
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        requests = len(self.fake.requests) - requests
+        line = '%-28s %9.3fs %10.1f cmd/s %8.1f S3 req/cmd' \
+            % (name, elapsed, commands / elapsed, float(requests) / commands)
+        if transferred:
+            line += ' %9.1f MB/s' % (transferred / elapsed / (1024 * 1024))
+        print line
+
+    def bench_list(self):
+        keys = self.options.keys
+        self.fake.populate(BUCKET, ['list/%08d' % i for i in xrange(keys)], 1024)
+        client = self.client()
+        lines = []
+        self.run('LIST %d keys' % keys, 1, 0, client.retrlines, 'LIST /%s/list' % BUCKET,
+                 lines.append)
+        assert len(lines) == keys, len(lines)
+        self.run('NLST %d keys' % keys, 1, 0, client.nlst, '/%s/list' % BUCKET)
+        lines = []
+        self.run('MLSD %d keys' % keys, 1, 0, client.retrlines, 'MLSD /%s/list' % BUCKET,
+                 lines.append)
+        assert len(lines) == keys, len(lines)
+        client.quit()
+
+    def bench_fs(self):
+        keys = self.options.keys
+        self.fake.populate(BUCKET, ['list/%08d' % i for i in xrange(keys)], 1024)
+
+        class Channel(object):
+            authorizer = FaetusAuthorizer()
+            username = USERNAME
+            password = PASSWORD
+
+        fs = FaetusFS('/' + USERNAME, Channel())
+        before = self.s3_time('ListObjects')
+        start = time.time()
+        count = 0
+        for lines in fs.get_list_dir('/%s/%s/list' % (USERNAME, BUCKET)):
+            count += lines.count('\r\n')
+        elapsed = time.time() - start
+        s3 = self.s3_time('ListObjects') - before
+        fs.close()
+        assert count == keys, count
+        print '%-28s %9.3fs %10.1f keys/s %8.3fs in S3 %8.3fs client side' \
+            % ('FaetusFS list %d keys' % keys, elapsed, keys / elapsed, s3, elapsed - s3)
+
+    def bench_format(self):
+        keys = self.options.keys
+        entries = []
+        for i in xrange(keys):
+            key = Key(None, 'list/%08d' % i)
+            key.size = i
+            # boto gives the dates as unicode.
+            key.last_modified = unicode(time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                                      time.gmtime(i * 3607)))
+            entries.append(('%08d' % i, key))
+        outputs = []
+        for name, formatter in (('strptime', lambda: strptime_list_lines(USERNAME, entries)),
+                                ('ListFormatter', lambda: ListFormatter(USERNAME).format(entries))):
+            start = time.time()
+            output = ''.join(formatter())
+            elapsed = time.time() - start
+            outputs.append(output)
+            print '%-28s %9.3fs %10.1f lines/s' \
+                % ('format %d, %s' % (keys, name), elapsed, keys / elapsed)
+        assert outputs[0] == outputs[1] and isinstance(outputs[1], str)
+
+    def s3_time(self, operation):
+        histogram = metrics.s3_requests.get(operation)
+        return histogram and histogram.sum or 0
+
+    def bench_small(self):
+        files, size = self.options.files, self.options.file_size
+        client = self.client()
+        data = 'x' * size
+
+        def stor():
+            for i in xrange(files):
+                client.storbinary('STOR /%s/small/%d' % (BUCKET, i), StringIO(data))
+
+        def retr():
+            for i in xrange(files):
+                client.retrbinary('RETR /%s/small/%d' % (BUCKET, i), lambda data: None)
+
+        self.run('STOR %d x %d bytes' % (files, size), files, files * size, stor)
+        self.run('RETR %d x %d bytes' % (files, size), files, files * size, retr)
+        client.quit()
+
+    def bench_large(self):
+        size = self.options.large_size * 1024 * 1024
+        client = self.client()
+        self.run('STOR %d MB' % self.options.large_size, 1, size, client.storbinary,
+                 'STOR /%s/large' % BUCKET, ZeroFile(size), 65536)
+        self.run('RETR %d MB' % self.options.large_size, 1, size, client.retrbinary,
+                 'RETR /%s/large' % BUCKET, lambda data: None, 65536)
+        client.quit()
+
+    def bench_concurrent(self):
+        clients, rounds, size = self.options.clients, self.options.rounds, self.options.file_size
+        latencies = []
+        errors = []
+        data = 'x' * size
+
+        def session(n):
+            try:
+                client = self.client()
+                path = '/%s/concurrent/%d/' % (BUCKET, n)
+                for i in xrange(rounds):
+                    name = path + str(i)
+                    for command in (lambda: client.storbinary('STOR ' + name, StringIO(data)),
+                                    lambda: client.retrbinary('RETR ' + name, lambda data: None),
+                                    lambda: client.nlst(path)):
+                        start = time.time()
+                        command()
+                        latencies.append(time.time() - start)
+                client.quit()
+            except Exception, e:
+                errors.append(e)
+
+        def run():
+            threads = [threading.Thread(target=session, args=(n,)) for n in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.run('%d clients x %d rounds' % (clients, rounds), clients * rounds * 3,
+                 clients * rounds * size * 2, run)
+        if errors:
+            print '  %d clients failed: %s' % (len(errors), errors[0])
+        latencies.sort()
+        if latencies:
+            print '  command latency: p50 %.3fs, p95 %.3fs, p99 %.3fs, max %.3fs' \
+                % tuple([latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+                         for q in (0.5, 0.95, 0.99, 1)])
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [' + '|'.join(SCENARIOS) + ' ...]')
+    parser.add_option('--latency', type='float', default=0,
+                      help='Milliseconds each S3 request waits for its response: %default')
+    parser.add_option('--bandwidth', type='float', default=0,
+                      help='MB/s of each S3 request body (0: unlimited): %default')
+    parser.add_option('-t', '--threads', type='int', default=0,
+                      help='Worker threads making the S3 calls (0: none): %default')
+    parser.add_option('--keys', type='int', default=10000,
+                      help='Keys in the listed directory: %default')
+    parser.add_option('--files', type='int', default=200,
+                      help='Files of the small files scenario: %default')
+    parser.add_option('--file-size', type='int', default=4096,
+                      help='Bytes of the small files: %default')
+    parser.add_option('--large-size', type='int', default=256,
+                      help='MB of the large file: %default')
+    parser.add_option('--clients', type='int', default=20,
+                      help='Concurrent clients: %default')
+    parser.add_option('--rounds', type='int', default=10,
+                      help='STOR/RETR/NLST rounds of each concurrent client: %default')
+    parser.add_option('--multipart-chunk-size', type='int', default=16,
+                      help='MB of the multipart upload parts (0: single PUT): %default')
+    parser.add_option('--upload-concurrency', type='int', default=0,
+                      help='Parts uploaded at once: %default')
+    parser.add_option('--download-concurrency', type='int', default=0,
+                      help='Ranged GETs at once for large files: %default')
+    parser.add_option('--log-file', default=None,
+                      help='Log everything to this file, as faetus-server does (none by default)')
+    parser.add_option('--async-log', action='store_true', default=False,
+                      help='Write the log from a background thread')
+    parser.add_option('--log-sample', type='int', default=1,
+                      help='Log one in N of the per-path debug lines: %default')
+    options, scenarios = parser.parse_args()
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('Unknown scenario: %s' % scenario)
+
+    benchmark = Benchmark(options)
+    for scenario in scenarios or SCENARIOS:
+        getattr(benchmark, 'bench_' + scenario)()
+    benchmark.close()
+
+
+if __name__ == '__main__':
+    main()
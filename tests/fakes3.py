@@ -0,0 +1,546 @@
+'''In-process stand-in for S3, for running faetus without AWS.
+
+FakeS3 keeps buckets and keys in memory and answers the S3 REST API calls
+faetus makes (listings, GET/HEAD with Range and conditions, PUT, copies,
+multipart uploads, multi-object deletes), with the XML and headers S3
+sends. FakeS3Connection is a FaetusS3Connection handing its requests to a
+FakeS3 instead of the network, so everything above the HTTP exchange
+(boto's request building and response parsing, faetus' connection
+pooling and metrics) runs as it does against AWS:
+
+    fake = FakeS3(latency=0.02, bandwidth=50 * 1024 * 1024)
+    connections.connection_class = fake.connection
+
+Each request waits `latency` seconds before its response; request and
+response bodies are sent at most at `bandwidth` bytes per second, per
+request. Keys larger than keep_data_limit only keep their size and read
+back as zero bytes, so that multi-GB transfers do not need as much memory.
+'''
+import re
+import cgi
+import base64
+import time
+import urllib
+import hashlib
+import httplib
+import itertools
+import threading
+from bisect import bisect_left
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+
+from boto.s3.connection import OrdinaryCallingFormat
+
+from faetus.server import FaetusS3Connection
+
+
+def iso_timestamp(secs):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(secs))
+
+
+def http_timestamp(secs):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(secs))
+
+
+class FakeObject(object):
+    '''Content of a key or of an uploaded part. data is None when only the
+ size is kept: the content is then that many zero bytes.'''
+
+    def __init__(self, data, size, etag, headers=None):
+        self.data = data
+        self.size = size
+        self.etag = etag
+        self.headers = headers or {}
+        self.last_modified = time.time()
+
+    def read(self, start, end):
+        if self.data is None:
+            return ZeroBody(end - start)
+        return self.data[start:end]
+
+
+class ZeroBody(object):
+    '''A body of `size` zero bytes, produced as it is read.'''
+
+    def __init__(self, size):
+        self.size = size
+
+    def read(self, amt=None):
+        if amt is None or amt > self.size:
+            amt = self.size
+        self.size -= amt
+        return '\0' * amt
+
+
+class FakeUpload(object):
+
+    def __init__(self, upload_id, bucket_name, key_name, headers):
+        self.id = upload_id
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.headers = headers
+        # part number -> FakeObject
+        self.parts = {}
+
+
+class FakeS3(object):
+    '''In-memory S3 service, shared by all the FakeS3Connections made by
+ connection(), whatever their credentials.'''
+
+    keep_data_limit = 64 * 1024 * 1024
+
+    def __init__(self, latency=0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        # bucket name -> {key name: FakeObject}
+        self.buckets = {}
+        # bucket name -> sorted key names, rebuilt when keys are added
+        self.sorted_names = {}
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+        # (method, path) of every request received, path including the query
+        self.requests = []
+
+    def connection(self, aws_access_key_id, aws_secret_access_key):
+        return FakeS3Connection(self, aws_access_key_id, aws_secret_access_key)
+
+    def throttle(self, size):
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    def populate(self, bucket_name, names, size=0):
+        '''Add many keys of `size` zero bytes at once, e.g. for listing
+        benchmarks, without going through requests.'''
+        obj = FakeObject(None, size, '"%s"' % hashlib.md5('\0' * size).hexdigest())
+        self.lock.acquire()
+        try:
+            bucket = self.buckets.setdefault(text(bucket_name), {})
+            for name in names:
+                bucket[text(name)] = obj
+            self.sorted_names.pop(text(bucket_name), None)
+        finally:
+            self.lock.release()
+
+    def request(self, method, path, headers, body):
+        '''Handle a request, returning (status, headers, body), body being
+        a string or a ZeroBody.'''
+        if self.latency:
+            time.sleep(self.latency)
+        headers = dict((name.lower(), value) for name, value in headers.items())
+        if method == 'PUT' and body and 'x-amz-copy-source' not in headers:
+            # Hashed before taking the lock, which the other requests wait for.
+            metadata = dict((name, value) for name, value in headers.items()
+                            if name == 'content-type' or name.startswith('x-amz-meta-'))
+            body = self.store(body, metadata)
+        self.lock.acquire()
+        try:
+            self.requests.append((method, path))
+            # boto may give the (quoted, so ASCII) path as unicode, which
+            # unquote() would decode as Latin-1.
+            path, _, query = str(path).partition('?')
+            # Names are handled as unicode, as S3 compares them.
+            query = dict((name, text(values[0])) for name, values in
+                         cgi.parse_qs(query, keep_blank_values=True).items())
+            bucket_name, _, key_name = text(urllib.unquote(path[1:])).partition('/')
+            try:
+                if not bucket_name:
+                    return self.list_buckets()
+                if not key_name:
+                    return self.bucket_request(method, bucket_name, query, headers, body)
+                return self.key_request(method, bucket_name, key_name, query, headers, body)
+            except S3Error, e:
+                return e.response()
+        finally:
+            self.lock.release()
+
+    def get_bucket(self, bucket_name):
+        if bucket_name not in self.buckets:
+            raise S3Error(404, 'NoSuchBucket', bucket_name)
+        return self.buckets[bucket_name]
+
+    def get_object(self, bucket_name, key_name):
+        obj = self.get_bucket(bucket_name).get(key_name)
+        if obj is None:
+            raise S3Error(404, 'NoSuchKey', key_name)
+        return obj
+
+    def store(self, data, headers=None):
+        '''A FakeObject for a request body (a string, or a list of strings
+        from a streamed request).'''
+        if isinstance(data, list):
+            md5 = hashlib.md5()
+            size = 0
+            for chunk in data:
+                md5.update(chunk)
+                size += len(chunk)
+            if size <= self.keep_data_limit:
+                data = ''.join(data)
+            else:
+                data = None
+            return FakeObject(data, size, '"%s"' % md5.hexdigest(), headers)
+        if len(data) > self.keep_data_limit:
+            return FakeObject(None, len(data), '"%s"' % hashlib.md5(data).hexdigest(), headers)
+        return FakeObject(data, len(data), '"%s"' % hashlib.md5(data).hexdigest(), headers)
+
+    def put_object(self, bucket_name, key_name, obj):
+        bucket = self.get_bucket(bucket_name)
+        if key_name not in bucket:
+            self.sorted_names.pop(bucket_name, None)
+        bucket[key_name] = obj
+
+    def names(self, bucket_name):
+        names = self.sorted_names.get(bucket_name)
+        if names is None:
+            names = self.sorted_names[bucket_name] = sorted(self.buckets[bucket_name])
+        return names
+
+    def list_buckets(self):
+        xml = ['<ListAllMyBucketsResult><Owner><ID>faetus</ID><DisplayName>faetus</DisplayName>'
+               '</Owner><Buckets>']
+        for name in sorted(self.buckets):
+            xml.append('<Bucket><Name>%s</Name><CreationDate>%s</CreationDate></Bucket>'
+                       % (escape(name), iso_timestamp(0)))
+        xml.append('</Buckets></ListAllMyBucketsResult>')
+        return 200, {}, ''.join(xml)
+
+    def bucket_request(self, method, bucket_name, query, headers, body):
+        if method == 'PUT':
+            self.buckets.setdefault(bucket_name, {})
+            return 200, {}, ''
+        bucket = self.get_bucket(bucket_name)
+        if method == 'HEAD':
+            return 200, {}, ''
+        if method == 'DELETE':
+            if bucket:
+                raise S3Error(409, 'BucketNotEmpty', bucket_name)
+            del self.buckets[bucket_name]
+            self.sorted_names.pop(bucket_name, None)
+            return 204, {}, ''
+        if method == 'POST' and 'delete' in query:
+            return self.delete_objects(bucket_name, body)
+        if method == 'GET':
+            return self.list_objects(bucket_name, query)
+        raise S3Error(501, 'NotImplemented', method)
+
+    def list_objects(self, bucket_name, query):
+        bucket = self.buckets[bucket_name]
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter', '')
+        marker = query.get('marker', '')
+        max_keys = int(query.get('max-keys', 1000))
+        names = self.names(bucket_name)
+        i = bisect_left(names, max(prefix, marker))
+        contents = []
+        prefixes = []
+        last = None
+        truncated = False
+        while i < len(names):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            if name <= marker:
+                i += 1
+                continue
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            position = delimiter and name.find(delimiter, len(prefix))
+            if delimiter and position >= 0:
+                common = name[:position + len(delimiter)]
+                if prefixes and prefixes[-1] == common:
+                    i += 1
+                    continue
+                prefixes.append(common)
+                last = common
+                # Skip all the keys rolled up in this common prefix.
+                i = bisect_left(names, common + u'\uffff', i)
+                continue
+            contents.append((name, bucket[name]))
+            last = name
+            i += 1
+
+        xml = ['<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>'
+               '<MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>'
+               % (escape(bucket_name), escape(prefix), escape(marker), max_keys,
+                  truncated and 'true' or 'false')]
+        if delimiter:
+            xml.append('<Delimiter>%s</Delimiter>' % escape(delimiter))
+        if truncated and delimiter:
+            xml.append('<NextMarker>%s</NextMarker>' % escape(last))
+        for name, obj in contents:
+            xml.append('<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+                       '<ETag>%s</ETag><Size>%d</Size><StorageClass>STANDARD</StorageClass>'
+                       '</Contents>' % (escape(name), iso_timestamp(obj.last_modified),
+                                        escape(obj.etag), obj.size))
+        for common in prefixes:
+            xml.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(common))
+        xml.append('</ListBucketResult>')
+        return 200, {}, ''.join(xml)
+
+    def delete_objects(self, bucket_name, body):
+        bucket = self.buckets[bucket_name]
+        quiet = '<Quiet>true</Quiet>' in body
+        xml = ['<DeleteResult>']
+        for name in re.findall(r'<Key>(.*?)</Key>', body):
+            name = text(unescape(name))
+            if bucket.pop(name, None) is not None:
+                self.sorted_names.pop(bucket_name, None)
+            if not quiet:
+                xml.append('<Deleted><Key>%s</Key></Deleted>' % escape(name))
+        xml.append('</DeleteResult>')
+        return 200, {}, ''.join(xml)
+
+    def key_request(self, method, bucket_name, key_name, query, headers, body):
+        if method in ('GET', 'HEAD'):
+            if 'uploadId' in query:
+                return self.list_parts(query['uploadId'])
+            return self.get(method, self.get_object(bucket_name, key_name), headers)
+        if method == 'PUT':
+            if 'x-amz-copy-source' in headers:
+                return self.copy(bucket_name, key_name, query, headers)
+            # The body, already stored by request().
+            obj = body or self.store('')
+            if 'content-md5' in headers and \
+               base64.b64decode(headers['content-md5']) != obj.etag[1:-1].decode('hex'):
+                raise S3Error(400, 'BadDigest', key_name)
+            if 'partNumber' in query:
+                upload = self.get_upload(query['uploadId'])
+                upload.parts[int(query['partNumber'])] = obj
+                return 200, {'ETag': obj.etag}, ''
+            self.put_object(bucket_name, key_name, obj)
+            return 200, {'ETag': obj.etag}, ''
+        if method == 'DELETE':
+            if 'uploadId' in query:
+                self.uploads.pop(query['uploadId'], None)
+            elif self.get_bucket(bucket_name).pop(key_name, None) is not None:
+                self.sorted_names.pop(bucket_name, None)
+            return 204, {}, ''
+        if method == 'POST' and 'uploads' in query:
+            self.get_bucket(bucket_name)
+            upload_id = 'upload-%d' % self.upload_ids.next()
+            self.uploads[upload_id] = FakeUpload(upload_id, bucket_name, key_name, headers)
+            return 200, {}, ('<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>'
+                             '<UploadId>%s</UploadId></InitiateMultipartUploadResult>'
+                             % (escape(bucket_name), escape(key_name), upload_id))
+        if method == 'POST' and 'uploadId' in query:
+            return self.complete_upload(self.get_upload(query['uploadId']), body)
+        raise S3Error(501, 'NotImplemented', method)
+
+    def get(self, method, obj, headers):
+        if headers.get('if-match', obj.etag) != obj.etag:
+            raise S3Error(412, 'PreconditionFailed', 'If-Match')
+        response_headers = {'ETag': obj.etag,
+                            'Last-Modified': http_timestamp(obj.last_modified),
+                            'Content-Type': 'binary/octet-stream'}
+        for name, value in obj.headers.items():
+            response_headers[name.title()] = value
+        if headers.get('if-none-match') == obj.etag:
+            return 304, response_headers, ''
+        start, end, status = 0, obj.size, 200
+        match = re.match(r'bytes=(\d*)-(\d*)$', headers.get('range', ''))
+        if match:
+            start = int(match.group(1) or 0)
+            if match.group(2):
+                end = min(int(match.group(2)) + 1, obj.size)
+            if start >= obj.size:
+                raise S3Error(416, 'InvalidRange', headers['range'])
+            status = 206
+            response_headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, obj.size)
+        response_headers['Content-Length'] = str(end - start)
+        if method == 'HEAD':
+            return status, response_headers, ''
+        return status, response_headers, obj.read(start, end)
+
+    def copy(self, bucket_name, key_name, query, headers):
+        source_bucket, _, source_key = text(urllib.unquote(str(
+            headers['x-amz-copy-source']).lstrip('/'))).partition('/')
+        source = self.get_object(source_bucket, source_key)
+        if 'partNumber' in query:
+            upload = self.get_upload(query['uploadId'])
+            start, end = 0, source.size - 1
+            if 'x-amz-copy-source-range' in headers:
+                start, end = [int(n) for n in headers['x-amz-copy-source-range'][6:].split('-')]
+            data = source.read(start, end + 1)
+            if isinstance(data, ZeroBody):
+                data = [data.read(min(data.size, 1024 * 1024)) for i in
+                        range((data.size + 1024 * 1024 - 1) // (1024 * 1024))]
+            obj = upload.parts[int(query['partNumber'])] = self.store(data)
+            return 200, {}, ('<CopyPartResult><LastModified>%s</LastModified><ETag>%s</ETag>'
+                             '</CopyPartResult>' % (iso_timestamp(obj.last_modified),
+                                                    escape(obj.etag)))
+        obj = FakeObject(source.data, source.size, source.etag, source.headers)
+        self.put_object(bucket_name, key_name, obj)
+        return 200, {}, ('<CopyObjectResult><LastModified>%s</LastModified><ETag>%s</ETag>'
+                         '</CopyObjectResult>' % (iso_timestamp(obj.last_modified),
+                                                  escape(obj.etag)))
+
+    def get_upload(self, upload_id):
+        if upload_id not in self.uploads:
+            raise S3Error(404, 'NoSuchUpload', upload_id)
+        return self.uploads[upload_id]
+
+    def list_parts(self, upload_id):
+        upload = self.get_upload(upload_id)
+        xml = ['<ListPartsResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+               '<IsTruncated>false</IsTruncated>'
+               % (escape(upload.bucket_name), escape(upload.key_name), upload_id)]
+        for part_num, obj in sorted(upload.parts.items()):
+            xml.append('<Part><PartNumber>%d</PartNumber><LastModified>%s</LastModified>'
+                       '<ETag>%s</ETag><Size>%d</Size></Part>'
+                       % (part_num, iso_timestamp(obj.last_modified), escape(obj.etag), obj.size))
+        xml.append('</ListPartsResult>')
+        return 200, {}, ''.join(xml)
+
+    def complete_upload(self, upload, body):
+        parts = re.findall(r'<PartNumber>(\d+)</PartNumber>\s*<ETag>(.*?)</ETag>', body)
+        numbers = [int(number) for number, etag in parts]
+        if not parts or numbers != sorted(set(numbers)):
+            raise S3Error(400, 'InvalidPartOrder', upload.id)
+        objects = []
+        for number, etag in parts:
+            obj = upload.parts.get(int(number))
+            if obj is None or unescape(etag) != obj.etag:
+                raise S3Error(400, 'InvalidPart', number)
+            objects.append(obj)
+        size = sum([part.size for part in objects])
+        md5 = hashlib.md5(''.join([part.etag[1:-1].decode('hex') for part in objects]))
+        etag = '"%s-%d"' % (md5.hexdigest(), len(objects))
+        data = None
+        if size <= self.keep_data_limit and None not in [part.data for part in objects]:
+            data = ''.join([part.data for part in objects])
+        metadata = dict((name, value) for name, value in upload.headers.items()
+                        if name == 'content-type' or name.startswith('x-amz-meta-'))
+        self.put_object(upload.bucket_name, upload.key_name,
+                        FakeObject(data, size, etag, metadata))
+        del self.uploads[upload.id]
+        return 200, {}, ('<CompleteMultipartUploadResult><Location>/%s/%s</Location>'
+                         '<Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag>'
+                         '</CompleteMultipartUploadResult>'
+                         % (escape(upload.bucket_name), escape(upload.key_name),
+                            escape(upload.bucket_name), escape(upload.key_name), escape(etag)))
+
+
+def text(name):
+    '''Names (of buckets and keys) as unicode: boto sends them UTF-8 encoded.'''
+    if isinstance(name, str):
+        return name.decode('utf-8')
+    return name
+
+
+def unescape(string):
+    return string.replace('&quot;', '"').replace('&lt;', '<').replace('&gt;', '>') \
+        .replace('&amp;', '&')
+
+
+class S3Error(Exception):
+
+    def __init__(self, status, code, resource):
+        Exception.__init__(self, code)
+        self.status = status
+        self.code = code
+        self.resource = resource
+
+    def response(self):
+        return self.status, {}, ('<Error><Code>%s</Code><Message>%s</Message>'
+                                 '<Resource>%s</Resource></Error>'
+                                 % (self.code, self.code, escape(self.resource)))
+
+
+class FakeResponse(object):
+    '''What boto uses of an httplib.HTTPResponse.'''
+
+    def __init__(self, fake, status, headers, body):
+        self.fake = fake
+        self.status = status
+        self.reason = httplib.responses.get(status, '')
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if isinstance(body, str):
+            if 'Content-Length' not in headers:
+                headers['Content-Length'] = str(len(body))
+            body = StringIO(body)
+        self.msg = httplib.HTTPMessage(StringIO(''.join(['%s: %s\r\n' % item for item
+                                                         in headers.items()]) + '\r\n'))
+        self.body = body
+        self.closed = False
+
+    def read(self, amt=None):
+        if self.closed:
+            return ''
+        if amt is None:
+            data = self.body.read()
+        else:
+            data = self.body.read(amt)
+        self.fake.throttle(len(data))
+        if not data or amt is None:
+            self.closed = True
+        return data
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def getheaders(self):
+        return self.msg.items()
+
+    def isclosed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class FakeHTTPConnection(object):
+    '''What the boto upload senders use of an httplib.HTTPConnection: the
+ request body is collected as it is sent, then handed to the FakeS3.'''
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.headers = {}
+        self.chunks = []
+
+    def putrequest(self, method, path, **kwargs):
+        self.method = method
+        self.path = path
+
+    def putheader(self, name, value):
+        self.headers[name] = value
+
+    def endheaders(self):
+        pass
+
+    def set_debuglevel(self, level):
+        pass
+
+    def send(self, data):
+        self.fake.throttle(len(data))
+        self.chunks.append(data)
+
+    def getresponse(self):
+        status, headers, body = self.fake.request(self.method, self.path, self.headers,
+                                                  self.chunks)
+        return FakeResponse(self.fake, status, headers, body)
+
+
+class FakeS3Connection(FaetusS3Connection):
+    '''FaetusS3Connection whose requests are answered by a FakeS3.'''
+
+    def __init__(self, fake, aws_access_key_id, aws_secret_access_key):
+        self.fake = fake
+        super(FakeS3Connection, self).__init__(aws_access_key_id, aws_secret_access_key,
+                                               is_secure=False, host='fakes3',
+                                               calling_format=OrdinaryCallingFormat())
+
+    def _mexe(self, request, sender=None, override_num_retries=None, retry_handler=None):
+        if sender is not None:
+            return sender(FakeHTTPConnection(self.fake), request.method, request.path,
+                          request.body, request.headers)
+        body = request.body or ''
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        elif not isinstance(body, str):
+            body = body.read()
+        self.fake.throttle(len(body))
+        status, headers, body = self.fake.request(request.method, request.path,
+                                                  request.headers, body)
+        return FakeResponse(self.fake, status, headers, body)
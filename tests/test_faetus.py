@@ -4,6 +4,7 @@ import os
 import sys
 import ftplib
 import StringIO
+import hashlib
 
 from faetus.constants import default_address, default_port
 
@@ -48,6 +49,60 @@ class FaetusTest(unittest.TestCase):
         self.assertEqual(self.cnx.delete("testfile.txt"), "250 File removed.")
         store.close()
 
+    def test_resume_retr(self):
+        ''' resume a download with REST '''
+        content_string = "Hello Moto"
+        self.cnx.storbinary("STOR testfile.txt",
+                            StringIO.StringIO(content_string))
+        store = StringIO.StringIO()
+        self.cnx.retrbinary("RETR testfile.txt", store.write, rest=6)
+        self.assertEqual(store.getvalue(), "Moto")
+        self.cnx.delete("testfile.txt")
+        store.close()
+
+    def test_rename(self):
+        ''' rename file '''
+        content_string = "Hello Moto"
+        self.cnx.storbinary("STOR testfile.txt",
+                            StringIO.StringIO(content_string))
+        self.assertEqual(self.cnx.rename("testfile.txt", "renamed.txt"),
+                         "250 Renaming ok.")
+        self.assertEqual(self.cnx.nlst(), ["renamed.txt"])
+        self.cnx.delete("renamed.txt")
+
+    def test_rmtree(self):
+        ''' remove a directory with its content '''
+        for name in ("dir/a.txt", "dir/sub/b.txt"):
+            self.cnx.storbinary("STOR " + name, StringIO.StringIO("Hello Moto"))
+        self.assertEqual(self.cnx.sendcmd("SITE RMTREE dir"),
+                         "250 Directory removed (2 files).")
+        self.assertEqual(self.cnx.nlst(), [])
+
+    def test_site_md5(self):
+        ''' MD5 of an uploaded file '''
+        self.cnx.storbinary("STOR testfile.txt",
+                            StringIO.StringIO("Hello Moto"))
+        self.assertEqual(self.cnx.sendcmd("SITE MD5 testfile.txt"),
+                         "213 " + hashlib.md5("Hello Moto").hexdigest())
+        self.cnx.delete("testfile.txt")
+
+    def test_mlsd(self):
+        ''' machine listing of a directory '''
+        self.cnx.storbinary("STOR testfile.txt",
+                            StringIO.StringIO("Hello Moto"))
+        lines = []
+        self.cnx.retrlines("MLSD", lines.append)
+        self.assertEqual(len(lines), 1)
+        self.assert_(lines[0].startswith("type=file;size=10;"))
+        self.assert_(lines[0].endswith("; testfile.txt"))
+        self.cnx.delete("testfile.txt")
+
+    def test_site_stats(self):
+        ''' server statistics '''
+        stats = self.cnx.sendcmd("SITE STATS")
+        self.assert_(stats.startswith("211-Faetus statistics:"))
+        self.assert_(" MKD: " in stats)
+
     def test_write_to_slash(self):
         ''' write to slash should not be permitted '''
         self.cnx.cwd("/")
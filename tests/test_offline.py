@@ -0,0 +1,798 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''Faetus tests against the in-process S3 stand-in of fakes3.py: no AWS
+account or network needed.
+
+ PYTHONPATH=. python tests/test_offline.py
+'''
+import os
+import re
+import cgi
+import time
+import shutil
+import hashlib
+import ftplib
+import tempfile
+import StringIO
+import threading
+import unittest
+
+from pyftpdlib import ftpserver
+
+from fakes3 import FakeS3
+from faetus.server import FaetusFTPHandler, FaetusAuthorizer, FaetusFS, FaetusFD
+from faetus.server import connections
+from faetus.workers import WorkerPool
+from faetus.download import ParallelRangeReader
+from faetus.upload import ParallelPartUploader
+from faetus.spool import MemoryBudget, SpooledUpload
+from faetus.index import KeyIndex
+from faetus.writebehind import UploadQueue
+from faetus.diskcache import DiskCache
+from faetus.cache import MetadataCache, MISSING
+from faetus.prefork import PreforkServer, split_ports
+from faetus.throttle import Scheduler
+
+BUCKET = 'bucket'
+
+
+class MetadataCacheTest(unittest.TestCase):
+    ''' The cache of S3 lookups '''
+
+    def test_ttl(self):
+        ''' entries expire after ttl seconds, none are kept with 0 '''
+        cache = MetadataCache(ttl=0.05)
+        cache.set(('bucket', 'key'), 'value')
+        self.assertEqual(cache.get(('bucket', 'key')), 'value')
+        time.sleep(0.1)
+        self.assert_(cache.get(('bucket', 'key')) is MISSING)
+        cache = MetadataCache(ttl=0)
+        cache.set(('bucket', 'key'), 'value')
+        self.assert_(cache.get(('bucket', 'key')) is MISSING)
+
+    def test_lru(self):
+        ''' the least recently used entries go first '''
+        cache = MetadataCache(max_entries=2)
+        cache.set(('bucket', 'a'), 'a')
+        cache.set(('bucket', 'b'), 'b')
+        cache.get(('bucket', 'a'))
+        cache.set(('bucket', 'c'), 'c')
+        self.assert_(cache.get(('bucket', 'b')) is MISSING)
+        self.assertEqual(cache.get(('bucket', 'a')), 'a')
+        self.assertEqual(cache.get(('bucket', 'c')), 'c')
+
+    def test_negative(self):
+        ''' what does not exist is cached as None '''
+        cache = MetadataCache()
+        cache.set(('bucket', 'missing'), None)
+        self.assertEqual(cache.get(('bucket', 'missing')), None)
+        self.assert_(cache.get(('bucket', 'other')) is MISSING)
+
+    def test_invalidate_key(self):
+        ''' a key written or deleted forgets the directories it is in '''
+        cache = MetadataCache()
+        for key in [('bucket', 'a/b/c'), ('bucket', None, 'a/'), ('bucket', None, 'a/b/'),
+                    ('bucket', None, 'a/b/c/'), ('bucket', None, 'x/'), ('bucket', None),
+                    ('other', 'a/b/c')]:
+            cache.set(key, None)
+        cache.invalidate_key('bucket', 'a/b/c')
+        self.assertEqual(sorted(cache.entries), [('bucket', None), ('bucket', None, 'a/b/c/'),
+                                                 ('bucket', None, 'x/'), ('other', 'a/b/c')])
+
+    def test_invalidate_bucket(self):
+        ''' a bucket forgets all its entries '''
+        cache = MetadataCache()
+        for key in [('bucket', 'a'), ('bucket', None, 'a/'), ('bucket', None),
+                    ('other', 'a')]:
+            cache.set(key, None)
+        cache.invalidate_bucket('bucket')
+        self.assertEqual(cache.entries.keys(), [('other', 'a')])
+
+
+class PreforkTest(unittest.TestCase):
+    ''' What each worker process gets, without forking them '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_split_ports(self):
+        ''' contiguous slices, of sizes differing by one at most '''
+        self.assertEqual(split_ports(range(10), 3), [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        self.assertEqual(split_ports(range(4), 4), [[0], [1], [2], [3]])
+        self.assertEqual(split_ports(range(2), 3), [[0], [1], []])
+
+    def test_passive_ports(self):
+        ''' each worker has its own passive ports '''
+        class Handler(object):
+            passive_ports = range(60000, 60005)
+        class Server(object):
+            handler = Handler
+        server = PreforkServer(Server(), 2)
+        self.assertEqual(server.passive_ports, [range(60000, 60003), range(60003, 60005)])
+
+    def test_slot_directories(self):
+        ''' the disk cache and write-behind queue of a worker are its own '''
+        cache = DiskCache(os.path.join(self.dir, 'cache'), 4 * 1024 * 1024)
+        queue = UploadQueue(os.path.join(self.dir, 'queue'), connections)
+        for slot in range(2):
+            part = cache.part(slot, 2)
+            self.assertEqual(part.directory, os.path.join(self.dir, 'cache', 'worker-%d' % slot))
+            self.assertEqual(part.max_size, 2 * 1024 * 1024)
+            self.assertEqual(part.max_object_size, cache.max_object_size)
+            self.assertEqual(queue.part(slot, 2).directory,
+                             os.path.join(self.dir, 'queue', 'worker-%d' % slot))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'cache'))),
+                         ['worker-0', 'worker-1'])
+
+
+class OfflineTest(unittest.TestCase):
+    ''' Faetus against a FakeS3 '''
+
+    def setUp(self):
+        self.saved = []
+        self.fake = FakeS3()
+        self.set(connections, 'connection_class', self.fake.connection)
+        connections.clear()
+        self.fake.request('PUT', '/' + BUCKET, {}, '')
+        self.set(FaetusFTPHandler, 'authorizer', FaetusAuthorizer())
+        self.set(FaetusFTPHandler, 'abstracted_fs', FaetusFS)
+        self.set(ftpserver, 'log', lambda msg: None)
+        self.set(ftpserver, 'logline', lambda msg: None)
+        self.server = None
+        self.pool = None
+
+    def set(self, obj, name, value):
+        '''Set obj.name to value until the end of the test.'''
+        self.saved.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def start(self, threads=0):
+        '''Start the FTP server, once the test has set its options, with a
+        pool of that many threads making the S3 calls.'''
+        if threads:
+            self.pool = WorkerPool(threads)
+            self.set(FaetusFTPHandler, 'worker_pool', self.pool)
+        self.server = ftpserver.FTPServer(('127.0.0.1', 0), FaetusFTPHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'timeout': 0.01})
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def client(self, username='user', password='secret'):
+        if self.server is None:
+            self.start()
+        client = ftplib.FTP()
+        client.connect('127.0.0.1', self.server.socket.getsockname()[1])
+        client.login(username, password)
+        client.cwd('/' + BUCKET)
+        return client
+
+    def put(self, name, data='Hello Moto'):
+        '''Store a key straight into the fake S3.'''
+        self.fake.request('PUT', '/%s/%s' % (BUCKET, name), {}, data)
+
+    def requests_with(self, parameter):
+        '''The (method, path) of the requests the fake S3 got with that
+        query parameter.'''
+        return [(method, path) for method, path in self.fake.requests
+                if parameter in cgi.parse_qs(path.partition('?')[2], keep_blank_values=True)]
+
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.close()
+        if self.server is not None:
+            self.server.close_all()
+            self.thread.join()
+        connections.clear()
+        for obj, name, value in reversed(self.saved):
+            setattr(obj, name, value)
+
+
+class NonAsciiTest(OfflineTest):
+    ''' Names outside of ASCII '''
+
+    def test_list_non_ascii_directory(self):
+        ''' list a directory with a non-ASCII name '''
+        self.put('été/x.txt')
+        self.put('été/sub/y.txt')
+        cnx = self.client()
+        self.assertEqual(cnx.nlst(), ['été'])
+        self.assertEqual(sorted(cnx.nlst('été')), ['sub', 'x.txt'])
+        lines = []
+        cnx.retrlines('LIST été', lines.append)
+        self.assertEqual(sorted([line.split(' ')[-1] for line in lines]), ['sub', 'x.txt'])
+        cnx.quit()
+
+    def test_rename_non_ascii_directory(self):
+        ''' rename directories from and to non-ASCII names '''
+        self.put('été/x.txt')
+        self.put('été/sub/y.txt')
+        cnx = self.client()
+        self.assertEqual(cnx.rename('été', 'new'), '250 Renaming ok.')
+        self.assertEqual(sorted(self.fake.buckets[BUCKET]), [u'new/sub/y.txt', u'new/x.txt'])
+        self.assertEqual(cnx.rename('new', 'déjà'), '250 Renaming ok.')
+        self.assertEqual(sorted(self.fake.buckets[BUCKET]),
+                         [u'd\xe9j\xe0/sub/y.txt', u'd\xe9j\xe0/x.txt'])
+        cnx.quit()
+
+
+class DeleteTest(OfflineTest):
+    ''' Recursive deletes '''
+
+    def test_rmtree_errors(self):
+        ''' SITE RMTREE of a file or of nothing '''
+        self.put('file')
+        cnx = self.client()
+        for path, error in (('file', '550 Not a directory.'),
+                            ('missing', '550 No such file or directory.')):
+            try:
+                cnx.sendcmd('SITE RMTREE ' + path)
+            except ftplib.error_perm, e:
+                self.assertEqual(str(e), error)
+            else:
+                self.fail(path)
+        self.assertEqual(sorted(self.fake.buckets[BUCKET]), ['file'])
+        cnx.quit()
+
+
+class ThrottleTest(OfflineTest):
+    ''' Per-user limits '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        # Two FTP users of the same S3 account, only alice being limited.
+        self.set(FaetusFTPHandler, 'authorizer', FaetusAuthorizer(
+            None, {'alice': 'key', 'bob': 'key'}, {}, {'alice': (200 * 1024, 0)}))
+        self.set(FaetusFTPHandler, 'scheduler', Scheduler(burst=0.1))
+        self.put('file', 'x' * 200 * 1024)
+
+    def retr_time(self, cnx):
+        start = time.time()
+        cnx.retrbinary('RETR file', lambda data: None)
+        return time.time() - start
+
+    def check_limits(self, first, second):
+        cnx = {}
+        for username in (first, second):
+            cnx[username] = self.client(username)
+        self.assert_(self.retr_time(cnx['alice']) > 0.7)
+        self.assert_(self.retr_time(cnx['bob']) < 0.5)
+        for client in cnx.values():
+            client.quit()
+
+    def test_limited_user_first(self):
+        ''' each user gets its own limits, the limited one logged in first '''
+        self.check_limits('alice', 'bob')
+
+    def test_unlimited_user_first(self):
+        ''' each user gets its own limits, the unlimited one logged in first '''
+        self.check_limits('bob', 'alice')
+
+
+
+class ConnectionTest(OfflineTest):
+    ''' S3 connections shared by the sessions '''
+
+    def test_shared_connection(self):
+        ''' the sessions of the same credentials share one connection '''
+        first, second = self.client(), self.client()
+        self.assertEqual(len(connections.entries), 1)
+        self.assertEqual(connections.entries.values()[0].sessions, 2)
+        first.quit()
+        second.quit()
+
+    def test_throttled_connections(self):
+        ''' FTP users limited apart get a connection each '''
+        self.set(FaetusFTPHandler, 'authorizer', FaetusAuthorizer(
+            None, {'alice': 'key', 'bob': 'key'}, {}, {'alice': (200 * 1024, 0)}))
+        self.set(FaetusFTPHandler, 'scheduler', Scheduler())
+        sessions = [self.client(username) for username in ('alice', 'bob', 'alice')]
+        self.assertEqual(sorted([(key[0], account.sessions) for key, account
+                                 in connections.entries.items()]), [('key', 1), ('key', 2)])
+        for cnx in sessions:
+            cnx.quit()
+
+    def test_max_pooled_sockets(self):
+        ''' at most max_pooled_sockets idle sockets are kept '''
+        class Socket(object):
+            closed = False
+            def close(self):
+                self.closed = True
+        connection = self.fake.connection('key', 'secret')
+        connection.max_pooled_sockets = 2
+        sockets = [Socket() for i in range(3)]
+        for sock in sockets:
+            connection.put_http_connection('s3.amazonaws.com', 443, True, sock)
+        self.assertEqual(connection._pool.size(), 2)
+        self.assertEqual([sock.closed for sock in sockets], [False, False, True])
+        connection.close()
+        self.assertEqual([sock.closed for sock in sockets], [True, True, True])
+
+
+class CacheTest(OfflineTest):
+    ''' What the sessions see of their own changes, within the cache TTL '''
+
+    def names(self, cnx, path):
+        lines = []
+        cnx.retrlines('LIST ' + path, lines.append)
+        return sorted([line.split(' ')[-1] for line in lines])
+
+    def test_list_after_changes(self):
+        ''' LIST after STOR, DELE and RNTO '''
+        self.put('dir/a')
+        cnx = self.client()
+        self.assertEqual(self.names(cnx, 'dir'), ['a'])
+        self.assertRaises(ftplib.error_perm, cnx.cwd, 'new')
+        cnx.storbinary('STOR dir/b', StringIO.StringIO('b'))
+        cnx.storbinary('STOR new/c', StringIO.StringIO('c'))
+        self.assertEqual(self.names(cnx, 'dir'), ['a', 'b'])
+        self.assertEqual(self.names(cnx, ''), ['dir', 'new'])
+        cnx.cwd('new')
+        cnx.cwd('..')
+        cnx.delete('dir/a')
+        cnx.rename('dir/b', 'new/b')
+        self.assertEqual(self.names(cnx, 'new'), ['b', 'c'])
+        self.assertEqual(self.names(cnx, ''), ['new'])
+        self.assertRaises(ftplib.error_perm, cnx.cwd, 'dir')
+        cnx.quit()
+
+
+class ProbeTest(OfflineTest):
+    ''' S3 requests of the path checks '''
+
+    def test_repeated_probes(self):
+        ''' one bounded request per path checked, none when checked again '''
+        self.put('dir/a')
+        cnx = self.client()
+        cnx.voidcmd('TYPE I')
+        for commands, requests in (
+                (['CWD dir', 'CWD ..'], [('GET', '/bucket/?max-keys=1&prefix=dir/')]),
+                (['CWD missing'], [('GET', '/bucket/?max-keys=1&prefix=missing/')]),
+                (['SIZE dir/a'], [('HEAD', '/bucket/dir/a')]),
+                (['SIZE dir'], [('HEAD', '/bucket/dir')]),
+                (['SIZE missing'], [('HEAD', '/bucket/missing')])):
+            del self.fake.requests[:]
+            for i in range(3):
+                for command in commands:
+                    try:
+                        cnx.sendcmd(command)
+                    except ftplib.error_perm:
+                        pass
+            self.assertEqual(self.fake.requests, requests)
+        cnx.quit()
+
+
+class WorkerPoolTest(OfflineTest):
+    ''' S3 calls made in a pool of threads '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.put('file')
+        self.start(threads=4)
+
+    def test_mdtm(self):
+        ''' modification time of a file '''
+        cnx = self.client()
+        self.assert_(cnx.sendcmd('MDTM file').startswith('213 '))
+        self.assertRaises(ftplib.error_perm, cnx.sendcmd, 'MDTM missing')
+        cnx.quit()
+
+    def test_stat(self):
+        ''' listing over the command channel '''
+        cnx = self.client()
+        lines = cnx.sendcmd('STAT /%s' % BUCKET).split('\n')
+        self.assertEqual(lines[0], '213-Status of "/%s":' % BUCKET)
+        self.assert_(lines[1].endswith(' file'))
+        self.assertEqual(lines[-1], '213 End of status.')
+        cnx.quit()
+
+    def test_loop_not_blocked(self):
+        ''' MDTM and STAT do not hold the other sessions up '''
+        cnx, other = self.client(), self.client()
+        self.fake.latency = 0.5
+        for command in ('MDTM file', 'STAT /%s' % BUCKET):
+            cnx.putcmd(command)
+            time.sleep(0.1)
+            start = time.time()
+            other.voidcmd('NOOP')
+            self.assert_(time.time() - start < 0.2, command)
+            cnx.getmultiline()
+        self.fake.latency = 0
+        cnx.quit()
+        other.quit()
+
+
+
+class UploadTest(OfflineTest):
+    ''' Parallel multipart uploads '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.set(FaetusFD, 'multipart_chunk_size', 16 * 1024)
+        self.set(FaetusFD, 'upload_concurrency', 2)
+        self.set(FaetusFD, 'upload_buffer_size', 32 * 1024)
+        self.full = []
+        submit = ParallelPartUploader.submit
+        def checked_submit(uploader, part_num, data, md5=None):
+            if not uploader.ready():
+                self.full.append(part_num)
+            submit(uploader, part_num, data, md5)
+        self.set(ParallelPartUploader, 'submit', checked_submit)
+
+    def check_buffer_bound(self):
+        data = ''.join([chr(i % 256) for i in range(256 * 1024)])
+        cnx = self.client()
+        self.fake.latency = 0.05
+        cnx.storbinary('STOR file', StringIO.StringIO(data), 16 * 1024)
+        self.fake.latency = 0
+        cnx.quit()
+        self.assertEqual(self.full, [])
+        self.assertEqual(self.fake.buckets[BUCKET]['file'].data, data)
+
+    def test_buffer_bound(self):
+        ''' the data channel waits for room in the upload buffer '''
+        self.check_buffer_bound()
+
+    def test_buffer_bound_threads(self):
+        ''' the same, with the S3 calls in a pool of threads '''
+        self.start(threads=4)
+        self.check_buffer_bound()
+
+
+class MultipartTest(OfflineTest):
+    ''' Uploads in parts of multipart_chunk_size bytes '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.set(ftpserver, 'logerror', lambda msg: None)
+        self.set(FaetusFD, 'multipart_chunk_size', 16 * 1024)
+        # The 226 reply waits for S3 to have the key.
+        self.start(threads=4)
+
+    def stor(self, cnx, data):
+        cnx.storbinary('STOR file', StringIO.StringIO(data), 16 * 1024)
+
+    def test_parts(self):
+        ''' the parts make the key, with the ETag of a multipart upload '''
+        data = ''.join([chr(i % 251) for i in range(100 * 1024)])
+        cnx = self.client()
+        self.stor(cnx, data)
+        obj = self.fake.buckets[BUCKET]['file']
+        self.assertEqual(obj.data, data)
+        self.assert_(obj.etag.endswith('-%d"' % len(self.requests_with('partNumber'))))
+        self.assert_(len(self.requests_with('partNumber')) > 1)
+        cnx.quit()
+
+    def test_single_part(self):
+        ''' a key smaller than a part is sent with a plain PUT '''
+        cnx = self.client()
+        self.stor(cnx, 'Hello Moto')
+        obj = self.fake.buckets[BUCKET]['file']
+        self.assertEqual(obj.data, 'Hello Moto')
+        self.assertEqual(obj.etag, '"%s"' % hashlib.md5('Hello Moto').hexdigest())
+        self.assertEqual(self.requests_with('uploads'), [])
+        cnx.quit()
+
+    def test_wrong_etag(self):
+        ''' an upload S3 completes with another ETag than its parts' fails '''
+        complete_upload = self.fake.complete_upload
+        def wrong_complete_upload(upload, body):
+            status, headers, body = complete_upload(upload, body)
+            return status, headers, re.sub('<ETag>.*</ETag>', '<ETag>&quot;0-1&quot;</ETag>', body)
+        self.set(self.fake, 'complete_upload', wrong_complete_upload)
+        cnx = self.client()
+        self.assertRaises(ftplib.error_temp, self.stor, cnx, 'x' * 40 * 1024)
+        cnx.quit()
+
+    def test_abort(self):
+        ''' ABOR cancels the multipart upload '''
+        cnx = self.client()
+        cnx.voidcmd('TYPE I')
+        transfer = cnx.transfercmd('STOR file')
+        transfer.sendall('x' * 40 * 1024)
+        deadline = time.time() + 5
+        while not self.requests_with('partNumber'):
+            self.assert_(time.time() < deadline)
+            time.sleep(0.01)
+        cnx.abort()
+        transfer.close()
+        cnx.getresp()
+        deadline = time.time() + 5
+        while self.fake.uploads:
+            self.assert_(time.time() < deadline)
+            time.sleep(0.01)
+        self.assert_('file' not in self.fake.buckets[BUCKET])
+        cnx.quit()
+
+
+class DiskCacheTest(OfflineTest):
+    ''' Downloads kept on the local disk '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.set(FaetusFD, 'disk_cache', DiskCache(self.dir, 1024 * 1024))
+
+    def tearDown(self):
+        OfflineTest.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def retr(self, cnx):
+        chunks = []
+        cnx.retrbinary('RETR file', chunks.append)
+        return ''.join(chunks)
+
+    def test_revalidation(self):
+        ''' a cached key is served from the disk while S3 has not changed it '''
+        self.put('file', 'first')
+        cnx = self.client()
+        self.assertEqual(self.retr(cnx), 'first')
+        self.assertEqual(len(FaetusFD.disk_cache.entries), 1)
+        # Not a new version as far as S3 tells: the cached copy is served.
+        self.fake.buckets[BUCKET]['file'].data = 'stale'
+        self.assertEqual(self.retr(cnx), 'first')
+        # A new version, while the stat() of the key, cached, still gives
+        # the old ETag.
+        self.put('file', 'second')
+        self.assertEqual(self.retr(cnx), 'second')
+        self.assertEqual(self.retr(cnx), 'second')
+        self.assertEqual(len(FaetusFD.disk_cache.entries), 1)
+        cnx.quit()
+
+
+class SpoolTest(OfflineTest):
+    ''' Uploads kept in memory '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.set(FaetusFD, 'spool_memory_size', 100)
+        self.set(FaetusFD, 'spool_budget', MemoryBudget(150))
+        self.spilled = []
+        spill = SpooledUpload.spill
+        def recorded_spill(spool):
+            self.spilled.append(spool.size)
+            spill(spool)
+        self.set(SpooledUpload, 'spill', recorded_spill)
+
+    def stor(self, cnx, name, size):
+        data = ''.join([chr(i % 256) for i in range(size)])
+        cnx.storbinary('STOR ' + name, StringIO.StringIO(data), 30)
+        # Without --threads, the upload is made once 226 is sent.
+        cnx.voidcmd('NOOP')
+        self.assertEqual(self.fake.buckets[BUCKET][name].data, data)
+
+    def test_spill(self):
+        ''' uploads spill to the disk beyond spool_memory_size '''
+        cnx = self.client()
+        self.stor(cnx, 'small', 100)
+        self.assertEqual(self.spilled, [])
+        self.stor(cnx, 'large', 101)
+        self.assertEqual(len(self.spilled), 1)
+        self.assertEqual(FaetusFD.spool_budget.used, 0)
+        cnx.quit()
+
+    def test_budget(self):
+        ''' uploads spill to the disk early when the budget is used up '''
+        # Taken by the other sessions.
+        FaetusFD.spool_budget.reserve(100)
+        cnx = self.client()
+        self.stor(cnx, 'small', 60)
+        self.assertEqual(len(self.spilled), 1)
+        self.assertEqual(FaetusFD.spool_budget.used, 100)
+        cnx.quit()
+
+
+class DownloadTest(OfflineTest):
+    ''' Parallel ranged downloads '''
+
+    def test_buffer_bound(self):
+        ''' no more ranges in flight than the buffer holds '''
+        data = ''.join([chr(i % 256) for i in range(100)])
+        self.put('file', data)
+        bucket = self.fake.connection('key', 'secret').get_bucket(BUCKET)
+        reader = ParallelRangeReader(bucket, 'file', None, len(data), concurrency=16,
+                                     range_size=10, buffer_size=35)
+        self.assertEqual(len(reader.threads), 3)
+        self.assert_(len(reader.ranges) <= 3)
+        chunks = [reader.read(5)]
+        while chunks[-1]:
+            self.assert_(len(reader.ranges) <= 3)
+            chunks.append(reader.read(5))
+        self.assertEqual(''.join(chunks), data)
+        reader.close()
+
+
+class KeyIndexTest(OfflineTest):
+    ''' Key index shared by worker processes '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        OfflineTest.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def listings(self):
+        return len([path for method, path in self.fake.requests
+                    if method == 'GET' and path.split('?')[0].rstrip('/') == '/' + BUCKET])
+
+    def test_one_listing(self):
+        ''' a bucket used by several workers is listed by one of them '''
+        self.put('file')
+        bucket = self.fake.connection('key', 'secret').get_bucket(BUCKET)
+        # One per worker, as each process has its own.
+        indexes = [KeyIndex(os.path.join(self.dir, 'index'), 60) for i in range(4)]
+        for index in indexes:
+            index.covers(bucket)
+        deadline = time.time() + 5
+        while not all([index.covers(bucket) for index in indexes]):
+            self.assert_(time.time() < deadline)
+            time.sleep(0.05)
+        time.sleep(0.2)
+        self.assertEqual(self.listings(), 1)
+        self.assertEqual([key.name for key in indexes[-1].list(bucket, '')], ['file'])
+
+
+class WriteBehindTest(OfflineTest):
+    ''' Uploads journaled on the local disk '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.set(ftpserver, 'logerror', lambda msg: None)
+        self.dir = tempfile.mkdtemp()
+        self.data = ''.join([chr(i) for i in range(25)])
+
+    def tearDown(self):
+        OfflineTest.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def journal(self, queue, name):
+        '''Journal an upload of self.data to name, written in pieces not
+        aligned on the parts.'''
+        entry = queue.new()
+        for start in range(0, len(self.data), 7):
+            entry.write(self.data[start:start + 7])
+        queue.submit(entry, 'user', BUCKET, name, hashlib.md5(self.data).hexdigest())
+        return entry
+
+    def resume(self, queue, name):
+        '''Let queue resume its journal, and wait for the upload of name.'''
+        queue.login(('user', 'secret'))
+        queue.flush('user', BUCKET, name)
+
+    def test_replay(self):
+        ''' the uploads journaled before a crash are sent on restart '''
+        self.journal(UploadQueue(self.dir, connections, part_size=10), 'file')
+        # Also left by the crash: a STOR cut short, a journal entry half written.
+        open(os.path.join(self.dir, 'upload-cut.data'), 'w').write('x')
+        open(os.path.join(self.dir, 'tmp-entry'), 'w').write('{')
+        self.resume(UploadQueue(self.dir, connections, part_size=10), 'file')
+        self.assertEqual(self.fake.buckets[BUCKET]['file'].data, self.data)
+        self.assert_(self.fake.buckets[BUCKET]['file'].etag.endswith('-3"'))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_replay_changed_data(self):
+        ''' data changed on the disk since it was journaled is not sent '''
+        entry = self.journal(UploadQueue(self.dir, connections, part_size=10), 'file')
+        data = open(entry.path, 'r+b')
+        data.seek(12)
+        data.write('!')
+        data.close()
+        queue = UploadQueue(self.dir, connections, part_size=10, retry_delay=60)
+        self.assertRaises(IOError, self.resume, queue, 'file')
+        self.assert_('file' not in self.fake.buckets[BUCKET])
+        self.assertEqual(self.fake.uploads, {})
+
+    def test_removed_worker(self):
+        ''' the journal of a worker process gone from the next run is resumed '''
+        queue = UploadQueue(self.dir, connections)
+        slot = queue.part(1, 2)
+        # Started, but dead before its user logged in again.
+        slot.login(('other', 'secret'))
+        self.journal(slot, 'file')
+        self.resume(queue.part(0, 1), 'file')
+        self.assertEqual(self.fake.buckets[BUCKET]['file'].data, self.data)
+
+
+class WriteBehindFTPTest(OfflineTest):
+    ''' Keys still being uploaded in the background, over FTP '''
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.set(ftpserver, 'logerror', lambda msg: None)
+        self.dir = tempfile.mkdtemp()
+        self.queue = UploadQueue(self.dir, connections, max_attempts=2, retry_delay=0.01)
+        self.set(FaetusFD, 'upload_queue', self.queue)
+        # The uploads wait for the test to let them go.
+        self.released = threading.Event()
+        next_upload = UploadQueue.next_upload
+        def held_next_upload(queue):
+            self.released.wait()
+            return next_upload(queue)
+        self.set(UploadQueue, 'next_upload', held_next_upload)
+        self.start(threads=4)
+
+    def tearDown(self):
+        self.released.set()
+        OfflineTest.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def stor(self, cnx, name, data='Hello Moto'):
+        cnx.storbinary('STOR ' + name, StringIO.StringIO(data))
+
+    def retr(self, cnx, name):
+        chunks = []
+        cnx.retrbinary('RETR ' + name, chunks.append)
+        return ''.join(chunks)
+
+    def test_pending_key(self):
+        ''' a key not on S3 yet is as it will be '''
+        cnx = self.client()
+        self.stor(cnx, 'dir/file')
+        self.assertEqual(cnx.size('dir/file'), 10)
+        self.assert_(cnx.sendcmd('MDTM dir/file').startswith('213 '))
+        self.assertEqual(cnx.nlst('dir'), ['file'])
+        cnx.cwd('dir')
+        self.assertEqual(self.retr(cnx, 'file'), 'Hello Moto')
+        self.assertEqual(self.fake.buckets[BUCKET], {})
+        self.released.set()
+        self.queue.flush('user', BUCKET, 'dir/file')
+        self.assertEqual(self.fake.buckets[BUCKET]['dir/file'].data, 'Hello Moto')
+        cnx.quit()
+
+    def test_retr_pending_key(self):
+        ''' RETR of a pending key does not wait for its upload '''
+        cnx, other = self.client(), self.client()
+        self.stor(cnx, 'file', 'x' * 100000)
+        # The transfer is left waiting: the key is read meanwhile.
+        cnx.voidcmd('TYPE I')
+        transfer = cnx.transfercmd('RETR file')
+        start = time.time()
+        other.voidcmd('NOOP')
+        self.assert_(time.time() - start < 0.2)
+        data = []
+        while not data or data[-1]:
+            data.append(transfer.recv(65536))
+        transfer.close()
+        cnx.voidresp()
+        self.assertEqual(''.join(data), 'x' * 100000)
+        # REST too.
+        cnx.sendcmd('REST 99990')
+        self.assertEqual(self.retr(cnx, 'file'), 'x' * 10)
+        self.assertEqual(self.fake.buckets[BUCKET], {})
+        cnx.quit()
+        other.quit()
+
+    def test_dele_pending_key(self):
+        ''' a key deleted before its upload is never sent '''
+        cnx = self.client()
+        self.stor(cnx, 'file')
+        cnx.delete('file')
+        self.assertRaises(ftplib.error_perm, cnx.size, 'file')
+        self.assertEqual(os.listdir(self.dir), [])
+        self.released.set()
+        self.queue.flush('user', BUCKET, 'file')
+        self.assertEqual(self.fake.buckets[BUCKET], {})
+        cnx.quit()
+
+    def test_failed_upload(self):
+        ''' an upload failing write_behind_attempts times is set aside '''
+        cnx = self.client()
+        self.stor(cnx, 'file')
+        del self.fake.buckets[BUCKET]
+        self.released.set()
+        deadline = time.time() + 5
+        while self.queue.entries:
+            self.assert_(time.time() < deadline)
+            time.sleep(0.01)
+        self.assertEqual(sorted([name.split('.', 1)[1] for name in os.listdir(self.dir)]),
+                         ['failed.data', 'failed.json'])
+        cnx.quit()
+
+
+if __name__ == '__main__':
+    unittest.main()